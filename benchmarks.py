@@ -0,0 +1,523 @@
+import sys
+import os
+import re
+import math
+import shutil
+import random
+import datetime
+import logging
+import threading
+import contextlib
+import functools
+import psutil
+import pandas as pd
+from time import time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from utilities import Utilities
+import parseForms
+import downloadForms
+import pipelineMetrics
+
+
+def fixup_reference(html):
+    # fixup as it was before the single pass rewrite, kept to check the
+    # new one gives the same text and to time it against
+    html = re.sub("<\?xml.*\?>", "", html)
+    html = re.sub("&", "and", html)
+    html = re.sub("<ACCEPTANCE-DATETIME>", "ACCEPTANCE-DATETIME: ", html)
+    noends = ["TYPE", "SEQUENCE", "FILENAME", "DESCRIPTION"]
+    tups = []
+    for ne in noends:
+        ms = [*re.finditer(f"<({ne})>([^<]*)(<.*>)", html)]
+        for i, m in enumerate(ms):
+            one = f"</{m.group(1)}>"
+            tups.append((m.start(), m.end(), m.group(1), one,  m.group(3)))
+    rdf = pd.DataFrame(tups, columns=["start", "end", "grp1", "one", "grp3"])
+    rdf.sort_values(by="start", inplace=True)
+    newhtml = ''
+    laststart = 0
+    for idx, row in rdf.iterrows():
+        if row["one"] != row["grp3"]:
+            pos = row["end"] - len(row["grp3"])
+            newstr = row["one"] + "\n"
+            newhtml += html[laststart:pos] + newstr
+            laststart = pos
+    newhtml += html[laststart:]
+    return newhtml
+
+
+def make_13f(nrows, ndocs=2, seed=0, form="13F-HR", CIK=1234567, fid="0001234567-21-000001",
+             company="SMITH & JONES CAPITAL", dt=datetime.datetime(2021, 9, 8), period="20210630",
+             accepted=None):
+    # a submission with nrows infoTable entries and ndocs documents. A 13F-NT has
+    # only the cover document. accepted replaces the ACCEPTANCE-DATETIME value,
+    # False drops the line
+    rnd = random.Random(seed)
+    datestr = dt.strftime("%Y%m%d")
+    accepted = dt.strftime("%Y%m%d") + "123456" if accepted is None else accepted
+    lines = [f"<SEC-DOCUMENT>{fid}.txt : {datestr}",
+             f"<SEC-HEADER>{fid}.hdr.sgml : {datestr}"]
+    if accepted is not False:
+        lines += [f"<ACCEPTANCE-DATETIME>{accepted}"]
+    lines += [f"ACCESSION NUMBER:\t\t{fid}",
+              f"CONFORMED SUBMISSION TYPE:\t{form}",
+              f"CONFORMED PERIOD OF REPORT:\t{period}",
+              f"FILED AS OF DATE:\t\t{datestr}",
+              f"\t\tCOMPANY CONFORMED NAME:\t\t\t{company}",
+              f"\t\tCENTRAL INDEX KEY:\t\t\t{CIK:010d}",
+              "\t\tCITY:\t\t\tNEW YORK",
+              "\t\tSTATE:\t\t\tNY",
+              "</SEC-HEADER>"]
+    if form.startswith("13F-NT"):
+        ndocs = 1
+        nrows = 0
+    for di in range(ndocs - 1 if nrows > 0 else ndocs):
+        lines += ["<DOCUMENT>", f"<TYPE>{form}", f"<SEQUENCE>{di+1}", "<FILENAME>primary_doc.xml",
+                  "<DESCRIPTION>COVER</DESCRIPTION>", "<TEXT>", "<XML>",
+                  '<?xml version="1.0" encoding="UTF-8"?>',
+                  '<edgarSubmission xmlns="http://www.sec.gov/edgar/thirteenffiler">',
+                  f"<reportType>{'13F NOTICE' if nrows == 0 else '13F HOLDINGS REPORT'}</reportType>",
+                  f"<tableEntryTotal>{nrows}</tableEntryTotal>",
+                  "</edgarSubmission>", "</XML>", "</TEXT>", "</DOCUMENT>"]
+    if nrows > 0:
+        lines += ["<DOCUMENT>", "<TYPE>INFORMATION TABLE", f"<SEQUENCE>{ndocs}", "<FILENAME>infotable.xml",
+                  "<TEXT>", "<XML>", '<?xml version="1.0" encoding="UTF-8"?>',
+                  '<informationTable xmlns="http://www.sec.gov/edgar/document/thirteenf/informationtable">']
+        for i in range(nrows):
+            lines += ["<infoTable>",
+                      f"<nameOfIssuer>ISSUER {i} &amp; CO</nameOfIssuer>",
+                      "<titleOfClass>COM</titleOfClass>",
+                      f"<cusip>{rnd.randint(0, 10**9):09d}</cusip>",
+                      f"<value>{rnd.randint(1, 10**6)}</value>",
+                      f"<shrsOrPrnAmt><sshPrnamt>{rnd.randint(1, 10**6)}</sshPrnamt>"
+                      "<sshPrnamtType>SH</sshPrnamtType></shrsOrPrnAmt>",
+                      "<investmentDiscretion>SOLE</investmentDiscretion>",
+                      f"<votingAuthority><Sole>{i}</Sole><Shared>0</Shared><None>0</None></votingAuthority>",
+                      "</infoTable>"]
+        lines += ["</informationTable>", "</XML>", "</TEXT>", "</DOCUMENT>"]
+    lines += ["</SEC-DOCUMENT>"]
+    return "\n".join(lines) + "\n"
+
+
+def make_form4(ntrans, nderiv=0, seed=0, form="4", CIK=1234567, fid="0001234567-21-000001",
+               company="DOE JOHN", dt=datetime.datetime(2021, 9, 8), issuerCik=320193, issuer="ACME & SONS INC"):
+    # a Form 4 with ntrans non-derivative and nderiv derivative transactions,
+    # the values wrapped in <value> as EDGAR has them
+    rnd = random.Random(seed)
+    datestr = dt.strftime("%Y%m%d")
+    lines = [f"<SEC-DOCUMENT>{fid}.txt : {datestr}",
+             f"<SEC-HEADER>{fid}.hdr.sgml : {datestr}",
+             f"<ACCEPTANCE-DATETIME>{datestr}163015",
+             f"ACCESSION NUMBER:\t\t{fid}",
+             f"CONFORMED SUBMISSION TYPE:\t{form}",
+             f"CONFORMED PERIOD OF REPORT:\t{datestr}",
+             f"FILED AS OF DATE:\t\t{datestr}",
+             "REPORTING-OWNER:\t",
+             "\tOWNER DATA:\t",
+             f"\t\tCOMPANY CONFORMED NAME:\t\t\t{company}",
+             f"\t\tCENTRAL INDEX KEY:\t\t\t{CIK:010d}",
+             "ISSUER:\t\t",
+             "\tCOMPANY DATA:\t",
+             f"\t\tCOMPANY CONFORMED NAME:\t\t\t{issuer}",
+             f"\t\tCENTRAL INDEX KEY:\t\t\t{issuerCik:010d}",
+             "</SEC-HEADER>",
+             "<DOCUMENT>", f"<TYPE>{form}", "<SEQUENCE>1", "<FILENAME>wf-form4.xml", "<TEXT>", "<XML>",
+             '<?xml version="1.0"?>',
+             "<ownershipDocument>",
+             "<schemaVersion>X0306</schemaVersion>",
+             f"<documentType>{form}</documentType>",
+             f"<periodOfReport>{dt.strftime('%Y-%m-%d')}</periodOfReport>",
+             f"<issuer><issuerCik>{issuerCik:010d}</issuerCik><issuerName>{issuer.replace('&', '&amp;')}</issuerName>"
+             "<issuerTradingSymbol>ACME</issuerTradingSymbol></issuer>",
+             f"<reportingOwner><reportingOwnerId><rptOwnerCik>{CIK:010d}</rptOwnerCik>"
+             f"<rptOwnerName>{company}</rptOwnerName></reportingOwnerId>",
+             "<reportingOwnerRelationship><isDirector>0</isDirector><isOfficer>1</isOfficer>"
+             "<isTenPercentOwner>0</isTenPercentOwner><isOther>0</isOther>"
+             "<officerTitle>Chief Executive Officer</officerTitle></reportingOwnerRelationship></reportingOwner>"]
+    txdate = f"<transactionDate><value>{dt.strftime('%Y-%m-%d')}</value></transactionDate>"
+    held = rnd.randint(10**4, 10**6)
+    lines += ["<nonDerivativeTable>"]
+    for i in range(ntrans):
+        code, ad = rnd.choice([("S", "D"), ("P", "A"), ("M", "A"), ("F", "D")])
+        shares = rnd.randint(1, 10**4)
+        held += shares if ad == "A" else -shares
+        lines += ["<nonDerivativeTransaction>",
+                  "<securityTitle><value>Common Stock</value></securityTitle>", txdate,
+                  "<transactionCoding><transactionFormType>4</transactionFormType>"
+                  f"<transactionCode>{code}</transactionCode><equitySwapInvolved>0</equitySwapInvolved>"
+                  "</transactionCoding>",
+                  f"<transactionAmounts><transactionShares><value>{shares}</value></transactionShares>"
+                  f"<transactionPricePerShare><value>{rnd.uniform(1, 500):.4f}</value>"
+                  "<footnoteId id=\"F1\"/></transactionPricePerShare>"
+                  f"<transactionAcquiredDisposedCode><value>{ad}</value></transactionAcquiredDisposedCode>"
+                  "</transactionAmounts>",
+                  "<postTransactionAmounts><sharesOwnedFollowingTransaction>"
+                  f"<value>{held}</value></sharesOwnedFollowingTransaction></postTransactionAmounts>",
+                  "<ownershipNature><directOrIndirectOwnership><value>D</value></directOrIndirectOwnership>"
+                  "</ownershipNature>",
+                  "</nonDerivativeTransaction>"]
+    lines += ["</nonDerivativeTable>", "<derivativeTable>"]
+    for i in range(nderiv):
+        shares = rnd.randint(1, 10**4)
+        lines += ["<derivativeTransaction>",
+                  "<securityTitle><value>Stock Option (Right to Buy)</value></securityTitle>",
+                  f"<conversionOrExercisePrice><value>{rnd.uniform(1, 200):.2f}</value></conversionOrExercisePrice>",
+                  txdate,
+                  "<transactionCoding><transactionFormType>4</transactionFormType>"
+                  "<transactionCode>M</transactionCode><equitySwapInvolved>0</equitySwapInvolved></transactionCoding>",
+                  f"<transactionAmounts><transactionShares><value>{shares}</value></transactionShares>"
+                  "<transactionPricePerShare><value>0</value></transactionPricePerShare>"
+                  "<transactionAcquiredDisposedCode><value>D</value></transactionAcquiredDisposedCode>"
+                  "</transactionAmounts>",
+                  "<exerciseDate><footnoteId id=\"F2\"/></exerciseDate>",
+                  "<expirationDate><value>2030-02-15</value></expirationDate>",
+                  "<underlyingSecurity><underlyingSecurityTitle><value>Common Stock</value></underlyingSecurityTitle>"
+                  f"<underlyingSecurityShares><value>{shares}</value></underlyingSecurityShares></underlyingSecurity>",
+                  "<postTransactionAmounts><sharesOwnedFollowingTransaction>"
+                  f"<value>{rnd.randint(0, 10**5)}</value></sharesOwnedFollowingTransaction></postTransactionAmounts>",
+                  "<ownershipNature><directOrIndirectOwnership><value>I</value></directOrIndirectOwnership>"
+                  "<natureOfOwnership><value>By Trust</value></natureOfOwnership></ownershipNature>",
+                  "</derivativeTransaction>"]
+    lines += ["</derivativeTable>",
+              "<footnotes><footnote id=\"F1\">Weighted average price.</footnote>"
+              "<footnote id=\"F2\">Fully vested.</footnote></footnotes>",
+              f"<ownerSignature><signatureName>/s/ {company}</signatureName>"
+              f"<signatureDate>{dt.strftime('%Y-%m-%d')}</signatureDate></ownerSignature>",
+              "</ownershipDocument>", "</XML>", "</TEXT>", "</DOCUMENT>", "</SEC-DOCUMENT>"]
+    return "\n".join(lines) + "\n"
+
+
+# kinds of broken filings in a synthetic corpus, see make_filing
+MALFORMED = ["noAcceptance", "badAcceptance", "truncated"]
+
+
+def make_filing(kind, nrows, seed=0, **kwargs):
+    # kind is a form type or one of MALFORMED, a malformed filing is a 13F-HR.
+    # For a Form 4 nrows are its transactions, a quarter of them derivative
+    if kind == "4":
+        return make_form4(nrows - nrows // 4, nrows // 4, seed=seed, **kwargs)
+    if kind == "noAcceptance":
+        return make_13f(nrows, seed=seed, accepted=False, **kwargs)
+    if kind == "badAcceptance":
+        return make_13f(nrows, seed=seed, accepted="2021-09-08 12:34", **kwargs)
+    if kind == "truncated":
+        text = make_13f(nrows, seed=seed, **kwargs)
+        return text[:len(text) * 2 // 3]
+    return make_13f(nrows, seed=seed, form=kind, **kwargs)
+
+
+def make_corpus(srcdir, dt, nfilings=200, rows=(20, 5000), ntShare=0.3, badShare=0.05, seed=0,
+                insiderShare=0.0):
+    # srcdir/Archives laid out like www.sec.gov/Archives: a daily form.idx and the
+    # filings it points to. Holdings reports have a log uniform number of rows
+    # between rows[0] and rows[1], so a few big ones dominate as on a real day.
+    # insiderShare of the filings are Form 4s with 1 to 12 transactions.
+    # Returns one row per filing with its form, kind, rows and bytes
+    rnd = random.Random(seed)
+    datestr = dt.strftime("%Y%m%d")
+    lines = [f"Daily Index of EDGAR Dissemination Feed by Form Type for {dt.strftime('%B %d, %Y')}", "",
+             f"{'Form Type':<12}{'Company Name':<62}{'CIK':<12}{'Date Filed':<12}File Name",
+             "-" * 140]
+    tups = []
+    for i in range(nfilings):
+        CIK = 1000000 + i
+        fid = f"{CIK:010d}-{dt.year % 100:02d}-{i:06d}"
+        company = f"BENCH CAPITAL {i} LLC"
+        draw = rnd.random()
+        if draw < insiderShare:
+            kind = "4"
+        elif draw < insiderShare + ntShare:
+            kind = "13F-NT"
+        elif draw < insiderShare + ntShare + badShare:
+            kind = rnd.choice(MALFORMED)
+        else:
+            kind = "13F-HR"
+        form = kind if kind in ["13F-NT", "4"] else "13F-HR"
+        if kind == "4":
+            nrows = rnd.randint(1, 12)
+        else:
+            nrows = 0 if kind == "13F-NT" else int(math.exp(rnd.uniform(math.log(rows[0]), math.log(rows[1]))))
+        text = make_filing(kind, nrows, seed=seed + i, CIK=CIK, fid=fid, company=company, dt=dt)
+        url = f"edgar/data/{CIK}/{fid}.txt"
+        fpath = os.path.join(srcdir, "Archives", url)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "w") as fp:
+            fp.write(text)
+        lines.append(f"{form:<12}{company:<62}{CIK:<12}{datestr:<12}{url}")
+        tups.append((url, form, kind, nrows, len(text)))
+    ipath = os.path.join(srcdir, "Archives", "edgar", "daily-index", str(dt.year),
+                         f"QTR{Utilities.get_quarter(dt)}", f"form.{datestr}.idx")
+    os.makedirs(os.path.dirname(ipath), exist_ok=True)
+    with open(ipath, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+    return pd.DataFrame(tups, columns=["url", "form", "kind", "rows", "bytes"])
+
+
+def stage_corpus(srcdir, basedir, dt, outLogName, errLogName, compress=None):
+    # the synthetic day as downloadForms leaves it: the secFilings csv in
+    # basedir/year/month and the filings in basedir/year/month/day/form.
+    # Returns the form index frame and the day's form directories
+    ipath = os.path.join(srcdir, "Archives", "edgar", "daily-index", str(dt.year),
+                         f"QTR{Utilities.get_quarter(dt)}", f"form.{dt.strftime('%Y%m%d')}.idx")
+    with open(ipath, "r") as fp:
+        formsdf = downloadForms.parse_form_index(fp.read(), outLogName, errLogName)
+    downloadForms.save_daily_index(formsdf, basedir, dt)
+    for idx, ser in formsdf.iterrows():
+        with open(os.path.join(srcdir, "Archives", ser["url"]), "r") as fp:
+            text = fp.read()
+        downloadForms.save_form(ser, text, basedir, dt.year, dt.month, dt.day, outLogName=outLogName,
+                                errLogName=errLogName, compress=compress)
+    ddir = os.path.join(basedir, str(dt.year), str(dt.month), str(dt.day))
+    sdirs = sorted(os.path.join(ddir, d) for d in os.listdir(ddir))
+    return formsdf, sdirs
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(object):
+    # serves a directory over http on localhost from a background thread, so the
+    # download path can be timed without the network or the SEC rate limit
+    def __init__(self, rootdir, port=0):
+        handler = functools.partial(QuietHandler, directory=rootdir)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+@contextlib.contextmanager
+def sec_archives(url):
+    # points downloadForms at another Archives root, the stub server
+    saved = downloadForms.SEC_ARCHIVES
+    downloadForms.SEC_ARCHIVES = url
+    try:
+        yield url
+    finally:
+        downloadForms.SEC_ARCHIVES = saved
+
+
+class PeakRss(object):
+    # highest resident memory of this process plus its children (pool workers)
+    # seen while the block runs, sampled every interval seconds
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        proc = psutil.Process()
+        rss = proc.memory_info().rss
+        for child in proc.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+
+def time_func(func, *args, repeat=3, **kwargs):
+    best = None
+    for i in range(repeat):
+        start = time()
+        res = func(*args, **kwargs)
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def bench_fixup(cases=((1000, 2), (20000, 2), (100000, 2), (20000, 500), (100000, 2000)),
+                outLogName="benchOut", errLogName="benchErr"):
+    tups = []
+    for nrows, ndocs in cases:
+        html = make_13f(nrows, ndocs=ndocs)
+        mb = len(html) / 2**20
+        oldt, old = time_func(fixup_reference, html, repeat=1)
+        newt, new = time_func(parseForms.fixup, html, outLogName, errLogName)
+        tups.append((nrows, ndocs, round(mb, 2), oldt, newt, oldt / newt, old == new))
+    df = pd.DataFrame(tups, columns=["rows", "docs", "MB", "reference", "fixup", "speedup", "identical"])
+    return df
+
+
+def measure(stage, func, *args, files=0, nbytes=0, rows=None, **kwargs):
+    # one timed run of func with throughput figures, rows is a count or a function of the result
+    with PeakRss() as rss:
+        start = time()
+        res = func(*args, **kwargs)
+        elapsed = time() - start
+    nrows = rows(res) if callable(rows) else rows
+    return {"stage": stage, "files": files, "rows": nrows, "MB": nbytes / 2**20, "seconds": elapsed,
+            "files/s": files / elapsed, "rows/s": None if nrows is None else nrows / elapsed,
+            "MB/s": nbytes / 2**20 / elapsed, "peakRssMB": rss.peak / 2**20}
+
+
+def dir_bytes(sdirs):
+    return sum(os.path.getsize(os.path.join(sdir, f)) for sdir in sdirs for f in os.listdir(sdir)
+               if Utilities.filing_stem(f) is not None)
+
+
+def bench_pipeline(workdir, nfilings=200, rows=(20, 5000), ntShare=0.3, badShare=0.05, seed=0, ncpu=None,
+                   compress=None, dt=datetime.datetime(2021, 9, 8), metrics=None, outLogName="benchOut",
+                   errLogName="benchErr"):
+    # builds a synthetic day in workdir and times fixup, parse_form, parse_forms,
+    # parallel_parse and download_forms on it. Runs from inside workdir, the parse
+    # code finds the daily index from the relative form directory. metrics, a
+    # pipelineMetrics.RunMetrics, gets the per filing stage times of the
+    # parallel_parse and download_forms runs
+    srcdir = os.path.abspath(os.path.join(workdir, "sec"))
+    corpus = make_corpus(srcdir, dt, nfilings=nfilings, rows=rows, ntShare=ntShare, badShare=badShare, seed=seed)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        basedir = "data"
+        shutil.rmtree(basedir, ignore_errors=True)
+        formsdf, sdirs = stage_corpus(srcdir, basedir, dt, outLogName, errLogName, compress=compress)
+        texts = []
+        for url in corpus["url"]:
+            with open(os.path.join(srcdir, "Archives", url), "r") as fp:
+                texts.append(fp.read())
+        nbytes = sum(len(text) for text in texts)
+        results = []
+
+        res = measure("fixup", lambda: [parseForms.fixup(text, outLogName, errLogName) for text in texts],
+                      files=len(texts), nbytes=nbytes, rows=int(corpus["rows"].sum()))
+        results.append(res)
+        fixed = [parseForms.fixup(text, outLogName, errLogName) for text in texts]
+        def parse_each():
+            dfs = [parseForms.parse_form(html, fname, outLogName, errLogName) for html, fname in zip(fixed, corpus["url"])]
+            return sum(df.shape[0] for df in dfs if isinstance(df, pd.DataFrame))
+        results.append(measure("parse_form", parse_each, files=len(texts), nbytes=nbytes, rows=lambda n: n))
+
+        # the raw filings as parse_forms reads them, compressed or not
+        diskbytes = dir_bytes(sdirs)
+        storedir = os.path.abspath("store")
+        def parse_dirs():
+            shutil.rmtree(storedir, ignore_errors=True)
+            stats = Utilities.new_stats(parsed=0, rows=0)
+            for sdir in sdirs:
+                txtfiles = [f for f in os.listdir(sdir) if Utilities.filing_stem(f) is not None]
+                Utilities.add_stats(stats, parseForms.parse_forms(sdir, outLogName, errLogName, txtfiles=txtfiles,
+                                                                  storedir=storedir))
+            return stats
+        results.append(measure("parse_forms", parse_dirs, files=len(texts), nbytes=diskbytes,
+                               rows=lambda stats: stats["rows"]))
+        # parallel_parse is parse_all over one directory, the day has one per form type
+        def parse_pool():
+            shutil.rmtree(storedir, ignore_errors=True)
+            return parseForms.parse_all(sdirs, outLogName, errLogName, ncpu=ncpu, storedir=storedir,
+                                        metrics=metrics)
+        results.append(measure("parallel_parse", parse_pool, files=len(texts), nbytes=diskbytes,
+                               rows=lambda stats: stats["rows"]))
+
+        dlbasedir = os.path.abspath("download")
+        shutil.rmtree(dlbasedir, ignore_errors=True)
+        limiter = downloadForms.RateLimiter(rate=10**6, burst=10**6)
+        with StubServer(srcdir) as server, sec_archives(server.url + "Archives/"):
+            res = measure("download_forms", downloadForms.download_forms, formsdf, dlbasedir, dt.year, dt.month,
+                          dt.day, outLogName, errLogName, compress=compress, limiter=limiter, metrics=metrics,
+                          files=formsdf.shape[0], nbytes=nbytes)
+        results.append(res)
+    finally:
+        os.chdir(cwd)
+    return pd.DataFrame(results)
+
+
+def bench_insiders(workdir, nfilings=5000, seed=0, ncpu=None, dt=datetime.datetime(2021, 9, 8), metrics=None,
+                   outLogName="benchOut", errLogName="benchErr"):
+    # a day of Form 4s, a busy one has a few thousand, through parse_all into the insiders dataset
+    srcdir = os.path.abspath(os.path.join(workdir, "sec"))
+    corpus = make_corpus(srcdir, dt, nfilings=nfilings, ntShare=0.0, badShare=0.0, seed=seed, insiderShare=1.0)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        basedir = "data"
+        shutil.rmtree(basedir, ignore_errors=True)
+        formsdf, sdirs = stage_corpus(srcdir, basedir, dt, outLogName, errLogName)
+        storedir = os.path.abspath(os.path.join("store", "holdings"))
+        def parse_pool():
+            shutil.rmtree(os.path.dirname(storedir), ignore_errors=True)
+            return parseForms.parse_all(sdirs, outLogName, errLogName, ncpu=ncpu, storedir=storedir,
+                                        metrics=metrics)
+        res = measure("parse_all form 4", parse_pool, files=corpus.shape[0], nbytes=dir_bytes(sdirs),
+                      rows=lambda stats: stats["rows"])
+    finally:
+        os.chdir(cwd)
+    return pd.DataFrame([res])
+
+
+def check_history(df, histpath, label, tolerance=0.2):
+    # compares a run with the earlier runs of the same label kept in histpath
+    # and appends it. A stage is flagged when its MB/s is more than tolerance
+    # below the median of the earlier runs
+    df = df.assign(label=label, run=Utilities.now().strftime("%Y-%m-%d %H:%M:%S"))
+    if os.path.isfile(histpath):
+        hist = pd.read_csv(histpath)
+        base = hist.loc[hist["label"] == label].groupby("stage")["MB/s"].median().rename("baseMB/s")
+        df = df.merge(base, left_on="stage", right_index=True, how="left")
+        df["regression"] = df["MB/s"] < (1 - tolerance) * df["baseMB/s"]
+    cols = ["run", "label", "stage", "files", "rows", "MB", "seconds", "files/s", "rows/s", "MB/s", "peakRssMB"]
+    df[cols].to_csv(histpath, mode="a", header=not os.path.isfile(histpath), index=False)
+    return df
+
+
+if __name__ == "__main__":
+    # benchmarks.py                 fixup against the reference, then the synthetic day
+    # benchmarks.py <filing> ...    fixup against the reference on real filings
+    outLogName = "benchOut"
+    errLogName = "benchErr"
+    logging.basicConfig(level=logging.WARNING)
+    # the malformed filings log every failure, only the timings are wanted here
+    for lname in [outLogName, errLogName, "forms"]:
+        logging.getLogger(lname).setLevel(logging.CRITICAL)
+    files = sys.argv[1:]
+    if len(files) > 0:
+        # check fixup against the reference on real filings
+        for fpath in files:
+            with open(fpath, "r") as fp:
+                html = fp.read()
+            oldt, old = time_func(fixup_reference, html, repeat=1)
+            newt, new = time_func(parseForms.fixup, html, outLogName, errLogName)
+            print(f"{fpath}  {len(html)/2**20:.2f}MB  {oldt:.3f}s -> {newt:.3f}s  identical: {old == new}")
+    else:
+        print(bench_fixup(outLogName=outLogName, errLogName=errLogName).to_string(index=False))
+        nfilings = 200
+        workdir = os.path.join("benchdata", f"day{nfilings}")
+        os.makedirs(workdir, exist_ok=True)
+        metrics = pipelineMetrics.RunMetrics()
+        df = bench_pipeline(workdir, nfilings=nfilings, metrics=metrics, outLogName=outLogName,
+                            errLogName=errLogName)
+        df = check_history(df, os.path.join("benchdata", "history.csv"), label=f"day{nfilings}")
+        pd.set_option("display.width", 200)
+        print(df.drop(columns=["label", "run"]).round(2).to_string(index=False))
+        print(metrics.summary().round(4).to_string(index=False))
+        workdir = os.path.join("benchdata", "form4")
+        os.makedirs(workdir, exist_ok=True)
+        df = bench_insiders(workdir, outLogName=outLogName, errLogName=errLogName)
+        df = check_history(df, os.path.join("benchdata", "history.csv"), label="form4")
+        print(df.drop(columns=["label", "run"]).round(2).to_string(index=False))
+    print("done {0}".format(Utilities.now()))
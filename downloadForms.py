@@ -7,10 +7,219 @@ import copy
 import psutil
 import pandas as pd
 import logging
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import threading
-from time import time
+from time import time, sleep, monotonic
 from http.client import HTTPSConnection
+import asyncio
+from utilities import Utilities
+import pipelineMetrics
+
+SEC_ARCHIVES = "https://www.sec.gov/Archives/"
+SEC_HEADERS = {"User-Agent": "Enter The Data john@enterthedata.com",
+               "Accept-Encoding": "gzip, deflate",
+               "Host": "www.sec.gov"}
+# responses that mean we are going too fast
+THROTTLE_STATUS = (429, 503)
+
+class RateLimiter(object):
+    # token bucket shared by every fetch, rate requests per second with
+    # bursts of up to burst requests. A 429/503 halves the rate and pauses
+    # everyone for the Retry-After time (or a doubling backoff), each good
+    # response then wins back 1% of the target rate.
+    def __init__(self, rate=10.0, burst=10, minRate=0.5, backoff=1.0, maxBackoff=60.0):
+        self.lock = threading.Lock()
+        self.configure(rate=rate, burst=burst, minRate=minRate, backoff=backoff, maxBackoff=maxBackoff)
+
+    def configure(self, rate=10.0, burst=10, minRate=0.5, backoff=1.0, maxBackoff=60.0):
+        with self.lock:
+            self.targetRate = float(rate)
+            self.rate = float(rate)
+            self.burst = float(burst)
+            self.minRate = min(float(minRate), self.targetRate)
+            self.initBackoff = float(backoff)
+            self.backoff = float(backoff)
+            self.maxBackoff = float(maxBackoff)
+            self.tokens = float(burst)
+            self.last = monotonic()
+            self.pausedUntil = 0.0
+
+    def reserve(self):
+        # takes a token and returns how many seconds to wait before using it
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.pausedUntil - now)
+
+    def paused(self):
+        # a throttle seen while we were waiting holds back requests already given a token
+        with self.lock:
+            return max(0.0, self.pausedUntil - monotonic())
+
+    def wait(self):
+        wait = self.reserve()
+        while wait > 0:
+            sleep(wait)
+            wait = self.paused()
+
+    def feedback(self, status, retryAfter=None):
+        with self.lock:
+            now = monotonic()
+            if status in THROTTLE_STATUS:
+                self.rate = max(self.minRate, self.rate / 2)
+                self.tokens = min(self.tokens, 0.0)
+                try:
+                    pause = float(retryAfter)
+                except (TypeError, ValueError):
+                    pause = self.backoff
+                    self.backoff = min(self.maxBackoff, self.backoff * 2)
+                self.pausedUntil = max(self.pausedUntil, now + pause)
+            else:
+                self.rate = min(self.targetRate, self.rate + self.targetRate / 100)
+                self.backoff = self.initBackoff
+
+# every request to the SEC goes through this one, see RateLimiter.configure
+SEC_LIMITER = RateLimiter(rate=8, burst=4)
+
+class DownloadManifest(object):
+    # sqlite table of every filing we tried to fetch, keyed by accession
+    # number (fid), so reruns only fetch what is missing or failed. Records
+    # added with commit=False are committed commitEvery at a time
+    def __init__(self, dbpath, commitEvery=200):
+        import sqlite3
+        self.dbpath = dbpath
+        self.commitEvery = commitEvery
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS downloads (
+                                   fid TEXT PRIMARY KEY, CIK INTEGER, form TEXT, url TEXT, path TEXT,
+                                   status TEXT, nbytes INTEGER, sha256 TEXT, fetched TEXT,
+                                   tries INTEGER DEFAULT 0)""")
+            self.conn.commit()
+
+    def done(self, fids):
+        # fids already fetched whose file is still on disk
+        fids = list(fids)
+        res = set()
+        with self.lock:
+            for start in range(0, len(fids), 500):
+                chunk = fids[start:start+500]
+                qs = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f"SELECT fid, path FROM downloads WHERE status = 'done' AND fid IN ({qs})",
+                                         chunk).fetchall()
+                res.update(fid for fid, path in rows if path and os.path.isfile(path))
+        return res
+
+    def record(self, ser, status, fpath=None, data=None, nbytes=None, sha256=None, commit=True):
+        # sha256 is of the filing text, nbytes what it takes on disk
+        import hashlib
+        if nbytes is None and data is not None:
+            nbytes = len(data)
+        if sha256 is None and data is not None:
+            sha256 = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            self.conn.execute("""INSERT INTO downloads (fid, CIK, form, url, path, status, nbytes, sha256, fetched, tries)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                                 ON CONFLICT(fid) DO UPDATE SET path=excluded.path, status=excluded.status,
+                                   nbytes=excluded.nbytes, sha256=excluded.sha256, fetched=excluded.fetched,
+                                   tries=downloads.tries + 1""",
+                              (form_fid(ser), int(ser["CIK"]), ser["form"], ser["url"], fpath, status,
+                               nbytes, sha256, now().isoformat(timespec="seconds")))
+            self.uncommitted += 1
+            if commit or self.uncommitted >= self.commitEvery:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def status_counts(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, count(*) FROM downloads GROUP BY status").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class HttpCache(object):
+    # on disk cache of GET responses keyed on the url. Keeps the body with its
+    # ETag/Last-Modified so a refetch is a conditional request, and serves
+    # immutable urls (past daily and quarterly indexes) without a request at all
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.hits = 0
+        self.revalidated = 0
+        self.stored = 0
+
+    def paths(self, url):
+        import hashlib
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.cachedir, key + ".body"), os.path.join(self.cachedir, key + ".json")
+
+    def get(self, url):
+        # (meta, body) or None when the url is not cached
+        import json
+        bpath, mpath = self.paths(url)
+        try:
+            with open(mpath, "r") as fp:
+                meta = json.load(fp)
+            with open(bpath, "rb") as fp:
+                body = fp.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or meta.get("nbytes") != len(body):
+            return None
+        return meta, body
+
+    def validators(self, meta):
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("lastModified"):
+            headers["If-Modified-Since"] = meta["lastModified"]
+        return headers
+
+    def put(self, url, resp):
+        # body then meta, each through a temp file and a rename so a
+        # concurrent reader never sees half a file
+        import json
+        bpath, mpath = self.paths(url)
+        meta = {"url": url, "etag": resp.headers.get("ETag"), "lastModified": resp.headers.get("Last-Modified"),
+                "contentType": resp.headers.get("Content-Type"), "encoding": resp.encoding,
+                "nbytes": len(resp.content), "fetched": now().isoformat(timespec="seconds")}
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(bpath + suffix, "wb") as fp:
+            fp.write(resp.content)
+        os.replace(bpath + suffix, bpath)
+        with open(mpath + suffix, "w") as fp:
+            json.dump(meta, fp)
+        os.replace(mpath + suffix, mpath)
+        self.stored += 1
+
+    def response(self, url, meta, body):
+        # a cached body dressed as a 200 requests.Response
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = url
+        resp._content = body
+        resp.encoding = meta.get("encoding")
+        resp.headers = requests.structures.CaseInsensitiveDict(
+            {k: v for k, v in [("ETag", meta.get("etag")), ("Last-Modified", meta.get("lastModified")),
+                               ("Content-Type", meta.get("contentType"))] if v})
+        resp.from_cache = True
+        return resp
 
 def processor_intensive(arg):
     def fib(n): # recursive, processor intensive calculation (avoid n > 36)
@@ -90,13 +299,33 @@ def log_msg(msg, loggers=[], level=logging.WARNING):
         raise(RuntimeError("Error writing to loggers"+msg))
     return
 
-def get_url_resp(url, outLogName, errLogName):
+def get_url_resp(url, outLogName, errLogName, limiter=None, maxTries=3, cache=None, immutable=False):
+    # with a cache, an immutable url already cached is not requested at all and
+    # anything else cached is revalidated, a 304 gives back the cached body
+    if limiter is None:
+        limiter = SEC_LIMITER
     try:
-        headers = {"User-Agent": "Enter The Data john@enterthedata.com",
-                   "Accept-Encoding": "gzip, deflate",
-                   "Host": "www.sec.gov"}
-        res = requests.get(url, headers = headers, timeout=2)
-        return res
+        cached = cache.get(url) if cache is not None else None
+        headers = SEC_HEADERS
+        if cached is not None:
+            if immutable:
+                cache.hits += 1
+                return cache.response(url, *cached)
+            headers = dict(SEC_HEADERS, **cache.validators(cached[0]))
+        for cnt in range(maxTries):
+            limiter.wait()
+            res = requests.get(url, headers = headers, timeout=2)
+            limiter.feedback(res.status_code, res.headers.get("Retry-After"))
+            if res.status_code == 304 and cached is not None:
+                cache.revalidated += 1
+                return cache.response(url, *cached)
+            if res.status_code == 200 and cache is not None:
+                cache.put(url, res)
+            if res.status_code not in THROTTLE_STATUS:
+                return res
+            msg = f"{get_fname()} throttled {res.status_code} {url} try {cnt+1} of {maxTries}"
+            log_msg(msg, loggers=[outLogName, errLogName], level=logging.WARNING)
+        return None
     except requests.exceptions.ConnectionError:
         msg = "ConnectionError "
         msg += get_fname()
@@ -120,30 +349,79 @@ def get_url_resp(url, outLogName, errLogName):
         return msg
 
 
+# column layout of the daily form.YYYYMMDD.idx and quarterly form.idx files
+FORM_INDEX_COLS = ["form", "company", "CIK", "date", "url"]
+FORM_INDEX_SEGMENTS = [(0, 12), (12, 74), (74, 86), (86, 98), (98, None)]
+ACCESSION_LEN = 20
+
+def empty_form_index():
+    empty = pd.Series([], dtype="string[pyarrow]")
+    df = pd.DataFrame({"form": pd.Categorical([]), "company": empty, "CIK": pd.Series([], dtype="int64"),
+                       "date": pd.Series([], dtype="datetime64[ns]"), "url": empty, "fid": empty})
+    return df
+
+def parse_form_index(text, outLogName, errLogName, verbosity=0):
+    # fixed width form index -> typed frame, each column is sliced out of all the
+    # lines after the ---- rule at once with the pandas string methods. The lines
+    # are arrow backed strings, pyarrow is there for the parquet store anyway
+    text = text.decode(errors="replace") if isinstance(text, bytes) else text
+    rule = text.find("\n----")
+    start = text.find("\n", rule + 1) + 1 if rule >= 0 else 0
+    if start == 0:
+        if verbosity > 0:
+            logger = logging.getLogger(outLogName)
+            logger.info(f"{get_fname()}  no ---- line, not a form index")
+        return empty_form_index()
+    lines = pd.Series(text[start:].splitlines(), dtype="string[pyarrow]")
+    lines = lines.loc[lines.str.strip().str.len() > 0].reset_index(drop=True)
+    if lines.shape[0] == 0:
+        return empty_form_index()
+    flds = pd.DataFrame({col: lines.str.slice(begin, end).str.strip()
+                         for col, (begin, end) in zip(FORM_INDEX_COLS, FORM_INDEX_SEGMENTS)})
+
+    # a line is on the fixed columns when its CIK field is digits then padding. A
+    # company name wider than its column, or padded in bytes rather than characters,
+    # shifts the rest of the line, those few lines are split on runs of spaces instead
+    cikseg = FORM_INDEX_SEGMENTS[2]
+    good = lines.str.slice(*cikseg).str.fullmatch(r"\d+ *").fillna(False).astype(bool)
+    bad = lines.loc[~good]
+    if bad.shape[0] > 0:
+        if verbosity > 0:
+            logger = logging.getLogger(outLogName)
+            logger.info(f"{get_fname()}  {bad.shape[0]} lines off the fixed columns")
+        parts = bad.str.strip().str.split(r"\s\s+", regex=True)
+        parts = pd.Series(parts.tolist(), index=parts.index, dtype=object)
+        ok = (parts.str.len() == len(FORM_INDEX_COLS)) & parts.str[2].str.isdigit().fillna(False).astype(bool)
+        for i, col in enumerate(FORM_INDEX_COLS):
+            flds.loc[ok.index[ok], col] = parts.loc[ok].str[i]
+        good.loc[ok.index[ok]] = True
+        if not good.all():
+            msg = f"{get_fname()}  dropped {(~good).sum()} unparseable index lines"
+            log_msg(msg=msg, level=logging.WARNING, loggers=[outLogName, errLogName])
+            flds = flds.loc[good].reset_index(drop=True)
+
+    fmt = "%Y-%m-%d" if flds["date"].str.contains("-").any() else "%Y%m%d"
+    df = pd.DataFrame({
+        "form": flds["form"].astype("category"),
+        "company": flds["company"],
+        "CIK": flds["CIK"].astype("int64"),
+        "date": pd.to_datetime(flds["date"], format=fmt, errors="coerce").astype("datetime64[ns]"),
+        "url": flds["url"],
+        # the accession number is the file name of the url without .txt
+        "fid": flds["url"].str.slice(-ACCESSION_LEN - len(".txt"), -len(".txt")),
+    })
+    return df
+
 def filter_forms_df(lines,  outLogName, errLogName, form_filter=None, verbosity=0):
     if verbosity > 1:
         logger = logging.getLogger(outLogName)
         logger.info("{0}".format(get_fname()))
-    for li, line in enumerate(lines):
-        if verbosity > 1:
-            logger = logging.getLogger("main")
-            logger.info("skippling line {0}: {1}".format(li, line))
-        if line.startswith("Form"):
-            break
-    data = []
-    for i, line in enumerate(lines[li+1:]):
-        if verbosity > 1:
-            pass
-            #print(f"line {i}:  {line}")
-        if line.startswith(form_filter):
-            flds = re.split("\s\s+", line)
-            flds = [f.strip() for f in flds if len(f) > 0]
-            data.append(flds)
-    df = pd.DataFrame(data, columns=["form", "company", "CIK", "date", "url"])
-    return df
-
-def get_daily_forms(dt, basedir, outLogName, errLogName, maxTries=4,
+    df = parse_form_index("\n".join(lines), outLogName, errLogName, verbosity=verbosity)
+    if form_filter is not None:
+        df = df.loc[df["form"].astype(str).str.startswith(form_filter)].reset_index(drop=True)
+    return df[FORM_INDEX_COLS]
 
+def get_daily_forms(dt, basedir, outLogName, errLogName, maxTries=4, cache=None,
                     verbosity=0):
     import xml.etree.ElementTree as ET
     if verbosity > 0:
@@ -154,14 +432,16 @@ def get_daily_forms(dt, basedir, outLogName, errLogName, maxTries=4,
         month = dt.month
         qtr = get_quarter(dt)
         datestr = dt.strftime("%Y%m%d")
-        url = f"https://www.sec.gov/Archives/edgar/daily-index/{year}/QTR{qtr}/form.{datestr}.idx"
+        url = f"{SEC_ARCHIVES}edgar/daily-index/{year}/QTR{qtr}/form.{datestr}.idx"
         resp = None
         cnt = 0
         while resp == None:
             if cnt >= maxTries:
                 break
             cnt += 1
-            resp = get_url_resp(url, outLogName=outLogName, errLogName=errLogName)
+            # a past day's index never changes, today's is revalidated
+            resp = get_url_resp(url, outLogName=outLogName, errLogName=errLogName, cache=cache,
+                                immutable=dt.date() < datetime.date.today())
         if resp == None:
             msg = get_fname() + f" tried {maxTries} times, no response"
             log_msg(msg, loggers=[outLogName, errLogName], level=logging.WARNING)
@@ -169,8 +449,6 @@ def get_daily_forms(dt, basedir, outLogName, errLogName, maxTries=4,
         lines = resp.text.split("\n")
         if len(lines) <= 2:
             return
-        with open(os.path.join(basedir, f"resp_text.text"), "w") as fp:
-            fp.write(resp.text)
     except:
         msg = get_fname() + " "
         msg += err_info()
@@ -182,35 +460,12 @@ def get_daily_forms(dt, basedir, outLogName, errLogName, maxTries=4,
         log_msg(msg, loggers=["main", "forms"])
         return pd.DataFrame()
     try:
-        for li, line in enumerate(lines):
-            if verbosity > 2:
-                print("skippling line {0}: {1}".format(li, line))
-            if line.startswith("----"):
-                break
-        data = []
-        segments = [(0,12), (12,74), (74,86), (86,98), (98,142)]
-        for i, line in enumerate(lines[li+1:]):
-            if verbosity > 2:
-                print(f"line {i}:  {line}")
-            flds = []
-            for start, end in segments:
-                fld = line[start:end]
-                flds.append(fld.strip())
-            data.append(flds)
-        df = pd.DataFrame(data, columns=["form", "company", "CIK", "date", "url"])
+        df = parse_form_index(resp.text, outLogName, errLogName, verbosity=verbosity)
         if df.shape[0] == 0:
             msg = "Empty dataframe"
             log_msg(msg=msg, level=logging.WARNING, loggers=[outLogName, errLogName])
             return df
-        df["fid"] = df["url"].apply(lambda x: os.path.splitext(x)[0].split("/")[-1])
-        fname = f"secFilings_{datestr}.csv"
-
-        savedir = os.path.join(basedir, str(year), str(month))
-
-        if not os.path.isdir(savedir):
-            os.makedirs(savedir)
-        fpath = os.path.join(savedir, fname)
-        df.to_csv(fpath, index=None)
+        save_daily_index(df, basedir, dt)
         if df.shape[0] == 0:
             msg = f"empty df for year: {year} qtr: {qtr} dt: {datestr} {url}"
             log_msg(msg=msg, level=logging.WARNING, loggers=[outLogName, errLogName])
@@ -220,113 +475,339 @@ def get_daily_forms(dt, basedir, outLogName, errLogName, maxTries=4,
         msg += err_info()
         log_msg(msg=msg, level=logging.ERROR, loggers=[outLogName, errLogName])
 
-def parallel_download(formsdf, basedir, ddir, outLogName, errLogName, ncpu=None,
-                      atATime=300,
-                      verbosity=0):
+def save_daily_index(df, basedir, dt):
+    # basedir/year/month/secFilings_YYYYMMDD.csv, where parseForms looks for a day's filings
+    savedir = os.path.join(basedir, str(dt.year), str(dt.month))
+    if not os.path.isdir(savedir):
+        os.makedirs(savedir)
+    fpath = os.path.join(savedir, f"secFilings_{dt.strftime('%Y%m%d')}.csv")
+    df.to_csv(fpath, index=None)
+    return fpath
+
+def get_quarterly_forms(year, qtr, basedir, outLogName, errLogName, maxTries=4, compressed=True,
+                        cache=None, verbosity=0):
+    # backfill: one full-index form file for the whole quarter instead of a request
+    # per calendar day, split into the same secFilings csvs get_daily_forms writes.
+    # Returns {day: formsdf} for the days that had filings
+    import gzip
+    if verbosity > 0:
+        logger = logging.getLogger(outLogName)
+        logger.info(f"{get_fname()}  {year} QTR{qtr}")
+    names = ["form.gz", "form.idx"] if compressed else ["form.idx"]
+    # the index of a quarter that is over never changes
+    immutable = datetime.date.today() >= datetime.date(year + qtr // 4, qtr % 4 * 3 + 1, 1)
+    data = None
+    for name in names:
+        url = f"{SEC_ARCHIVES}edgar/full-index/{year}/QTR{qtr}/{name}"
+        for cnt in range(maxTries):
+            resp = get_url_resp(url, outLogName=outLogName, errLogName=errLogName, cache=cache,
+                                immutable=immutable)
+            if isinstance(resp, requests.Response):
+                break
+        if not isinstance(resp, requests.Response) or resp.status_code != 200:
+            msg = f"{get_fname()}  no {url}"
+            log_msg(msg, loggers=[outLogName, errLogName], level=logging.WARNING)
+            continue
+        try:
+            data = gzip.decompress(resp.content) if name.endswith(".gz") else resp.content
+            break
+        except:
+            msg = get_fname() + f" {url} "
+            msg += err_info()
+            log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
+    if data is None:
+        return {}
+    df = parse_form_index(data, outLogName, errLogName, verbosity=verbosity)
+    days = {}
+    for day, ddf in df.groupby("date", sort=True):
+        ddf = ddf.reset_index(drop=True)
+        ddf["form"] = ddf["form"].cat.remove_unused_categories()
+        save_daily_index(ddf, basedir, day)
+        days[day.to_pydatetime()] = ddf
+    if verbosity > 0:
+        logger = logging.getLogger(outLogName)
+        logger.info(f"{get_fname()}  {year} QTR{qtr}  {df.shape[0]} filings over {len(days)} days")
+    return days
+
+def parallel_download(formsdf, basedir, year, month, day, outLogName, errLogName, ncpu=None,
+                      atATime=300, incl_filter=None, excl_filter=None, manifest=None, compress=None,
+                      limiter=None, metrics=None, verbosity=0):
     if verbosity > 0:
         logger = logging.getLogger(outLogName)
-        logger.info(f"{get_fname()}  ddir: {ddir}  atATime {atATime}")
+        logger.info(f"{get_fname()}  {year}-{month}-{day}  atATime {atATime}")
     if ncpu is None:
         ncpu = psutil.cpu_count()
     nrows = atATime
-    start = 0
-    end = nrows
-    futures = []
-    ranges = []
     pool_executor = ThreadPoolExecutor
-    fi = 0
+    stats = Utilities.new_stats(saved=0, bytes=0, batches=0, failedBatches=0)
+    errors = []
+    starttime = time()
     with pool_executor(max_workers=ncpu) as executor:
-        while start < formsdf.shape[0]:
+        futures = {}
+        for start in range(0, formsdf.shape[0], nrows):
+            subdf = formsdf.iloc[start:start+nrows]
+            future =  executor.submit(download_forms, formsdf=subdf, basedir=basedir,
+                                      year=year, month=month, day=day,
+                                      incl_filter=incl_filter, excl_filter=excl_filter,
+                                      manifest=manifest, compress=compress, limiter=limiter, metrics=metrics,
+                                      outLogName=outLogName, errLogName=errLogName, verbosity=verbosity)
+            futures[future] = (start, start + subdf.shape[0])
+        for future in as_completed(futures):
+            start, end = futures[future]
+            stats["batches"] += 1
             try:
-                print(start)
-                subdf = formsdf.iloc[start:end]
-                future =  executor.submit(download_forms, formsdf=subdf, basedir=basedir, ddir=ddir,
-                                          outLogName=outLogName, errLogName=errLogName, verbosity=verbosity)
-                futures.append(future)
-                ranges.append((start, end))
-                print(len(futures), start, end)
-                start = end
-                end = min(end+nrows, formsdf.shape[0])
-            except:
-                msg = err_info()
-                log_msg(level=logging.ERROR, msg=msg)
-    ndone = 0
-    while ndone < len(futures):
-        ndone = 0
-        for i, f in enumerate(futures):
-            if not f.done():
-                msg = f"not done with batch {i}"
-            else:
-                ndone += 1
-    return
+                res = future.result()
+                Utilities.add_stats(stats, res)
+                if verbosity > 1:
+                    logger = logging.getLogger(outLogName)
+                    logger.info(f"{get_fname()}  rows {start}-{end}  {res}")
+            except Exception as e:
+                stats["failedBatches"] += 1
+                errors.append(e)
+                msg = f"{get_fname()}  {year}-{month}-{day} rows {start}-{end} failed: {repr(e)}"
+                log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
+    stats["elapsed"] = time() - starttime
+    if verbosity > 0:
+        logger = logging.getLogger(outLogName)
+        logger.info(f"{get_fname()}  {year}-{month}-{day}  {stats}")
+    if len(errors) > 0:
+        msg = f"{len(errors)} of {stats['batches']} batches failed for {year}-{month}-{day}, {stats}"
+        raise RuntimeError(msg) from errors[0]
+    return stats
 
 def download_forms(formsdf, basedir,  year, month, day, outLogName, errLogName,  incl_filter=None,
-                    excl_filter=None, verbosity=0):
-    import time
+                    excl_filter=None, manifest=None, compress=None, limiter=None, metrics=None, verbosity=0):
+    # with a pipelineMetrics.RunMetrics every filing's fetch and write are timed
     if verbosity > 0:
         logger = logging.getLogger(outLogName)
         logger.info(f"<{get_fname()}>  {year}-{month}-{day} shape formsdf {formsdf.shape}  {now()}")
         logger.info(f"  pid: {os.getpid()}  thread id {threading.get_ident()}")
+    stats = Utilities.new_stats(saved=0, bytes=0)
+    starttime = time()
     if formsdf.shape[0] == 0:
-        log_msg(msg=f"no forms for {ddir}", level=logging.INFO)
-        return
-
-    for i, (idx, ser) in enumerate(formsdf.iterrows()):
-        if incl_filter and not re.search(incl_filter, ser["form"]) :
-            continue
-        if excl_filter and re.search(excl_filter, ser["form"]) :
-            continue
-        url = f"https://www.sec.gov/Archives/" + ser["url"]
+        log_msg(msg=f"no forms for {year}-{month}-{day}", loggers=[outLogName], level=logging.INFO)
+        return stats
+
+    sers = forms_to_fetch(formsdf, incl_filter=incl_filter, excl_filter=excl_filter, manifest=manifest)
+    stats["files"] = len(sers)
+    timers = []
+    for i, ser in enumerate(sers):
+        url = form_url(ser)
+        timer = None
+        if metrics is not None:
+            timer = metrics.timer(form_fid(ser), form=ser["form"])
+            timers.append(timer)
         try:
-            time.sleep(0.15)
-            resp = get_url_resp(url, outLogName=outLogName, errLogName=errLogName)
+            with pipelineMetrics.stage(timer, "fetch"):
+                resp = get_url_resp(url, outLogName=outLogName, errLogName=errLogName, limiter=limiter)
         except requests.exceptions.ConnectionError:
             msg = "ConnectionError: "
             msg += err_info()
             log_msg(level=logging.ERROR, msg=msg, loggers=[outLogName, errLogName])
-            return None
+            stats["failures"] += len(sers) - i
+            break
         except Exception as e:
             msg = "other error "
             msg += err_info()
             log_msg(level=logging.ERROR, msg=msg, loggers=[outLogName, errLogName])
-            return None
-        CIK = ser["CIK"]
-        uparts = os.path.splitext(url)[0].split("/")
-        fid = uparts[len(uparts)-1]
-        try:
-            cname = ser["company"].replace(" ","-")
-            cname = cname.replace("\\","-")
-            cname = cname.replace("/","-")
-            cname = cname.replace(",","-")
-            cname = cname.replace("_","-")
-
-            if verbosity > 0:
-                if i % 20 == 0:
-                    print(f"<{i}, {cname}>")
-
-
-            form = ser["form"]
-            formdir = re.sub("\\\\|/", "_", ser["form"])
-            savedir = os.path.join(basedir, str(year), str(month), str(day), formdir)
-            if not os.path.isdir(savedir):
-                os.makedirs(savedir)
+            stats["failures"] += len(sers) - i
+            break
+        if not isinstance(resp, requests.Response) or resp.status_code != 200:
+            status = resp.status_code if isinstance(resp, requests.Response) else "no response"
+            msg = f"{get_fname()} {status} for {url}"
+            log_msg(level=logging.WARNING, msg=msg, loggers=[outLogName, errLogName])
+            if manifest is not None:
+                manifest.record(ser, "failed")
+            stats["failures"] += 1
+            continue
+        with pipelineMetrics.stage(timer, "write"):
+            fpath = save_form(ser, resp.text, basedir, year, month, day,
+                              outLogName=outLogName, errLogName=errLogName, manifest=manifest, compress=compress)
+        if fpath is None:
+            stats["failures"] += 1
+            continue
+        stats["saved"] += 1
+        stats["bytes"] += os.path.getsize(fpath)
+        if timer is not None:
+            timer.add(bytes=len(resp.content))
+        if verbosity > 0:
+            if i % 20 == 0:
+                print(f"<{i}, {os.path.basename(fpath)}>")
+    if metrics is not None:
+        metrics.add(timers)
+    stats["elapsed"] = time() - starttime
+    return stats
+
+def form_url(ser):
+    return SEC_ARCHIVES + ser["url"]
+
+def form_wanted(ser, incl_filter=None, excl_filter=None):
+    if incl_filter and not re.search(incl_filter, ser["form"]) :
+        return False
+    if excl_filter and re.search(excl_filter, ser["form"]) :
+        return False
+    return True
+
+def form_fid(ser):
+    uparts = os.path.splitext(ser["url"])[0].split("/")
+    return uparts[len(uparts)-1]
+
+def forms_to_fetch(formsdf, incl_filter=None, excl_filter=None, manifest=None):
+    sers = [ser for idx, ser in formsdf.iterrows()
+            if form_wanted(ser, incl_filter=incl_filter, excl_filter=excl_filter)]
+    if manifest is not None and len(sers) > 0:
+        done = manifest.done(form_fid(ser) for ser in sers)
+        sers = [ser for ser in sers if form_fid(ser) not in done]
+    return sers
+
+def write_form(ser, text, basedir, year, month, day, compress=None):
+    # compress is None, "gzip" or "zstd", parseForms reads all three. Returns
+    # the path, the sha256 of the text and the bytes on disk for the manifest
+    import hashlib
+    fpath = form_save_path(ser, basedir, year, month, day, compress=compress)
+    data = text.encode()
+    with Utilities.open_filing(fpath, 'wb') as fp:
+        fp.write(data)
+    return fpath, hashlib.sha256(data).hexdigest(), os.path.getsize(fpath)
+
+def save_form(ser, text, basedir, year, month, day, outLogName, errLogName, manifest=None, compress=None):
+    try:
+        fpath, sha256, nbytes = write_form(ser, text, basedir, year, month, day, compress=compress)
+        if manifest is not None:
+            manifest.record(ser, "done", fpath=fpath, nbytes=nbytes, sha256=sha256)
+        return fpath
+    except:
+        msg = get_fname() + " "
+        msg += ser["company"]
+        msg += err_info()
+        log_msg(level=logging.ERROR, msg=msg, loggers=[outLogName, errLogName])
+        if manifest is not None:
+            manifest.record(ser, "failed")
+        return None
 
-            fname = f"{cname}_CIK{CIK}_FID{fid}.txt"
-            fpath = os.path.join(savedir, fname)
+def form_save_path(ser, basedir, year, month, day, compress=None):
+    # basedir/year/month/day/form/company_CIK_FID.txt(.gz|.zst), makes the directory
+    CIK = ser["CIK"]
+    fid = form_fid(ser)
+    cname = ser["company"].replace(" ","-")
+    cname = cname.replace("\\","-")
+    cname = cname.replace("/","-")
+    cname = cname.replace(",","-")
+    cname = cname.replace("_","-")
+
+    formdir = re.sub("\\\\|/", "_", ser["form"])
+    savedir = os.path.join(basedir, str(year), str(month), str(day), formdir)
+    if not os.path.isdir(savedir):
+        os.makedirs(savedir)
+
+    fname = f"{cname}_CIK{CIK}_FID{fid}" + Utilities.FILING_SUFFIXES[compress]
+    return os.path.join(savedir, fname)
+
+async def fetch_form_async(session, semaphore, limiter, ser, basedir, year, month, day,
+                           outLogName, errLogName, maxTries=4, manifest=None, compress=None, metrics=None,
+                           verbosity=0):
+    import aiohttp
+    url = form_url(ser)
+    text = None
+    timer = metrics.timer(form_fid(ser), form=ser["form"]) if metrics is not None else None
+    async with semaphore:
+        for cnt in range(maxTries):
+            wait = limiter.reserve()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = limiter.paused()
+            # only the request is timed, not the wait for a token
+            start = monotonic()
             try:
-                with open(fpath, 'wt') as fp:
-                    fp.write(resp.text)
-            except Exception as e1:
-                msg = get_fname() + " "
-                msg += fname
+                async with session.get(url, headers=SEC_HEADERS) as resp:
+                    limiter.feedback(resp.status, resp.headers.get("Retry-After"))
+                    if resp.status in THROTTLE_STATUS:
+                        msg = f"{get_fname()} throttled {resp.status} {url} try {cnt+1} of {maxTries}"
+                        log_msg(msg, loggers=[outLogName, errLogName], level=logging.WARNING)
+                        continue
+                    if resp.status != 200:
+                        msg = f"{get_fname()} {url} status {resp.status}"
+                        log_msg(msg, loggers=[outLogName, errLogName], level=logging.WARNING)
+                        break
+                    text = await resp.text(errors="replace")
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                msg = f"{get_fname()} {url} try {cnt+1} of {maxTries} "
                 msg += err_info()
-                log_msg(level=logging.ERROR, msg=msg, loggers=[outLogName, errLogName])
-        except:
-            msg = get_fname() + " "
-            msg += ser["company"]
-            msg += err_info()
-            log_msg(level=logging.ERROR, msg=msg, loggers=[outLogName, errLogName])
-    return
+                log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
+            finally:
+                if timer is not None:
+                    timer.add_time("fetch", monotonic() - start)
+    if text is None:
+        if manifest is not None:
+            manifest.record(ser, "failed", commit=False)
+        if timer is not None:
+            metrics.add([timer])
+        return None
+    # compression and the write run in a worker thread so the other requests
+    # keep going, the manifest stays on the loop thread with batched commits
+    fpath = None
+    try:
+        with pipelineMetrics.stage(timer, "write"):
+            fpath, sha256, nbytes = await asyncio.to_thread(write_form, ser, text, basedir, year, month, day,
+                                                            compress=compress)
+        if manifest is not None:
+            manifest.record(ser, "done", fpath=fpath, nbytes=nbytes, sha256=sha256, commit=False)
+    except Exception:
+        msg = f"{get_fname()} {ser['company']}"
+        msg += err_info()
+        log_msg(level=logging.ERROR, msg=msg, loggers=[outLogName, errLogName])
+        if manifest is not None:
+            manifest.record(ser, "failed", commit=False)
+        fpath = None
+    if timer is not None:
+        timer.add(bytes=len(text))
+        metrics.add([timer])
+    if verbosity > 1 and fpath is not None:
+        print(f"<{os.path.basename(fpath)}>")
+    return fpath
+
+async def download_forms_async(formsdf, basedir, year, month, day, outLogName, errLogName, incl_filter=None,
+                               excl_filter=None, maxInFlight=8, limiter=None, timeout=30, manifest=None,
+                               compress=None, metrics=None, verbosity=0):
+    # one keep-alive connection pool for the whole day, at most maxInFlight
+    # requests open at once
+    import aiohttp
+    if limiter is None:
+        limiter = SEC_LIMITER
+    if verbosity > 0:
+        logger = logging.getLogger(outLogName)
+        logger.info(f"<{get_fname()}>  {year}-{month}-{day} shape formsdf {formsdf.shape}  {now()}")
+    sers = forms_to_fetch(formsdf, incl_filter=incl_filter, excl_filter=excl_filter, manifest=manifest)
+    if len(sers) == 0:
+        return []
+    connector = aiohttp.TCPConnector(limit=maxInFlight, keepalive_timeout=30)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    semaphore = asyncio.Semaphore(maxInFlight)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+            tasks = [fetch_form_async(session, semaphore, limiter, ser, basedir, year, month, day,
+                                      outLogName=outLogName, errLogName=errLogName, manifest=manifest,
+                                      compress=compress, metrics=metrics, verbosity=verbosity)
+                     for ser in sers]
+            fpaths = await asyncio.gather(*tasks)
+    finally:
+        if manifest is not None:
+            manifest.commit()
+    fpaths = [f for f in fpaths if f is not None]
+    if verbosity > 0:
+        logger = logging.getLogger(outLogName)
+        logger.info(f"<{get_fname()}>  {year}-{month}-{day} saved {len(fpaths)} of {len(sers)}  {now()}")
+    return fpaths
+
+def async_download(formsdf, basedir, year, month, day, outLogName, errLogName, incl_filter=None,
+                   excl_filter=None, maxInFlight=8, limiter=None, manifest=None, compress=None, metrics=None,
+                   verbosity=0):
+    return asyncio.run(download_forms_async(formsdf, basedir, year, month, day,
+                                            outLogName=outLogName, errLogName=errLogName,
+                                            incl_filter=incl_filter, excl_filter=excl_filter,
+                                            maxInFlight=maxInFlight, limiter=limiter, manifest=manifest,
+                                            compress=compress, metrics=metrics, verbosity=verbosity))
 
 def get_filings(urls):
     for url in urls:
@@ -376,11 +857,30 @@ if __name__ == "__main__":
 
     numdays = 20
     basedir = "data"
+    if not os.path.isdir(basedir):
+        os.makedirs(basedir)
+    manifest = DownloadManifest(os.path.join(basedir, "downloads.sqlite"))
+    cache = HttpCache(os.path.join(basedir, "httpcache"))
+    # per filing fetch and write timings as json lines, the run's aggregates for a Prometheus textfile collector
+    metrics = pipelineMetrics.RunMetrics(
+        jsonPath=os.path.join(basedir, "metrics", f"download_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.jsonl"),
+        promPath=os.path.join(basedir, "metrics", "download.prom"))
     date_list = [base - datetime.timedelta(days=x) for x in range(numdays)]
-    for dt in date_list:
-        weekday = dt.weekday()
-        if weekday >= 5:
-            pass
+    # every form type parseForms has a parser for
+    import formParsers
+    incl_filter = formParsers.form_filter()
+    # set to [(year, qtr), ...] to backfill whole quarters from the full-index,
+    # one request a quarter instead of one a day
+    backfill = None
+    if backfill is not None:
+        days = {}
+        for year, qtr in backfill:
+            days.update(get_quarterly_forms(year, qtr, basedir=basedir, outLogName=outLogName,
+                                            errLogName=errLogName, cache=cache, verbosity=verbosity))
+    else:
+        # no filings on weekends, no daily index to fetch
+        days = {dt: None for dt in date_list if dt.weekday() < 5}
+    for dt, formsdf in days.items():
         ddir = dt.strftime("%Y%m%d")
         year = dt.year
         month = dt.month
@@ -389,16 +889,22 @@ if __name__ == "__main__":
             logger = logging.getLogger(lname)
             logger.info(f"--{ddir}--")
         try:
-            formsdf = get_daily_forms(dt, basedir=basedir,
-                                      outLogName= outLogName, errLogName=errLogName, verbosity=verbosity)
+            if formsdf is None:
+                formsdf = get_daily_forms(dt, basedir=basedir, outLogName= outLogName, errLogName=errLogName,
+                                          cache=cache, verbosity=verbosity)
             if not isinstance(formsdf, pd.DataFrame):
                 msg = f" dt {dt} formsdf not a dataframe"
                 log_msg(msg=msg, level=logging.WARNING, loggers = [outLogName, errLogName])
             if formsdf.shape[0] > 0:
-                download_forms(formsdf, basedir, year, month, day, incl_filter='13F', excl_filter=None,
-                               outLogName=outLogName, errLogName=errLogName, verbosity=verbosity)
+                async_download(formsdf, basedir, year, month, day, incl_filter=incl_filter, excl_filter=None,
+                               outLogName=outLogName, errLogName=errLogName, manifest=manifest,
+                               compress="gzip", metrics=metrics, verbosity=verbosity)
         except Exception as e:
             print(err_info())
             print("")
+    print(manifest.status_counts())
+    print(f"index cache hits: {cache.hits} revalidated: {cache.revalidated} stored: {cache.stored}")
+    metrics.close(outLogName)
+    manifest.close()
     print("done {0}".format(datetime.datetime.now()))
 
@@ -0,0 +1,322 @@
+import os
+import re
+import time
+import logging
+import xml.etree.ElementTree as ET
+import pandas as pd
+from utilities import Utilities
+import holdingsStore
+import pipelineMetrics
+
+# form type -> FormParser, amendments (form/A) parse like the form they amend
+PARSERS = {}
+
+
+class FormParser(object):
+    # how one family of forms is parsed and which dataset of the store its rows go
+    # to. parse(fpath, fname, outLogName, errLogName, header, timer, use_mmap, verbosity)
+    # returns the rows of one filing and fills header with the SEC header values
+    # parseForms.parse_forms puts on every row. dtypes is the dataset's store schema.
+    # Parsers of small forms return a list of row dicts instead of a DataFrame and
+    # give their own columns' types in columns, parse_forms frames the rows of a
+    # whole batch at once since a DataFrame per filing costs more than the parse.
+    # maxFiles overrides parseForms.plan_batches' files per work unit, for forms
+    # small enough that the per batch frame and parquet write would dominate
+    def __init__(self, dataset, forms, parse, dtypes, columns=None, maxFiles=None):
+        self.dataset = dataset
+        self.forms = forms
+        self.parse = parse
+        self.dtypes = dtypes
+        self.columns = columns
+        self.maxFiles = maxFiles
+
+    def __call__(self, fpath, fname, outLogName, errLogName, header, timer=None, use_mmap=False, verbosity=0):
+        try:
+            return self.parse(fpath, fname, outLogName, errLogName, header=header, timer=timer,
+                              use_mmap=use_mmap, verbosity=verbosity)
+        except Exception:
+            msg = f"{fname}, {Utilities.get_fname()}  {self.dataset} parser failed"
+            msg += Utilities.err_info()
+            Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
+            return None
+
+
+def register(parser):
+    for form in parser.forms:
+        PARSERS[form] = parser
+        PARSERS[form + "/A"] = parser
+    return parser
+
+
+def normal_form(form):
+    # a form type, or its directory name from downloadForms.form_save_path (13F-HR_A)
+    return re.sub("_A$", "/A", str(form).strip().upper())
+
+
+def parser_for(form):
+    return PARSERS.get(normal_form(form))
+
+
+def form_filter():
+    # downloadForms incl_filter for every form type that has a parser
+    forms = sorted(PARSERS.keys(), key=len, reverse=True)
+    return "^(" + "|".join(re.escape(form) for form in forms) + ")$"
+
+
+def dataset_dir(storedir, dataset):
+    # storedir is the holdings store, the other datasets sit next to it
+    if dataset == "holdings":
+        return storedir
+    return os.path.join(os.path.dirname(os.path.normpath(storedir)), dataset)
+
+
+# SGML header lines, KEY:<tabs>value with the nesting in the leading tabs
+SEC_HEADER_LINE = re.compile("^(\t*)([A-Za-z][A-Za-z0-9 \\-]*):[\t ]*(.*?)\\s*$")
+SEC_HEADER_END = "</SEC-HEADER>"
+# header keys that come on one line per value, kept as a list of all of them
+SEC_HEADER_LISTS = {"GROUP MEMBERS"}
+# the XML document of the cover page forms (13F-NT, N-PORT)
+EDGAR_SUBMISSION_START = re.compile("<([A-Za-z0-9_]+:)?edgarSubmission[\\s>]")
+EDGAR_SUBMISSION_END = re.compile("</([A-Za-z0-9_]+:)?edgarSubmission\\s*>")
+# an & that does not start an entity, which a strict XML parser rejects
+BARE_AMPERSAND = re.compile("&(?!#?\\w+;)")
+
+
+def sec_header_line(line, header, section):
+    # one header line into header, keyed by name and, under a top level section
+    # like SUBJECT COMPANY or FILED BY, by section/name. The first value of a key
+    # wins, but for SEC_HEADER_LISTS. Returns the section
+    if line.startswith("<ACCEPTANCE-DATETIME>"):
+        header.setdefault("ACCEPTANCE-DATETIME", line[len("<ACCEPTANCE-DATETIME>"):].strip())
+        return section
+    match = SEC_HEADER_LINE.match(line)
+    if not match:
+        return section
+    indent, key, value = match.groups()
+    if indent == "":
+        section = key if value == "" else None
+    if value == "":
+        return section
+    if key in SEC_HEADER_LISTS:
+        header.setdefault(key, []).append(value)
+        return section
+    header.setdefault(key, value)
+    if section is not None:
+        header.setdefault(f"{section}/{key}", value)
+    return section
+
+
+def envelope_lines(lines, header, start=None, end=None):
+    # reads the SGML header into header, then yields the lines of the document
+    # between the start and end patterns trimmed to its tags. Bare ampersands
+    # are escaped, entities like &amp; are left for the XML parser. Without
+    # start the read stops at the end of the header
+    section = None
+    inHeader = True
+    found = False
+    for line in lines:
+        if inHeader:
+            if SEC_HEADER_END in line:
+                inHeader = False
+                if start is None:
+                    return
+            else:
+                section = sec_header_line(line.rstrip("\n"), header, section)
+            continue
+        line = BARE_AMPERSAND.sub("&amp;", line)
+        if not found:
+            match = start.search(line)
+            if not match:
+                continue
+            found = True
+            line = line[match.start():]
+        match = end.search(line)
+        if match:
+            yield line[:match.end()]
+            return
+        yield line
+
+
+def iter_xml_records(chunks, record, header=None, keys=(), timer=None, wrappers=(), recordKey=None):
+    # one dict per record element (a tag or a tuple of tags) as soon as it closes,
+    # its descendants flattened to tag -> text, or the value attribute for the
+    # <isin value=""/> kind, first one wins. The text of a wrapper element, like
+    # the <value> in <transactionShares><value>, goes to its parent's tag. With
+    # recordKey the record's own tag is kept under that key. Elements in keys
+    # outside the records go into header
+    records = {record} if isinstance(record, str) else set(record)
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    tup = None
+    stack = []
+    for chunk in chunks:
+        start = time.perf_counter() if timer is not None else 0.0
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            tag = elem.tag.rpartition("}")[2]
+            if event == "start":
+                stack.append(tag)
+                if root is None:
+                    root = elem
+                elif tag in records:
+                    tup = {} if recordKey is None else {recordKey: tag}
+                continue
+            stack.pop()
+            if tag in records and tup is not None:
+                yield tup
+                tup = None
+                root.clear()
+                continue
+            text = elem.text.strip() if elem.text is not None else ""
+            if text == "":
+                text = elem.get("value")
+            if text is None:
+                continue
+            if tag in wrappers and len(stack) > 0:
+                tag = stack[-1]
+            if tup is not None:
+                tup.setdefault(tag, text)
+            elif header is not None and tag in keys:
+                header.setdefault(tag, text)
+        if timer is not None:
+            timer.add_time("xml", time.perf_counter() - start)
+    parser.close()
+
+
+# XML booleans, anything else is missing
+BOOLEANS = {"1": True, "true": True, "0": False, "false": False}
+
+
+def records_frame(tups, dtypes, keep=()):
+    # rows as parsed into the dataset's own columns and types, anything that
+    # does not convert is left missing. Columns in keep are carried over as they are
+    df = pd.DataFrame(tups)
+    res = {}
+    for col, dtype in dtypes.items():
+        vals = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if dtype == "category":
+            res[col] = vals.astype("string").astype("category")
+        elif dtype == "boolean":
+            res[col] = vals.astype("string").str.strip().str.lower().map(BOOLEANS).astype("boolean")
+        elif dtype.startswith("datetime"):
+            # XML dates, a time zone suffix (2021-08-25-05:00) is dropped
+            vals = vals.astype("string").str.slice(0, 10)
+            res[col] = pd.to_datetime(vals, format="%Y-%m-%d", errors="coerce").astype(dtype)
+        else:
+            res[col] = pd.to_numeric(vals, errors="coerce").astype(dtype)
+    for col in keep:
+        if col in df.columns:
+            res[col] = df[col]
+    return pd.DataFrame(res, index=df.index)
+
+
+def read_records(fpath, header, start, end, record, keys=(), timer=None, wrappers=(), recordKey=None):
+    with Utilities.open_filing(fpath, "rt") as fp:
+        with pipelineMetrics.stage(timer, "read", exclude="xml"):
+            return list(iter_xml_records(envelope_lines(fp, header, start, end), record, header=header,
+                                         keys=keys, timer=timer, wrappers=wrappers, recordKey=recordKey))
+
+
+def parse_holdings(fpath, fname, outLogName, errLogName, header, timer=None, use_mmap=False, verbosity=0):
+    # 13F-HR information tables, the streaming and memory mapped readers of parseForms.
+    # Imported here, parseForms imports this module to dispatch
+    import parseForms
+    compressed = fpath.endswith(".gz") or fpath.endswith(".zst")
+    if use_mmap and not compressed:
+        return parseForms.parse_form_mmap(fpath, fname=fname, outLogName=outLogName, errLogName=errLogName,
+                                          header=header, verbosity=verbosity, timer=timer)
+    # compressed filings are decompressed as they are read
+    with Utilities.open_filing(fpath, "rt") as fp:
+        return parseForms.parse_form_stream(fp, fname=fname, outLogName=outLogName, errLogName=errLogName,
+                                            header=header, verbosity=verbosity, timer=timer)
+
+
+# 13F-NT: the managers that report this filer's holdings, one row each
+NOTICE_DTYPES = {"otherManagerName": "category", "otherManagerCIK": "Int64", "form13FFileNumber": "category"}
+NOTICE_RENAMES = {"name": "otherManagerName", "cik": "otherManagerCIK"}
+
+
+def parse_notice(fpath, fname, outLogName, errLogName, header, timer=None, use_mmap=False, verbosity=0):
+    tups = read_records(fpath, header, EDGAR_SUBMISSION_START, EDGAR_SUBMISSION_END, "otherManager",
+                        keys=["amendmentType"], timer=timer)
+    # a notice without other managers still gets its row
+    return [{NOTICE_RENAMES.get(key, key): val for key, val in tup.items()} for tup in tups] or [{}]
+
+
+# SC 13D/G: who crossed 5% of which company, from the SGML header. The body is
+# free text and is not read
+OWNERSHIP_DTYPES = {"subjectCIK": "Int64", "subjectName": "category", "filerCIK": "Int64",
+                    "filerName": "category", "groupMembers": "category"}
+OWNERSHIP_KEYS = {"subjectCIK": "SUBJECT COMPANY/CENTRAL INDEX KEY",
+                  "subjectName": "SUBJECT COMPANY/COMPANY CONFORMED NAME",
+                  "filerCIK": "FILED BY/CENTRAL INDEX KEY",
+                  "filerName": "FILED BY/COMPANY CONFORMED NAME",
+                  "groupMembers": "GROUP MEMBERS"}
+
+
+def parse_ownership(fpath, fname, outLogName, errLogName, header, timer=None, use_mmap=False, verbosity=0):
+    with pipelineMetrics.stage(timer, "read"), Utilities.open_filing(fpath, "rt") as fp:
+        for line in envelope_lines(fp, header):
+            pass
+    row = {col: header.get(key) for col, key in OWNERSHIP_KEYS.items()}
+    if row["groupMembers"] is not None:
+        row["groupMembers"] = "; ".join(row["groupMembers"])
+    return [row]
+
+
+# N-PORT: a fund series' portfolio, one row per investment
+NPORT_DTYPES = {"seriesId": "category", "name": "category", "lei": "category", "title": "category",
+                "cusip": "category", "isin": "category", "balance": "float64", "units": "category",
+                "curCd": "category", "valUSD": "float64", "pctVal": "float64", "payoffProfile": "category",
+                "assetCat": "category", "issuerCat": "category", "invCountry": "category",
+                "isRestrictedSec": "category", "fairValLevel": "category"}
+
+
+def parse_nport(fpath, fname, outLogName, errLogName, header, timer=None, use_mmap=False, verbosity=0):
+    tups = read_records(fpath, header, EDGAR_SUBMISSION_START, EDGAR_SUBMISSION_END, "invstOrSec",
+                        keys=["seriesId"], timer=timer)
+    with pipelineMetrics.stage(timer, "frame"):
+        df = records_frame(tups, NPORT_DTYPES)
+        df["seriesId"] = pd.Series(header.get("seriesId"), index=df.index, dtype="string").astype("category")
+        return df
+
+
+# Forms 4 and 5: insider transactions, one row per non-derivative or derivative
+# transaction. The issuer and the (first) reporting owner come from outside the
+# transaction tables and go on every row
+OWNERSHIP_DOCUMENT_START = re.compile("<([A-Za-z0-9_]+:)?ownershipDocument[\\s>]")
+OWNERSHIP_DOCUMENT_END = re.compile("</([A-Za-z0-9_]+:)?ownershipDocument\\s*>")
+INSIDER_TRANSACTIONS = ("nonDerivativeTransaction", "derivativeTransaction")
+INSIDER_OWNER_DTYPES = {"issuerCik": "Int64", "issuerName": "category", "issuerTradingSymbol": "category",
+                        "rptOwnerCik": "Int64", "rptOwnerName": "category", "isDirector": "boolean",
+                        "isOfficer": "boolean", "isTenPercentOwner": "boolean", "isOther": "boolean",
+                        "officerTitle": "category"}
+INSIDER_DTYPES = dict(INSIDER_OWNER_DTYPES, **{
+    "derivative": "boolean", "securityTitle": "category", "transactionDate": "datetime64[ns]",
+    "transactionCode": "category", "equitySwapInvolved": "boolean", "transactionShares": "float64",
+    "transactionPricePerShare": "float64", "transactionAcquiredDisposedCode": "category",
+    "sharesOwnedFollowingTransaction": "float64", "directOrIndirectOwnership": "category",
+    "natureOfOwnership": "category", "conversionOrExercisePrice": "float64", "exerciseDate": "datetime64[ns]",
+    "expirationDate": "datetime64[ns]", "underlyingSecurityTitle": "category",
+    "underlyingSecurityShares": "float64"})
+
+
+def parse_insider(fpath, fname, outLogName, errLogName, header, timer=None, use_mmap=False, verbosity=0):
+    tups = read_records(fpath, header, OWNERSHIP_DOCUMENT_START, OWNERSHIP_DOCUMENT_END, INSIDER_TRANSACTIONS,
+                        keys=INSIDER_OWNER_DTYPES, timer=timer, wrappers=("value",), recordKey="derivative")
+    owner = {col: header.get(col) for col in INSIDER_OWNER_DTYPES}
+    rows = []
+    for tup in tups:
+        tup["derivative"] = tup["derivative"] == "derivativeTransaction"
+        rows.append(dict(tup, **owner))
+    return rows
+
+
+register(FormParser("holdings", ["13F-HR"], parse_holdings, holdingsStore.HOLDINGS_DTYPES))
+register(FormParser("notices", ["13F-NT"], parse_notice, dict(holdingsStore.FILING_DTYPES, **NOTICE_DTYPES),
+                    columns=NOTICE_DTYPES))
+register(FormParser("ownership", ["SC 13D", "SC 13G"], parse_ownership,
+                    dict(holdingsStore.FILING_DTYPES, **OWNERSHIP_DTYPES), columns=OWNERSHIP_DTYPES))
+register(FormParser("nport", ["NPORT-P"], parse_nport, dict(holdingsStore.FILING_DTYPES, **NPORT_DTYPES)))
+register(FormParser("insiders", ["4", "5"], parse_insider, dict(holdingsStore.FILING_DTYPES, **INSIDER_DTYPES),
+                    columns=INSIDER_DTYPES, maxFiles=500))
@@ -0,0 +1,166 @@
+import sys
+import os
+import logging
+import numpy as np
+import pandas as pd
+from time import time
+from utilities import Utilities
+import holdingsStore
+
+# holdings columns the change job reads from the store
+CHANGE_COLUMNS = ["CIK", "fid", "company", "nameOfIssuer", "cusip", "putCall", "value", "sshPrnamt",
+                  "form", "filingDt", "period", "amendmentType"]
+POSITION_KEYS = ["CIK", "cusip", "putCall"]
+CHANGE_TYPES = ["new", "buy", "unchanged", "sell", "closed"]
+
+
+def current_filings(df):
+    # drops the holdings of filings replaced by a later restating 13F-HR/A for
+    # the same CIK and period, the same rule holdingsLoader applies in the database
+    forms = pd.unique(df["form"].astype(object))
+    amended = [form for form in forms if str(form).endswith(("/A", "_A"))]
+    if len(amended) == 0:
+        return df
+    filings = df.loc[df["form"].isin(amended), ["fid", "CIK", "period", "filingDt", "form", "amendmentType"]]
+    filings = filings.drop_duplicates("fid")
+    filings = filings.loc[holdingsStore.restates(filings)]
+    if filings.shape[0] == 0:
+        return df
+    cutoff = filings.groupby(["CIK", "period"])["filingDt"].max().rename("cutoff").reset_index()
+    # only the managers with a restatement need the join
+    touched = df["CIK"].isin(set(cutoff["CIK"]))
+    sub = df.loc[touched].merge(cutoff, on=["CIK", "period"], how="left")
+    sub = sub.loc[sub["cutoff"].isna() | (sub["filingDt"] >= sub["cutoff"])].drop(columns=["cutoff"])
+    return pd.concat([df.loc[~touched], sub], ignore_index=True)
+
+
+def normal_codes(ser, normal):
+    # integer codes of a text column after normal() is applied to its distinct
+    # values, so the string work is per value and not per row. Missing is ""
+    codes, uniques = pd.factorize(ser.astype(object), use_na_sentinel=True)
+    names = normal(pd.Series(uniques, dtype=object).fillna("").astype(str).str.strip())
+    ncodes, nuniques = pd.factorize(pd.concat([names, pd.Series([""])], ignore_index=True), sort=True)
+    return np.where(codes < 0, ncodes[-1], ncodes[codes]), pd.Index(nuniques)
+
+
+def positions(df):
+    # one row per manager, period and position, summed over the lines a filing
+    # splits a position into (other managers, share classes)
+    df = df.assign(CIK=df["CIK"].astype("int64"),
+                   period=holdingsStore.holding_periods(df).astype("datetime64[ns]"))
+    df = current_filings(df)
+    if "putCall" not in df.columns:
+        df["putCall"] = None
+    cusips, cusipNames = normal_codes(df["cusip"], lambda x: x.str.upper())
+    puts, putNames = normal_codes(df["putCall"], lambda x: x.str.title())
+    df = df.assign(cusip=cusips, putCall=puts)
+    pos = df.groupby(["CIK", "period", "cusip", "putCall"], sort=False, observed=True).agg(
+        company=("company", "first"), nameOfIssuer=("nameOfIssuer", "first"),
+        sshPrnamt=("sshPrnamt", "sum"), value=("value", "sum")).reset_index()
+    return pos, cusipNames, putNames
+
+
+def prior_period(periods):
+    # quarter end before each period end, worked out once per distinct period
+    codes, uniques = pd.factorize(periods)
+    priors = (pd.Series(uniques).dt.to_period("Q") - 1).dt.end_time.dt.normalize().astype("datetime64[ns]")
+    return pd.Series(priors.to_numpy()[codes], index=periods.index)
+
+
+def position_changes(df, periods=None):
+    # every manager's positions joined to the same manager's positions a quarter
+    # earlier by (CIK, cusip, putCall), all managers and quarters in one merge on
+    # integer keys. Only managers with a filing in both quarters are compared, a
+    # manager that has not filed yet has no closed positions and a first filer no new ones
+    pos, cusipNames, putNames = positions(df)
+    pos["prior"] = prior_period(pos["period"])
+    filed = pos[["CIK", "period", "prior"]].drop_duplicates()
+    pairs = filed.merge(filed[["CIK", "period"]].rename(columns={"period": "prior"}), on=["CIK", "prior"])
+    if periods is not None:
+        periods = pd.to_datetime(pd.Series(list(periods))).astype("datetime64[ns]")
+        pairs = pairs.loc[pairs["period"].isin(set(periods))]
+    pos = pos.loc[pos["CIK"].isin(set(pairs["CIK"]))]
+    # (CIK, cusip, putCall) as one int64
+    pos["key"] = (pos["CIK"] * len(cusipNames) + pos["cusip"]) * len(putNames) + pos["putCall"]
+    cur = pos.merge(pairs[["CIK", "period"]], on=["CIK", "period"])
+    prv = pos.merge(pairs[["CIK", "prior"]].rename(columns={"prior": "period"}), on=["CIK", "period"])
+    nxt = pairs.set_index(["CIK", "prior"])["period"]
+    prv["period"] = nxt.reindex(pd.MultiIndex.from_frame(prv[["CIK", "period"]])).to_numpy()
+    prv = prv[["key", "period", "CIK", "cusip", "putCall", "company", "nameOfIssuer", "sshPrnamt", "value"]]
+    res = cur.drop(columns=["prior"]).merge(prv, on=["key", "period"], how="outer", sort=False, suffixes=("", "_prior"),
+                                            indicator=True)
+    side = res["_merge"].cat.codes.to_numpy()
+    for col in ["CIK", "cusip", "putCall", "company", "nameOfIssuer"]:
+        res[col] = res[col].where(side != 1, res[col + "_prior"])
+    for col in ["sshPrnamt", "value"]:
+        res[col + "_prior"] = res[col + "_prior"].fillna(0).astype("int64")
+        res[col] = res[col].fillna(0).astype("int64")
+    res["shares_delta"] = res["sshPrnamt"] - res["sshPrnamt_prior"]
+    res["value_delta"] = res["value"] - res["value_prior"]
+    # _merge codes: 0 left_only, 1 right_only, 2 both
+    delta = res["shares_delta"].to_numpy()
+    change = np.select([side == 0, side == 1, delta > 0, delta < 0], [0, 4, 1, 3], default=2)
+    res["change"] = pd.Categorical.from_codes(change, categories=CHANGE_TYPES)
+    res["prior"] = prior_period(res["period"])
+    res["CIK"] = res["CIK"].astype("int64")
+    res["cusip"] = pd.Categorical.from_codes(res["cusip"].astype("int64"), categories=cusipNames)
+    putCall = res["putCall"].astype("int64")
+    res["putCall"] = pd.Categorical.from_codes(putCall, categories=putNames).remove_categories([""])
+    cols = ["CIK", "company", "period", "prior", "cusip", "nameOfIssuer", "putCall", "change",
+            "sshPrnamt_prior", "sshPrnamt", "shares_delta", "value_prior", "value", "value_delta"]
+    res = res[cols].sort_values(["period", "CIK", "cusip", "putCall"], ignore_index=True)
+    for col in ["company", "nameOfIssuer"]:
+        res[col] = res[col].astype("category")
+    return res
+
+
+def period_filter(periods):
+    # store read filter for the holdings of periods and the quarters before them.
+    # Rows without a period get one from their filing date, so they are read too.
+    # A 13F is filed after its quarter ends, earlier years of filings are skipped
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    periods = pd.to_datetime(pd.Series(list(periods))).astype("datetime64[ns]")
+    wanted = pd.concat([periods, prior_period(periods)]).drop_duplicates()
+    inPeriod = pc.field("period").isin(pa.array(wanted, type=pa.timestamp("ns")))
+    return (inPeriod | pc.field("period").is_null()) & (pc.field("year") >= int(wanted.min().year))
+
+
+def store_changes(storedir, changedir=None, periods=None, outLogName="changesOut", errLogName="changesErr",
+                  verbosity=0):
+    # the batch job: read the holdings columns it needs from the store, compute the
+    # changes for every period (or just periods), and write one parquet file per
+    # period. With periods only those quarters and the ones before them are read.
+    # Run by hand after parseForms has written the store, see __main__
+    starttime = time()
+    where = period_filter(periods) if periods is not None else None
+    df = holdingsStore.read_holdings(storedir, columns=CHANGE_COLUMNS, where=where)
+    changes = position_changes(df, periods=periods)
+    if changedir is not None:
+        if not os.path.isdir(changedir):
+            os.makedirs(changedir)
+        for period, pdf in changes.groupby("period", sort=True):
+            fpath = os.path.join(changedir, f"changes_{period.strftime('%Y%m%d')}.parquet")
+            pdf.to_parquet(fpath + ".tmp", index=False)
+            os.replace(fpath + ".tmp", fpath)
+    if verbosity > 0:
+        logger = logging.getLogger(outLogName)
+        counts = changes["change"].value_counts().to_dict()
+        logger.info(f"{Utilities.get_fname()}  {df.shape[0]} holdings -> {changes.shape[0]} changes "
+                    f"{counts} in {time() - starttime:.2f}s")
+    return changes
+
+
+if __name__ == "__main__":
+    # holdingsChanges.py <store dir> <changes dir> [period YYYY-MM-DD ...]
+    # not part of the parse run, run it once the quarter's filings are in the store
+    outLogName = "changesOut"
+    errLogName = "changesErr"
+    logging.basicConfig(level=logging.INFO)
+    storedir = sys.argv[1] if len(sys.argv) > 1 else os.path.join("data", "holdings")
+    changedir = sys.argv[2] if len(sys.argv) > 2 else os.path.join("data", "changes")
+    periods = sys.argv[3:] if len(sys.argv) > 3 else None
+    changes = store_changes(storedir, changedir, periods=periods, outLogName=outLogName,
+                            errLogName=errLogName, verbosity=1)
+    print(changes.groupby(["period", "change"], observed=True).size())
+    print("done {0}".format(Utilities.now()))
@@ -0,0 +1,263 @@
+import sys
+import os
+import bisect
+import logging
+import numpy as np
+import pandas as pd
+from time import time
+from utilities import Utilities
+import holdingsStore
+
+# holdings columns the index is built from
+INDEX_COLUMNS = ["CIK", "fid", "company", "nameOfIssuer", "cusip", "value", "sshPrnamt",
+                 "form", "filingDt", "period", "amendmentType"]
+AGGREGATE_COLS = ["value", "sshPrnamt", "holders", "filings"]
+
+
+def normal_cusip(cusip):
+    return str(cusip).strip().upper()
+
+
+class CusipIndex(object):
+    # precomputed per security view of the 13F holdings. postings holds one row
+    # per (filing, cusip) sorted by cusip, with the position of every cusip's run
+    # kept in a dict, so "who holds this and how much" is a slice and not a scan.
+    # aggregates holds value, shares, holder and filing counts per (period, cusip).
+    # add() folds in new filings and only recomputes the cusips they touch. A
+    # restating 13F-HR/A drops the filings it replaces, as in holdingsLoader
+    def __init__(self, indexdir, outLogName="indexOut", errLogName="indexErr", verbosity=0):
+        self.indexdir = indexdir
+        self.outLogName = outLogName
+        self.errLogName = errLogName
+        self.verbosity = verbosity
+        self.postings = pd.DataFrame()
+        self.filings = pd.DataFrame()
+        self.runs = {}
+        self.aggregates = {}
+        # store files already folded in, relative to the store dir
+        self.sources = set()
+
+    def load(self):
+        ppath = os.path.join(self.indexdir, "postings.parquet")
+        fpath = os.path.join(self.indexdir, "filings.parquet")
+        if os.path.isfile(ppath) and os.path.isfile(fpath):
+            self.postings = pd.read_parquet(ppath)
+            self.filings = pd.read_parquet(fpath)
+            self.reindex(None)
+        spath = os.path.join(self.indexdir, "sources.parquet")
+        if os.path.isfile(spath):
+            self.sources = set(pd.read_parquet(spath)["source"])
+        return self
+
+    def save(self):
+        if not os.path.isdir(self.indexdir):
+            os.makedirs(self.indexdir)
+        sources = pd.DataFrame({"source": sorted(self.sources)}, dtype=object)
+        for name, df in [("postings", self.postings), ("filings", self.filings), ("sources", sources)]:
+            fpath = os.path.join(self.indexdir, f"{name}.parquet")
+            df.to_parquet(fpath + ".tmp", index=False)
+            os.replace(fpath + ".tmp", fpath)
+
+    def indexed_fids(self):
+        if self.filings.shape[0] == 0:
+            return set()
+        return set(self.filings["fid"].astype(str))
+
+    def add(self, df):
+        # fold parsed holdings into the index, filings already in it are skipped.
+        # Returns the number of new filings
+        starttime = time()
+        df = df.loc[df["fid"].notna()]
+        df = df.loc[~df["fid"].astype(str).isin(self.indexed_fids())]
+        if df.shape[0] == 0:
+            return 0
+        df = pd.DataFrame({
+            "cusip": df["cusip"].astype(str).str.strip().str.upper(),
+            "nameOfIssuer": df["nameOfIssuer"].astype(str),
+            "CIK": df["CIK"].astype("int64"),
+            "fid": df["fid"].astype(str),
+            "company": df["company"].astype(str) if "company" in df.columns else None,
+            "form": df["form"].astype(str),
+            "filingDt": pd.to_datetime(df["filingDt"]).astype("datetime64[ns]"),
+            "period": holdingsStore.holding_periods(df).astype("datetime64[ns]"),
+            "amendmentType": df["amendmentType"].astype(object) if "amendmentType" in df.columns else None,
+            "value": df["value"].astype("int64"),
+            "sshPrnamt": df["sshPrnamt"].astype("int64"),
+        })
+        # a filing can list a security on several lines (puts, calls, other managers)
+        keys = ["cusip", "fid"]
+        postings = df.groupby(keys, sort=False, observed=True).agg(
+            nameOfIssuer=("nameOfIssuer", "first"), CIK=("CIK", "first"), company=("company", "first"),
+            period=("period", "first"), filingDt=("filingDt", "first"),
+            value=("value", "sum"), sshPrnamt=("sshPrnamt", "sum")).reset_index()
+        filings = df.groupby("fid", sort=False).agg(
+            CIK=("CIK", "first"), form=("form", "first"), period=("period", "first"),
+            filingDt=("filingDt", "first"), amendmentType=("amendmentType", "first")).reset_index()
+        filings["restates"] = holdingsStore.restates(filings)
+        filings["supersededBy"] = None
+        filings = filings.drop(columns=["amendmentType"])
+        self.filings = pd.concat([self.filings, filings], ignore_index=True) if self.filings.shape[0] > 0 else filings
+        touched = set(postings["cusip"])
+        touched |= self.supersede(set(zip(filings["CIK"], filings["period"])))
+        alive = self.filings.loc[self.filings["supersededBy"].isna(), "fid"]
+        postings = postings.loc[postings["fid"].isin(set(alive))]
+        self.merge(postings)
+        self.reindex(touched)
+        if self.verbosity > 0:
+            logger = logging.getLogger(self.outLogName)
+            logger.info(f"{Utilities.get_fname()}  {filings.shape[0]} filings, {len(touched)} cusips "
+                        f"in {time() - starttime:.2f}s")
+        return filings.shape[0]
+
+    def merge(self, postings):
+        # postings stay sorted by cusip, period and value (biggest first). Only the
+        # new rows and the old runs of their cusips are sorted, the untouched runs
+        # keep their order and the whole frame is copied once. Needs runs to be
+        # up to date with postings
+        order = ["cusip", "period", "value"]
+        ascending = [True, True, False]
+        if self.postings.shape[0] == 0:
+            self.postings = postings.sort_values(order, ascending=ascending, kind="stable", ignore_index=True)
+            return
+        n = self.postings.shape[0]
+        merged = pd.concat([self.postings, postings], ignore_index=True)
+        # where each new cusip's run is, or for a cusip new to the index where it goes
+        keys = list(self.runs.keys())
+        starts = {}
+        hit = np.zeros(n, dtype=bool)
+        for cusip in pd.unique(postings["cusip"]).tolist():
+            run = self.runs.get(cusip)
+            if run is None:
+                i = bisect.bisect_left(keys, cusip)
+                starts[cusip] = self.runs[keys[i]][0] if i < len(keys) else n
+            else:
+                starts[cusip] = run[0]
+                hit[run[0]:run[1]] = True
+        blockIdx = np.r_[np.flatnonzero(hit), n + np.arange(postings.shape[0])]
+        block = merged.iloc[blockIdx].sort_values(order, ascending=ascending, kind="stable")
+        # each block row goes in after the kept rows before its cusip's start
+        kept = np.flatnonzero(~hit)
+        keptBefore = np.r_[0, np.cumsum(~hit)]
+        pos = keptBefore[np.array([starts[cusip] for cusip in block["cusip"].tolist()], dtype=np.int64)]
+        rows = np.empty(kept.shape[0] + block.shape[0], dtype=np.int64)
+        rows[np.arange(kept.shape[0]) + np.searchsorted(pos, np.arange(kept.shape[0]), side="right")] = kept
+        rows[pos + np.arange(block.shape[0])] = block.index.to_numpy()
+        self.postings = merged.take(rows).reset_index(drop=True)
+
+    def supersede(self, keys):
+        # the latest restating filing for a CIK and period replaces the ones before
+        # it, returns the cusips whose postings were dropped
+        removed = set()
+        restating = self.filings.loc[self.filings["restates"]]
+        if restating.shape[0] == 0:
+            return removed
+        latest = restating.sort_values("filingDt").groupby(["CIK", "period"]).tail(1)
+        latest = latest.loc[[key in keys for key in zip(latest["CIK"], latest["period"])]]
+        for row in latest.itertuples():
+            old = ((self.filings["CIK"] == row.CIK) & (self.filings["period"] == row.period)
+                   & (self.filings["filingDt"] < row.filingDt) & (self.filings["fid"] != row.fid))
+            self.filings.loc[old, "supersededBy"] = row.fid
+            oldfids = set(self.filings.loc[old, "fid"])
+            if self.postings.shape[0] > 0 and len(oldfids) > 0:
+                gone = self.postings["fid"].isin(oldfids)
+                removed |= set(self.postings.loc[gone, "cusip"])
+                self.postings = self.postings.loc[~gone].reset_index(drop=True)
+        if len(removed) > 0:
+            self.runs = self.run_offsets()
+        return removed
+
+    def run_offsets(self):
+        # cusip -> (start, end) of its run in postings, from a vectorized compare
+        # of neighbours so only the run starts become python strings
+        codes = self.postings["cusip"]
+        if len(codes) == 0:
+            return {}
+        starts = np.flatnonzero((codes != codes.shift()).to_numpy(dtype=bool))
+        ends = np.r_[starts[1:], len(codes)]
+        return dict(zip(codes.iloc[starts].tolist(), zip(starts.tolist(), ends.tolist())))
+
+    def reindex(self, cusips):
+        # cusip -> (start, end) of its run in postings, and the aggregates of the
+        # given cusips (all of them when cusips is None)
+        self.runs = self.run_offsets()
+        if len(self.runs) == 0:
+            return
+        if cusips is None:
+            sub = self.postings
+            self.aggregates = {}
+        else:
+            for key in [key for key in self.aggregates if key[1] in cusips]:
+                del self.aggregates[key]
+            runs = [self.runs[cusip] for cusip in cusips if cusip in self.runs]
+            rows = np.concatenate([np.arange(start, end) for start, end in runs]) if len(runs) > 0 else []
+            sub = self.postings.iloc[rows]
+        aggs = sub.groupby(["period", "cusip"], sort=False).agg(
+            value=("value", "sum"), sshPrnamt=("sshPrnamt", "sum"), holders=("CIK", "nunique"),
+            filings=("fid", "size"), nameOfIssuer=("nameOfIssuer", "first"))
+        for key, vals in zip(aggs.index.tolist(), aggs.itertuples(index=False, name=None)):
+            self.aggregates[key] = dict(zip(AGGREGATE_COLS + ["nameOfIssuer"], vals))
+
+    def holders(self, cusip, period=None):
+        # every (CIK, filing) holding the security, biggest position first within each period
+        run = self.runs.get(normal_cusip(cusip))
+        if run is None:
+            return self.postings.iloc[0:0]
+        df = self.postings.iloc[run[0]:run[1]]
+        if period is not None:
+            df = df.loc[df["period"] == pd.Timestamp(period)]
+        return df
+
+    def aggregate(self, cusip, period=None):
+        # {period: {value, sshPrnamt, holders, filings, nameOfIssuer}} or one period's dict
+        cusip = normal_cusip(cusip)
+        if period is not None:
+            return self.aggregates.get((pd.Timestamp(period), cusip))
+        run = self.runs.get(cusip)
+        if run is None:
+            return {}
+        periods = self.postings["period"].iloc[run[0]:run[1]].unique()
+        return {p: self.aggregates[(p, cusip)] for p in periods if (p, cusip) in self.aggregates}
+
+    def update_from_store(self, storedir, year=None, month=None, form=None):
+        # new filings of the parquet store into the index. Only the files not in
+        # sources are read, like the checkpoint table of holdingsLoader.load_store.
+        # An index saved without sources reads the store once, add() skips the
+        # filings it already has
+        new = []
+        for fpath in holdingsStore.store_files(storedir, year=year, month=month, form=form):
+            source = holdingsStore.store_source(fpath, storedir)
+            if source not in self.sources:
+                new.append((source, fpath))
+        if len(new) == 0:
+            return 0
+        df = holdingsStore.concat_holdings([holdingsStore.read_store_file(fpath, storedir, columns=INDEX_COLUMNS)
+                                            for source, fpath in new])
+        nfilings = self.add(df) if df.shape[0] > 0 else 0
+        self.sources.update(source for source, fpath in new)
+        if self.verbosity > 0:
+            logger = logging.getLogger(self.outLogName)
+            logger.info(f"{Utilities.get_fname()}  {len(new)} new store files")
+        return nfilings
+
+
+if __name__ == "__main__":
+    # holdingsIndex.py <store dir> <index dir> [cusip ...]
+    outLogName = "indexOut"
+    errLogName = "indexErr"
+    logging.basicConfig(level=logging.INFO)
+    storedir = sys.argv[1] if len(sys.argv) > 1 else os.path.join("data", "holdings")
+    indexdir = sys.argv[2] if len(sys.argv) > 2 else os.path.join("data", "cusipIndex")
+    index = CusipIndex(indexdir, outLogName, errLogName, verbosity=1).load()
+    nfilings = index.update_from_store(storedir)
+    if nfilings > 0:
+        index.save()
+    print(f"{nfilings} new filings, {len(index.runs)} cusips, {index.postings.shape[0]} postings")
+    for cusip in sys.argv[3:]:
+        starttime = time()
+        aggs = index.aggregate(cusip)
+        holders = index.holders(cusip)
+        print(f"{cusip}  {(time() - starttime)*1000:.3f}ms")
+        for period, agg in aggs.items():
+            print(f"  {period.date()}  {agg}")
+        print(holders.head(10).to_string(index=False))
+    print("done {0}".format(Utilities.now()))
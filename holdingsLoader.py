@@ -0,0 +1,402 @@
+import sys
+import os
+import re
+import logging
+import tempfile
+import datetime
+import numpy as np
+import pandas as pd
+from time import time
+from pathlib import PurePath
+from utilities import Utilities
+import holdingsStore
+import formParsers
+
+# column types of the holdings table, in holdingsStore column order
+HOLDINGS_SQL = {
+    "CIK": "BIGINT NOT NULL",
+    "fid": "VARCHAR(20) NOT NULL",
+    "company": "VARCHAR(150)",
+    "nameOfIssuer": "VARCHAR(200)",
+    "titleOfClass": "VARCHAR(150)",
+    "cusip": "VARCHAR(12)",
+    "value": "BIGINT",
+    "sshPrnamt": "BIGINT",
+    "sshPrnamtType": "VARCHAR(8)",
+    "putCall": "VARCHAR(8)",
+    "investmentDiscretion": "VARCHAR(8)",
+    "otherManager": "VARCHAR(150)",
+    "Sole": "BIGINT",
+    "Shared": "BIGINT",
+    "None": "BIGINT",
+    "wt": "DOUBLE",
+    "perSh": "DOUBLE",
+    "year": "SMALLINT",
+    "month": "SMALLINT",
+    "day": "SMALLINT",
+    "form": "VARCHAR(16)",
+    "filingDt": "DATETIME",
+    "period": "DATE",
+    "amendmentType": "VARCHAR(16)",
+}
+# datetime columns written as text in these formats, DATETIME otherwise
+SQL_DATE_FORMATS = {"period": "%Y-%m-%d"}
+SQL_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+CHECKPOINT_TABLE = "holdings_loaded"
+FILINGS_TABLE = "filings_loaded"
+CSV_KEY = re.compile(r"_CIK(\d+)_FID([^_.]+)")
+
+
+def connect_mariadb(user, password, host="localhost", port=3306, database="Edgar"):
+    import mariadb
+    return mariadb.connect(user=user, password=password, host=host, port=port,
+                           database=database, local_infile=True)
+
+
+class HoldingsLoader(object):
+    # loads parsed holdings into a holdings table a batch at a time. Each batch
+    # goes in one transaction together with the names of the sources (csv files,
+    # parquet files) it came from, so a rerun skips what is already loaded and a
+    # crash never leaves half a source behind. dialect is "mariadb" or "sqlite",
+    # sqlite stands in for MariaDB when testing
+    def __init__(self, conn, outLogName, errLogName, dialect="mariadb", table="holdings",
+                 batchRows=200000, infile=None, verbosity=0):
+        self.conn = conn
+        self.outLogName = outLogName
+        self.errLogName = errLogName
+        self.dialect = dialect
+        self.table = table
+        self.batchRows = batchRows
+        # LOAD DATA LOCAL INFILE on MariaDB, executemany otherwise
+        self.infile = dialect == "mariadb" if infile is None else infile
+        self.verbosity = verbosity
+        self.pending = []
+        self.pendingSources = []
+        self.pendingRows = 0
+        self.stats = Utilities.new_stats(sources=0, skipped=0, rows=0, batches=0)
+
+    def quote(self, name):
+        return f"`{name}`" if self.dialect == "mariadb" else f'"{name}"'
+
+    def table_columns(self, cur, table):
+        # column names of an existing table, empty when there is no such table
+        if self.dialect == "sqlite":
+            cur.execute(f"PRAGMA table_info({table})")
+            return [row[1] for row in cur.fetchall()]
+        cur.execute("""SELECT column_name FROM information_schema.columns
+                       WHERE table_schema = DATABASE() AND table_name = ? ORDER BY ordinal_position""", (table,))
+        return [row[0] for row in cur.fetchall()]
+
+    def create_tables(self):
+        cols = ",\n  ".join(f"{self.quote(col)} {sqltype}" for col, sqltype in HOLDINGS_SQL.items())
+        cur = self.conn.cursor()
+        # a holdings table from before the loader (database.ipynb's to_sql) has other
+        # columns, loading into it would fail half way or drop the filing keys
+        existing = self.table_columns(cur, self.table)
+        if len(existing) > 0 and set(existing) != set(HOLDINGS_SQL):
+            missing = [col for col in HOLDINGS_SQL if col not in existing]
+            extra = [col for col in existing if col not in HOLDINGS_SQL]
+            msg = (f"{Utilities.get_fname()}  table {self.table} exists with other columns, missing: {missing}  "
+                   f"extra: {extra}. Drop or rename it, or load into another table with table=")
+            Utilities.log_msg(msg, loggers=[self.outLogName, self.errLogName], level=logging.ERROR)
+            raise RuntimeError(msg)
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (\n  {cols}\n)")
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+                          source VARCHAR(255) PRIMARY KEY, nrows BIGINT, loaded DATETIME)""")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_fid ON {self.table} (fid)")
+        self.conn.commit()
+
+    def loaded_sources(self):
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT source FROM {CHECKPOINT_TABLE}")
+        return set(row[0] for row in cur.fetchall())
+
+    def add(self, df, source):
+        # queue one source's rows, flushing once a batch is big enough
+        self.pending.append(df)
+        self.pendingSources.append((source, df.shape[0]))
+        self.pendingRows += df.shape[0]
+        if self.pendingRows >= self.batchRows:
+            self.flush()
+
+    def flush(self):
+        if len(self.pendingSources) == 0:
+            return 0
+        df = pd.concat(self.pending, ignore_index=True) if len(self.pending) > 1 else self.pending[0]
+        df = sql_holdings(df)
+        starttime = time()
+        cur = self.conn.cursor()
+        try:
+            nrows = self.load_batch(cur, df)
+            loaded = datetime.datetime.now().strftime(SQL_DATETIME_FORMAT)
+            cur.executemany(f"INSERT INTO {CHECKPOINT_TABLE} (source, nrows, loaded) VALUES (?, ?, ?)",
+                            [(source, nrows, loaded) for source, nrows in self.pendingSources])
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            msg = f"{Utilities.get_fname()}  error loading {len(self.pendingSources)} sources"
+            msg += Utilities.err_info()
+            Utilities.log_msg(msg, loggers=[self.outLogName, self.errLogName], level=logging.ERROR)
+            raise
+        finally:
+            self.pending = []
+            sources = self.pendingSources
+            self.pendingSources = []
+            self.pendingRows = 0
+        self.stats["sources"] += len(sources)
+        self.stats["rows"] += nrows
+        self.stats["batches"] += 1
+        if self.verbosity > 0:
+            logger = logging.getLogger(self.outLogName)
+            logger.info(f"{Utilities.get_fname()}  {nrows} rows from {len(sources)} sources "
+                        f"in {time() - starttime:.2f}s")
+        return nrows
+
+    def load_batch(self, cur, df):
+        # rows of one flush into the table, inside the flush's transaction
+        self.insert(cur, df)
+        return df.shape[0]
+
+    def insert(self, cur, df):
+        if df.shape[0] == 0:
+            return
+        if self.infile:
+            self.load_infile(cur, df)
+        else:
+            self.load_rows(cur, df)
+
+    def load_rows(self, cur, df):
+        cols = ", ".join(self.quote(col) for col in df.columns)
+        qs = ", ".join("?" * df.shape[1])
+        sql = f"INSERT INTO {self.table} ({cols}) VALUES ({qs})"
+        rows = sql_rows(df)
+        for start in range(0, len(rows), 50000):
+            cur.executemany(sql, rows[start:start+50000])
+
+    def load_infile(self, cur, df):
+        # tab separated temp file, \N for NULL, then one LOAD DATA for the batch
+        fd, fpath = tempfile.mkstemp(suffix=".tsv")
+        try:
+            with os.fdopen(fd, "w", newline="\n") as fp:
+                fp.write("\n".join(infile_lines(df)) + "\n")
+            cols = ", ".join(self.quote(col) for col in df.columns)
+            path = fpath.replace("\\", "/")
+            cur.execute(f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE {self.table} "
+                        f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({cols})")
+        finally:
+            os.remove(fpath)
+
+    def load_store(self, storedir, year=None, month=None, form=None):
+        # one source per parquet file of the holdingsStore dataset
+        done = self.loaded_sources()
+        for fpath in holdingsStore.store_files(storedir, year=year, month=month, form=form):
+            source = "store:" + holdingsStore.store_source(fpath, storedir)
+            if source in done:
+                self.stats["skipped"] += 1
+                continue
+            self.add(holdingsStore.read_store_file(fpath, storedir), source)
+        self.flush()
+        return self.stats
+
+    def load_csvs(self, basedir):
+        # one source per parsed holdings csv under basedir/year/month/day/form. The
+        # csvs of the other datasets (13F-NT, Form 4, ...) sit in their own form
+        # directories and are left alone
+        done = self.loaded_sources()
+        for sdir in sorted(Utilities.sub_dirs_with_files(basedir, fname_incl=".csv$")):
+            if len(PurePath(sdir).parts) < 5:
+                continue
+            parser = formParsers.parser_for(PurePath(sdir).parts[-1])
+            if parser is None or parser.dataset != "holdings":
+                continue
+            for fname in sorted(os.listdir(sdir)):
+                if not fname.endswith(".csv") or fname.startswith("secFilings"):
+                    continue
+                fpath = os.path.join(sdir, fname)
+                source = "csv:" + PurePath(os.path.relpath(fpath, basedir)).as_posix()
+                if source in done:
+                    self.stats["skipped"] += 1
+                    continue
+                df = read_holdings_csv(fpath, self.outLogName, self.errLogName)
+                if df is not None:
+                    self.add(df, source)
+        self.flush()
+        return self.stats
+
+
+class HoldingsSync(HoldingsLoader):
+    # incremental load keyed on the accession number (fid). A filing already in
+    # filings_loaded is never loaded twice, so a daily run costs what the day's new
+    # filings cost. A 13F-HR/A that restates (anything but NEW HOLDINGS) replaces
+    # the holdings of the filings made before it for the same CIK and period
+    def __init__(self, conn, outLogName, errLogName, **kwargs):
+        super().__init__(conn, outLogName, errLogName, **kwargs)
+        self.stats.update(filings=0, duplicates=0, superseded=0)
+
+    def create_tables(self):
+        super().create_tables()
+        cur = self.conn.cursor()
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {FILINGS_TABLE} (
+                          fid VARCHAR(20) PRIMARY KEY, CIK BIGINT, form VARCHAR(16), period DATE,
+                          filingDt DATETIME, restates SMALLINT, nrows BIGINT, loaded DATETIME,
+                          supersededBy VARCHAR(20))""")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS filings_cik_period ON {FILINGS_TABLE} (CIK, period)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_cik_period ON {self.table} (CIK, period)")
+        self.conn.commit()
+
+    def loaded_fids(self, cur, fids):
+        res = set()
+        for start in range(0, len(fids), 500):
+            chunk = fids[start:start+500]
+            qs = ",".join("?" * len(chunk))
+            cur.execute(f"SELECT fid FROM {FILINGS_TABLE} WHERE fid IN ({qs})", chunk)
+            res.update(row[0] for row in cur.fetchall())
+        return res
+
+    def load_batch(self, cur, df):
+        df = df.loc[df["fid"].notna()]
+        filings = df.groupby("fid", observed=True, sort=False).agg(
+            CIK=("CIK", "first"), form=("form", "first"), period=("period", "first"),
+            filingDt=("filingDt", "first"), amendmentType=("amendmentType", "first"),
+            nrows=("CIK", "size")).reset_index()
+        filings["fid"] = filings["fid"].astype(str)
+        done = self.loaded_fids(cur, filings["fid"].tolist())
+        new = filings.loc[~filings["fid"].isin(done)].copy()
+        self.stats["duplicates"] += filings.shape[0] - new.shape[0]
+        if new.shape[0] == 0:
+            return 0
+        new["restates"] = holdingsStore.restates(new).astype("int64")
+        rows = sql_rows(new[["fid", "CIK", "form", "period", "filingDt", "restates", "nrows"]])
+        loaded = datetime.datetime.now().strftime(SQL_DATETIME_FORMAT)
+        cur.executemany(f"""INSERT INTO {FILINGS_TABLE} (fid, CIK, form, period, filingDt, restates, nrows, loaded)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", [row + (loaded,) for row in rows])
+        df = df.loc[df["fid"].astype(str).isin(set(new["fid"]))]
+        self.insert(cur, df)
+        self.stats["filings"] += new.shape[0]
+        self.stats["superseded"] += self.supersede(cur, new)
+        return df.shape[0]
+
+    def supersede(self, cur, new):
+        # for each CIK and period the batch touched, the latest restating filing
+        # wins: everything filed before it is marked and its holdings deleted.
+        # Works whichever order the original and the amendment arrive in
+        new = new.loc[new["period"].notna()]
+        if new.shape[0] == 0:
+            return 0
+        touched = set(zip(new["CIK"].astype("int64").tolist(),
+                          new["period"].dt.strftime(SQL_DATE_FORMATS["period"]).tolist()))
+        ciks = sorted(set(CIK for CIK, period in touched))
+        latest = {}
+        for start in range(0, len(ciks), 500):
+            chunk = ciks[start:start+500]
+            qs = ",".join("?" * len(chunk))
+            cur.execute(f"""SELECT CIK, period, fid, filingDt FROM {FILINGS_TABLE}
+                            WHERE restates = 1 AND CIK IN ({qs})""", chunk)
+            for CIK, period, fid, filingDt in cur.fetchall():
+                key = (int(CIK), str(period)[:10])
+                if key not in latest or str(filingDt) > latest[key][1]:
+                    latest[key] = (fid, str(filingDt))
+        nrows = 0
+        for (CIK, period) in sorted(touched & latest.keys()):
+            fid, filingDt = latest[(CIK, period)]
+            cur.execute(f"""UPDATE {FILINGS_TABLE} SET supersededBy = ?
+                            WHERE CIK = ? AND period = ? AND filingDt < ? AND fid != ?""",
+                        (fid, CIK, period, filingDt, fid))
+            cur.execute(f"DELETE FROM {self.table} WHERE CIK = ? AND period = ? AND filingDt < ?",
+                        (CIK, period, filingDt))
+            nrows += max(cur.rowcount, 0)
+        return nrows
+
+
+def read_holdings_csv(fpath, outLogName, errLogName):
+    # parsed holdings csv, CIK and fid from the file name when the csv predates those columns
+    try:
+        df = pd.read_csv(fpath)
+    except:
+        msg = f"{Utilities.get_fname()}  can't read {fpath}"
+        msg += Utilities.err_info()
+        logger = logging.getLogger(errLogName)
+        logger.warning(msg)
+        return None
+    m = CSV_KEY.search(os.path.basename(fpath))
+    if m is not None:
+        if "CIK" not in df.columns:
+            df["CIK"] = int(m.group(1))
+        if "fid" not in df.columns:
+            df["fid"] = m.group(2)
+    pparts = PurePath(fpath).parts
+    if "form" not in df.columns and len(pparts) > 5:
+        df["form"] = pparts[-2]
+    return df
+
+
+def sql_holdings(df):
+    # the store types, then only the table columns. A DOUBLE column cannot hold
+    # inf (perSh of a zero share position), so non-finite values load as NULL
+    df = holdingsStore.typed_holdings(df)
+    for col in df.columns:
+        if pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].where(np.isfinite(df[col]))
+    return df[[col for col in HOLDINGS_SQL if col in df.columns]]
+
+
+def sql_rows(df):
+    # python values a column at a time, None for missing, datetimes as text
+    cols = []
+    for col in df.columns:
+        ser = df[col]
+        if pd.api.types.is_datetime64_any_dtype(ser):
+            vals = ser.dt.strftime(SQL_DATE_FORMATS.get(col, SQL_DATETIME_FORMAT))
+        elif isinstance(ser.dtype, pd.CategoricalDtype):
+            vals = ser.astype(object)
+        else:
+            vals = ser
+        cols.append(vals.astype(object).where(ser.notna(), None).tolist())
+    return list(zip(*cols))
+
+
+def infile_lines(df):
+    # LOAD DATA text, tab between fields, \N for NULL and backslash escapes
+    # for the characters LOAD DATA would read as separators
+    cols = []
+    for col in df.columns:
+        ser = df[col]
+        if pd.api.types.is_datetime64_any_dtype(ser):
+            vals = ser.dt.strftime(SQL_DATE_FORMATS.get(col, SQL_DATETIME_FORMAT))
+        elif pd.api.types.is_numeric_dtype(ser):
+            vals = ser.astype(str)
+        else:
+            vals = ser.astype(object).astype(str)
+            for char, escaped in [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")]:
+                vals = vals.str.replace(char, escaped, regex=False)
+        cols.append(vals.astype(object).where(ser.notna(), "\\N"))
+    return cols[0].str.cat(cols[1:], sep="\t").tolist()
+
+
+if __name__ == "__main__":
+    # holdingsLoader.py <store dir or csv base dir> [sqlite file]
+    # without a sqlite file it loads into MariaDB, Edgar.holdings. Only filings
+    # not loaded before go in, restating amendments replace what they amend
+    outLogName = "loadOut"
+    errLogName = "loadErr"
+    logging.basicConfig(level=logging.INFO)
+    srcdir = sys.argv[1] if len(sys.argv) > 1 else os.path.join("data", "holdings")
+    if len(sys.argv) > 2:
+        import sqlite3
+        conn = sqlite3.connect(sys.argv[2])
+        dialect = "sqlite"
+    else:
+        import getpass
+        conn = connect_mariadb("root", getpass.getpass())
+        dialect = "mariadb"
+    loader = HoldingsSync(conn, outLogName, errLogName, dialect=dialect, verbosity=1)
+    loader.create_tables()
+    starttime = time()
+    if any(f.startswith("year=") for f in os.listdir(srcdir)):
+        stats = loader.load_store(srcdir)
+    else:
+        stats = loader.load_csvs(srcdir)
+    stats["elapsed"] = time() - starttime
+    print(stats)
+    conn.close()
+    print("done {0}".format(Utilities.now()))
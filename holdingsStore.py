@@ -0,0 +1,186 @@
+import os
+import uuid
+import logging
+import pandas as pd
+from pathlib import PurePath
+from utilities import Utilities
+
+# column types of the holdings kept in the parquet store, fixed at write time
+# so every file in the dataset has the same schema. Text is dictionary encoded,
+# the voting counts are nullable
+HOLDINGS_DTYPES = {
+    "CIK": "int64",
+    "fid": "category",
+    "company": "category",
+    "nameOfIssuer": "category",
+    "titleOfClass": "category",
+    "cusip": "category",
+    "value": "int64",
+    "sshPrnamt": "int64",
+    "sshPrnamtType": "category",
+    "putCall": "category",
+    "investmentDiscretion": "category",
+    "otherManager": "category",
+    "Sole": "Int64",
+    "Shared": "Int64",
+    "None": "Int64",
+    "wt": "float64",
+    "perSh": "float64",
+    "year": "int64",
+    "month": "int64",
+    "day": "int64",
+    "form": "category",
+    "filingDt": "datetime64[ns]",
+    "period": "datetime64[ns]",
+    "amendmentType": "category",
+}
+PARTITION_COLS = ["year", "month", "form"]
+# the columns parseForms puts on the rows of every filing, whatever the form type
+FILING_DTYPES = {col: HOLDINGS_DTYPES[col] for col in
+                 ["CIK", "fid", "company", "year", "month", "day", "form", "filingDt", "period", "amendmentType"]}
+
+
+def typed_holdings(df):
+    return typed_frame(df, HOLDINGS_DTYPES)
+
+
+def typed_frame(df, dtypes):
+    # only the store columns, in store order, with the store types
+    df = df.copy()
+    for col, dtype in dtypes.items():
+        if col not in df.columns:
+            df[col] = None
+        if dtype == "category":
+            df[col] = df[col].astype("string").astype("category")
+        elif dtype.startswith("datetime"):
+            df[col] = pd.to_datetime(df[col]).astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df[list(dtypes.keys())]
+
+
+def holding_periods(df):
+    # the period of report, or for filings without one the quarter end before the
+    # filing, worked out once per distinct filing date
+    codes, dates = pd.factorize(df["filingDt"])
+    ends = (pd.Series(dates).dt.to_period("Q") - 1).dt.end_time.dt.normalize().to_numpy()
+    fallback = pd.Series(ends[codes], index=df.index)
+    fallback[codes < 0] = pd.NaT
+    if "period" not in df.columns:
+        return fallback
+    return df["period"].fillna(fallback)
+
+
+def concat_holdings(dfs):
+    # concat that keeps categorical columns categorical, plain pd.concat turns
+    # categoricals whose categories differ back into one string per row
+    from pandas.api.types import union_categoricals
+    dfs = [df for df in dfs if df.shape[0] > 0]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    cols = {}
+    for df in dfs:
+        for col in df.columns:
+            cols.setdefault(col, None)
+    res = {}
+    for col in cols:
+        parts = [df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object) for df in dfs]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            # an all missing column has untyped categories, union needs them to match
+            parts = [part.cat.set_categories(part.cat.categories.astype(str)) for part in parts]
+            res[col] = pd.Series(union_categoricals(parts, ignore_order=True))
+        else:
+            res[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(res)
+
+
+def write_holdings(df, storedir, outLogName, errLogName, verbosity=0):
+    return write_frame(df, storedir, HOLDINGS_DTYPES, outLogName, errLogName, verbosity=verbosity)
+
+
+def write_frame(df, storedir, dtypes, outLogName, errLogName, verbosity=0):
+    # any of the parsed datasets, partitioned like the holdings
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if verbosity > 1:
+        logger = logging.getLogger(outLogName)
+        logger.info(f"{Utilities.get_fname()}  {storedir}  rows: {df.shape[0]}")
+    if df.shape[0] == 0:
+        return 0
+    try:
+        table = pa.Table.from_pandas(typed_frame(df, dtypes), preserve_index=False)
+        # several workers write into the same partitions, so each call gets its own file names
+        basename = f"part-{os.getpid()}-{uuid.uuid4().hex}-{{i}}.parquet"
+        pq.write_to_dataset(table, root_path=storedir, partition_cols=PARTITION_COLS,
+                            basename_template=basename)
+        return df.shape[0]
+    except:
+        msg = f"{Utilities.get_fname()}  error writing {storedir}"
+        msg += Utilities.err_info()
+        Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
+        return -1
+
+
+def read_holdings(storedir, year=None, month=None, form=None, columns=None, where=None):
+    return read_frame(storedir, HOLDINGS_DTYPES, year=year, month=month, form=form, columns=columns, where=where)
+
+
+def read_frame(storedir, dtypes, year=None, month=None, form=None, columns=None, where=None):
+    # one read of the whole dataset, the partition filters skip the other directories.
+    # where is a pyarrow.compute expression on any column, the row groups it rules out
+    # by their statistics are not read
+    import pyarrow.parquet as pq
+    filters = []
+    for col, val in zip(PARTITION_COLS, [year, month, form]):
+        if val is None:
+            continue
+        vals = list(val) if isinstance(val, (list, tuple, set)) else [val]
+        filters.append((col, "in", vals))
+    filters = filters if len(filters) > 0 else None
+    if where is not None:
+        filters = where if filters is None else pq.filters_to_expression(filters) & where
+    df = pd.read_parquet(storedir, columns=columns, filters=filters)
+    for col in PARTITION_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype(str).astype(dtypes[col])
+    return df[[col for col in dtypes if col in df.columns]]
+
+
+def restates(filings):
+    # 13F-HR/A (stored as 13F-HR_A) that are not NEW HOLDINGS amendments
+    amended = filings["form"].astype(str).str.endswith(("/A", "_A"))
+    added = filings["amendmentType"].astype(str).str.upper().str.strip() == "NEW HOLDINGS"
+    return amended & ~added
+
+
+def store_files(storedir, year=None, month=None, form=None):
+    # parquet files of the dataset, walking only the wanted partitions
+    wanted = {"year": year, "month": month, "form": form}
+    res = []
+    for root, dirs, files in os.walk(storedir):
+        keep = []
+        for d in dirs:
+            col, _, val = d.partition("=")
+            want = wanted.get(col)
+            vals = [str(v) for v in (want if isinstance(want, (list, tuple, set)) else [want])]
+            if want is None or val in vals:
+                keep.append(d)
+        dirs[:] = sorted(keep)
+        res += [os.path.join(root, f) for f in sorted(files) if f.endswith(".parquet")]
+    return res
+
+
+def store_source(fpath, storedir):
+    # a parquet file's path in the dataset, the key of the loader and index checkpoints
+    return PurePath(os.path.relpath(fpath, storedir)).as_posix()
+
+
+def read_store_file(fpath, storedir, columns=None):
+    # a single parquet file with its partition values put back from the path
+    df = pd.read_parquet(fpath, columns=None if columns is None else
+                         [col for col in columns if col not in PARTITION_COLS])
+    for part in PurePath(os.path.relpath(fpath, storedir)).parts[:-1]:
+        col, _, val = part.partition("=")
+        if col in PARTITION_COLS and (columns is None or col in columns):
+            df[col] = val
+    return df
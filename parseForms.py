@@ -5,13 +5,19 @@ import psutil
 from pathlib import PurePath
 import pandas as pd
 import logging
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+import time
 import threading
 import xml.etree.ElementTree as ET
 import io
+import cProfile
 from utilities import Utilities
+import holdingsStore
+import pipelineMetrics
+import formParsers
 
-def holdings_to_pandas(etree, fname, outLogName, errLogName, verbosity=0):
+def holdings_to_pandas(etree, fname, outLogName, errLogName, verbosity=0, timer=None):
     if verbosity > 1:
         logger = logging.getLogger(outLogName)
         logger.info("{0} {1}".format(Utilities.get_fname(), fname))
@@ -19,21 +25,31 @@ def holdings_to_pandas(etree, fname, outLogName, errLogName, verbosity=0):
     table = False
     tups = []
     tup = {}
-    for p in etree.iter() :
-        if re.search("infoTable", p.tag):
-          table = True
-          if len(tup.keys()) > 0:
-            tups.append(tup)
-            tup = {}
-        elif table:
-          tag = re.sub("{.*}", "", p.tag).strip()
-          tag.replace("\n","")
-          tag.replace("\t","")
-          if len(tag) > 0:
-            tup[tag] = p.text
-
-    tups.append(tup)
+    with pipelineMetrics.stage(timer, "xml"):
+        for p in etree.iter() :
+            if re.search("infoTable", p.tag):
+              table = True
+              if len(tup.keys()) > 0:
+                tups.append(tup)
+                tup = {}
+            elif table:
+              tag = re.sub("{.*}", "", p.tag).strip()
+              tag.replace("\n","")
+              tag.replace("\t","")
+              if len(tag) > 0:
+                tup[tag] = p.text
 
+        tups.append(tup)
+    with pipelineMetrics.stage(timer, "frame"):
+        return holdings_rows_to_pandas(tups, fname, outLogName=outLogName, errLogName=errLogName)
+
+# info table columns as fixed width numbers, the voting counts nullable
+# since some filers leave them out. Everything else is text with few distinct
+# values per filing and is kept as categories
+HOLDINGS_INTS = ["value", "sshPrnamt"]
+HOLDINGS_VOTING = ["Sole", "Shared", "None"]
+
+def holdings_rows_to_pandas(tups, fname, outLogName, errLogName):
     df = pd.DataFrame(tups)
     if df.empty:
         msg = f"{fname}, {Utilities.get_fname()} empty dataframe"
@@ -42,112 +58,420 @@ def holdings_to_pandas(etree, fname, outLogName, errLogName, verbosity=0):
             logger.warning(msg)
         return df
     try:
-        ncols = ["value", "sshPrnamt", "Sole", "Shared", "None"]
-        for ncol in ncols:
-            df[ncol] = df[ncol].astype(int)
+        for ncol in HOLDINGS_INTS:
+            df[ncol] = df[ncol].astype("int64")
+        for ncol in HOLDINGS_VOTING:
+            vals = df[ncol] if ncol in df.columns else pd.Series(None, index=df.index, dtype=object)
+            df[ncol] = pd.to_numeric(vals, errors="coerce").astype("Int64")
         df["value"] = df["value"] * 1000
         sumval = float(df["value"].sum())
         df["wt"] = df["value"]/sumval
         df["perSh"] = df["value"] / df["sshPrnamt"]
+        for col in df.columns:
+            if pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]):
+                df[col] = df[col].astype("category")
         return df
     except:
         msg = f"{fname}, {Utilities.get_fname()}  error processing holdings2pandas"
         msg += Utilities.err_info()
         Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
 
+# header keys picked up while streaming, same as extract_key_values on the fixed text.
+# KEY: lines of the SEC header and <KEY> elements of the cover page both count
+HEADER_KEYS = ["ACCEPTANCE-DATETIME", "STATE", "CITY", "CONFORMED PERIOD OF REPORT", "amendmentType"]
+INFO_TABLE_START = re.compile("<([A-Za-z0-9_]+:)?informationTable[\\s>]")
+INFO_TABLE_END = re.compile("</([A-Za-z0-9_]+:)?informationTable\\s*>")
+# the same searches over the raw bytes of a memory mapped filing
+HEADER_KEYS_B = {key: re.compile(key.encode() + b"(?::|>)(.*)") for key in HEADER_KEYS}
+INFO_TABLE_START_B = re.compile(INFO_TABLE_START.pattern.encode())
+INFO_TABLE_END_B = re.compile(INFO_TABLE_END.pattern.encode())
+BARE_AMPERSAND_B = re.compile(formParsers.BARE_AMPERSAND.pattern.encode())
+
+def info_table_lines(lines, header):
+    # scans the envelope for the header keys and yields only the lines of
+    # the <informationTable> document, trimmed to its start and end tags. Bare
+    # ampersands are escaped, entities like &amp; are left for the XML parser
+    found = False
+    for line in lines:
+        if not found:
+            if len(header) < len(HEADER_KEYS):
+                line = line.replace("<ACCEPTANCE-DATETIME>", "ACCEPTANCE-DATETIME: ")
+                for key in HEADER_KEYS:
+                    if key in header:
+                        continue
+                    match = re.search("(" + key + "(?::|>))(.*)", line)
+                    if match:
+                        header[key] = match.group(2).split("<")[0].strip()
+            match = INFO_TABLE_START.search(line)
+            if not match:
+                continue
+            found = True
+            line = line[match.start():]
+        line = formParsers.BARE_AMPERSAND.sub("&amp;", line)
+        match = INFO_TABLE_END.search(line)
+        if match:
+            yield line[:match.end()]
+            return
+        yield line
+
+def info_table_chunks_mmap(mm, header, chunksize=2**20):
+    # same as info_table_lines but over the bytes of a memory mapped filing,
+    # only the header values and the information table are ever copied out
+    match = INFO_TABLE_START_B.search(mm)
+    start = match.start() if match else len(mm)
+    for key, pattern in HEADER_KEYS_B.items():
+        if key in header:
+            continue
+        kmatch = pattern.search(mm, 0, start)
+        if kmatch:
+            header[key] = kmatch.group(1).decode(errors="replace").split("<")[0].strip()
+    if not match:
+        return
+    match = INFO_TABLE_END_B.search(mm, start)
+    end = match.end() if match else len(mm)
+    # chunks end after a tag so an entity is never cut in two by the escaping
+    pos = start
+    while pos < end:
+        stop = min(pos + chunksize, end)
+        if stop < end:
+            gt = mm.find(b">", stop, end)
+            stop = gt + 1 if gt >= 0 else end
+        yield BARE_AMPERSAND_B.sub(b"&amp;", mm[pos:stop])
+        pos = stop
+
+def iter_info_table(chunks, timer=None):
+    # yields one dict per infoTable as soon as it is closed, chunks can be
+    # str or bytes pieces of the <informationTable> document. With a timer the
+    # parser time goes to its xml stage, the time to get the chunks does not
+    parser = None
+    root = None
+    tup = {}
+    for chunk in chunks:
+        if parser is None:
+            parser = ET.XMLPullParser(events=("start", "end"))
+        start = time.perf_counter() if timer is not None else 0.0
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            tag = elem.tag.rpartition("}")[2].strip()
+            if root is None:
+                root = elem
+            elif "infoTable" in tag:
+                if event == "end":
+                    yield tup
+                    tup = {}
+                    root.clear()
+            elif len(tag) > 0:
+                if event == "start":
+                    tup.setdefault(tag, None)
+                else:
+                    tup[tag] = elem.text
+        if timer is not None:
+            timer.add_time("xml", time.perf_counter() - start)
+    if parser is not None:
+        parser.close()
+
+def iter_holdings(lines, fname, outLogName, errLogName, header=None, verbosity=0, timer=None):
+    # pulls only the <informationTable> document out of the submission envelope
+    # and yields its rows as they are parsed, so the whole filing is never
+    # held in memory
+    if verbosity > 1:
+        logger = logging.getLogger(outLogName)
+        logger.info("{0} {1}".format(Utilities.get_fname(), fname))
+    if header is None:
+        header = {}
+    return iter_info_table(info_table_lines(lines, header), timer=timer)
+
+def iter_holdings_mmap(mm, fname, outLogName, errLogName, header=None, verbosity=0, timer=None):
+    if verbosity > 1:
+        logger = logging.getLogger(outLogName)
+        logger.info("{0} {1}".format(Utilities.get_fname(), fname))
+    if header is None:
+        header = {}
+    return iter_info_table(info_table_chunks_mmap(mm, header), timer=timer)
+
+def parse_form_stream(lines, fname, outLogName, errLogName, header=None, verbosity=0, timer=None):
+    if verbosity > 1:
+        logger = logging.getLogger(outLogName)
+        logger.info("{0} {1}".format(Utilities.get_fname(), fname))
+
+    try:
+        with pipelineMetrics.stage(timer, "read", exclude="xml"):
+            tups = [tup for tup in iter_holdings(lines, fname, outLogName=outLogName, errLogName=errLogName,
+                                                 header=header, verbosity=verbosity, timer=timer)]
+        with pipelineMetrics.stage(timer, "frame"):
+            df = holdings_rows_to_pandas(tups, fname, outLogName=outLogName, errLogName=errLogName)
+        return df
+    except Exception as e:
+        msg = f"{fname}, {Utilities.get_fname()}  error iterparse"
+        msg += Utilities.err_info()
+        Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
+        return None
+
+
+def parse_form_mmap(fpath, fname, outLogName, errLogName, header=None, verbosity=0, timer=None):
+    import mmap
+    if verbosity > 1:
+        logger = logging.getLogger(outLogName)
+        logger.info("{0} {1}".format(Utilities.get_fname(), fname))
+
+    try:
+        tups = []
+        with pipelineMetrics.stage(timer, "read", exclude="xml"), open(fpath, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size > 0:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    tups = [tup for tup in iter_holdings_mmap(mm, fname, outLogName=outLogName, errLogName=errLogName,
+                                                              header=header, verbosity=verbosity, timer=timer)]
+        with pipelineMetrics.stage(timer, "frame"):
+            df = holdings_rows_to_pandas(tups, fname, outLogName=outLogName, errLogName=errLogName)
+        return df
+    except Exception as e:
+        msg = f"{fname}, {Utilities.get_fname()}  error iterparse"
+        msg += Utilities.err_info()
+        Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
+        return None
+
+# compressed filings cost about this many times their size on disk to parse
+COMPRESSED_COST = 8
+
+def plan_batches(sdir, txtfiles, ncpu, targetBytes=None, maxFiles=50):
+    # groups files into (cost, files) work units of about targetBytes, biggest first, so an
+    # 80MB holdings report runs on its own while 13F-NT notices go in bulk and
+    # the pool drains evenly. By default there are ~4 units per worker.
+    costs = []
+    for fname in txtfiles:
+        size = os.path.getsize(os.path.join(sdir, fname))
+        if fname.endswith(".gz") or fname.endswith(".zst"):
+            size *= COMPRESSED_COST
+        costs.append((size, fname))
+    costs.sort(reverse=True)
+    if targetBytes is None:
+        total = sum(c for c, f in costs)
+        targetBytes = min(64 * 2**20, max(2**20, total // max(1, ncpu * 4)))
+    batches = []
+    batch = []
+    batchBytes = 0
+    for size, fname in costs:
+        if size >= targetBytes:
+            batches.append((size, [fname]))
+            continue
+        batch.append(fname)
+        batchBytes += size
+        if batchBytes >= targetBytes or len(batch) >= maxFiles:
+            batches.append((batchBytes, batch))
+            batch = []
+            batchBytes = 0
+    if len(batch) > 0:
+        batches.append((batchBytes, batch))
+    return batches
 
-def parallel_parse(sdir, outLogName, errLogName, ncpu=None, verbosity=0):
+def parallel_parse(sdir, outLogName, errLogName, ncpu=None, verbosity=0, storedir=None,
+                   targetBytes=None, maxFiles=50, metrics=None, profile=None, use_mmap=False):
+    return parse_all([sdir], outLogName=outLogName, errLogName=errLogName, ncpu=ncpu, verbosity=verbosity,
+                     storedir=storedir, targetBytes=targetBytes, maxFiles=maxFiles, metrics=metrics,
+                     profile=profile, use_mmap=use_mmap)
+
+def parse_all(sdirs, outLogName, errLogName, ncpu=None, verbosity=0, storedir=None,
+              targetBytes=None, maxFiles=50, maxPending=None, metrics=None, profile=None, use_mmap=False):
+    # one long lived process pool for every day directory. Work units from all
+    # directories go through it biggest first, at most maxPending at a time, so
+    # the workers import pandas once and memory stays capped. Each daily index
+    # is read once here, while the units are planned a day at a time, and only
+    # the rows of the files in each unit are kept until it is sent. With a
+    # pipelineMetrics.RunMetrics the workers time every filing and send the
+    # records back with their stats. A pipelineMetrics.ProfileReport also has
+    # them run cProfile over its fraction of the files and send the profiles back.
+    # use_mmap goes to parse_forms, the holdings are read through mmap
     if verbosity > 0:
         logger = logging.getLogger(outLogName)
-        logger.info(f"{Utilities.get_fname()}  ddir: {sdir}  {Utilities.now()}")
+        logger.info(f"{Utilities.get_fname()}  {len(sdirs)} dirs  {Utilities.now()}")
 
     if ncpu is None:
         ncpu = psutil.cpu_count()
+    if maxPending is None:
+        maxPending = 2 * ncpu
+
+    # sdirs grouped by day, so a day's form directories share the cached daily
+    # index map and the whole day's map is never held for the length of the run
+    units = []
+    for sdir in sorted(sdirs):
+        txtfiles = [f for f in os.listdir(sdir) if Utilities.filing_stem(f) is not None]
+        tpath = daily_index_path(sdir)
+        index = daily_index_map(tpath) if os.path.isfile(tpath) else None
+        parser = formParsers.parser_for(os.path.basename(os.path.normpath(sdir)))
+        dirMaxFiles = parser.maxFiles if parser is not None and parser.maxFiles is not None else maxFiles
+        for cost, batch in plan_batches(sdir, txtfiles, ncpu, targetBytes=targetBytes, maxFiles=dirMaxFiles):
+            entries = batch_entries(index, batch) if index is not None else None
+            units.append((cost, sdir, batch, entries))
+    units.sort(key=lambda x: x[0], reverse=True)
 
-    txtfiles = [f for f in os.listdir(sdir) if f.endswith(".txt")]
-    nrows = 20
-    start = 0
-    end = nrows
-    futures = []
-    ranges = []
     func = parse_forms
     pool_executor = ProcessPoolExecutor
-    fi = 0
-    files = {}
+    stats = Utilities.new_stats(parsed=0, rows=0, batches=0, failedBatches=0)
+    dirstats = {}
+    errors = []
+    starttime = time.time()
+    nextunit = 0
+    pending = {}
     with pool_executor(max_workers=ncpu) as executor:
-        while start < len(txtfiles):
-            try:
-                #print(start)
-                files[fi] = txtfiles[start:end]
-                future =  executor.submit(func, txtfiles=files[fi], sdir=sdir, verbosity=verbosity,
-                                          outLogName=outLogName, errLogName=errLogName)
-                futures.append(future)
-                ranges.append((start, end))
-                #print(len(futures), start, end)
-                start = end
-                end = min(end+nrows, len(txtfiles))
-                fi += 1
-            except:
-                msg = Utilities.err_info()
-                Utilities.log_msg(level=logging.ERROR, loggers=[executor, outLogName], msg=msg)
-    ndone = 0
-    while ndone < len(futures):
-        ndone = 0
-        for i, f in enumerate(futures):
-            if not f.done():
-                msg = f"not done with batch {i}"
-            else:
-                ndone += 1
-    return
+        while nextunit < len(units) or len(pending) > 0:
+            while nextunit < len(units) and len(pending) < maxPending:
+                cost, sdir, batch, entries = units[nextunit]
+                # the unit's index rows go with it, nothing here holds on to them
+                units[nextunit] = None
+                nextunit += 1
+                future =  executor.submit(func, txtfiles=batch, sdir=sdir, verbosity=verbosity,
+                                          outLogName=outLogName, errLogName=errLogName, storedir=storedir,
+                                          use_mmap=use_mmap, entries=entries, timed=metrics is not None or profile is not None,
+                                          profile=profile.fraction if profile is not None else 0.0)
+                pending[future] = (sdir, batch)
+            # blocks until a unit finishes, then tops the queue back up
+            done, notdone = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                sdir, batch = pending.pop(future)
+                dstats = dirstats.setdefault(sdir, Utilities.new_stats(parsed=0, rows=0, batches=0,
+                                                                        failedBatches=0))
+                stats["batches"] += 1
+                dstats["batches"] += 1
+                try:
+                    res = future.result()
+                    records = res.pop("metrics", [])
+                    if metrics is not None:
+                        metrics.add(records)
+                    if profile is not None:
+                        profile.add(res.pop("profile", None), records)
+                    Utilities.add_stats(stats, res)
+                    Utilities.add_stats(dstats, res)
+                    if verbosity > 1:
+                        logger = logging.getLogger(outLogName)
+                        logger.info(f"{Utilities.get_fname()}  {sdir}  batch {batch[0]}  {res}")
+                except Exception as e:
+                    for st in [stats, dstats]:
+                        st["failedBatches"] += 1
+                        st["failures"] += len(batch)
+                    errors.append(e)
+                    msg = f"{Utilities.get_fname()}  {sdir}  batch of {len(batch)} from {batch[0]} failed: {repr(e)}"
+                    for lname in [outLogName, errLogName]:
+                        logger = logging.getLogger(lname)
+                        logger.error(msg)
+    stats["elapsed"] = time.time() - starttime
+    if verbosity > 0:
+        logger = logging.getLogger(outLogName)
+        for sdir in sorted(dirstats.keys()):
+            logger.info(f"{Utilities.get_fname()}  ddir: {sdir}  {dirstats[sdir]}")
+        logger.info(f"{Utilities.get_fname()}  {len(sdirs)} dirs  {stats}")
+    if len(errors) > 0:
+        msg = f"{len(errors)} of {stats['batches']} batches failed in {len(sdirs)} dirs, {stats}"
+        raise RuntimeError(msg) from errors[0]
+    return stats
+
+def daily_index_path(sdir):
+    # the daily file is in basedir/year/month
+    # but the txt files are in basedir/year/month/day/form
+    pparts = PurePath(sdir).parts
+    year, month, day = pparts[1:4]
+    month = month.zfill(2)
+    day = day.zfill(2)
+    tparts = list(pparts[:3]) + [f"secFilings_{year}{month}{day}.csv"]
+    return PurePath(*tparts)
+
+def filing_key(fname):
+    # (CIK, fid) from company_CIK<cik>_FID<fid>.txt
+    fparts = Utilities.filing_stem(fname).split("_")
+    CIK = int(fparts[len(fparts)-2][3:])
+    fid = fparts[len(fparts)-1][3:]
+    return CIK, fid
+
+# daily index columns carried onto the holdings of each filing
+ENTRY_COLS = ["company"]
+
+@lru_cache(maxsize=8)
+def daily_index_map(tpath):
+    # (CIK, fid) -> daily index row, built once per day with one pass over the csv
+    dailydf = pd.read_csv(tpath, dtype={"CIK": "int64", "fid": str})
+    dailydf = dailydf.drop_duplicates(subset=["CIK", "fid"])
+    keys = zip(dailydf["CIK"].tolist(), dailydf["fid"].tolist())
+    return dict(zip(keys, dailydf.to_dict("records")))
+
+def batch_entries(index, txtfiles):
+    # only the index rows a batch needs, so workers are not sent the whole day
+    entries = {}
+    for fname in txtfiles:
+        try:
+            key = filing_key(fname)
+        except:
+            continue
+        if key in index:
+            entries[key] = index[key]
+    return entries
 
 def parse_forms(sdir, outLogName, errLogName,
-                txtfiles, verbosity=0, files=None):
+                txtfiles, verbosity=0, files=None, stream=True, use_mmap=False, storedir=None, entries=None,
+                timed=False, profile=0.0):
     if verbosity > 0:
         logger = logging.getLogger(outLogName)
         msg = f"{Utilities.get_fname()}  ddir: {sdir}  {Utilities.now()}"
         msg += f"  pid: {os.getpid()}  threadid: {threading.get_ident()}"
         msg += txtfiles[0]
         print(msg)
+    stats = Utilities.new_stats(files=len(txtfiles), parsed=0, rows=0)
+    starttime = time.time()
 
-    # the daily file is in basedir
-    # but the txt files are in basedir/ddir or fdir
-    # confusing!
-    ppath = PurePath(sdir)
-    pparts = ppath.parts
+    pparts = PurePath(sdir).parts
     year, month, day = pparts[1:4]
     month = month.zfill(2)
     day = day.zfill(2)
-    tparts = list(pparts[:3]) + [f"secFilings_{year}{month}{day}.csv"]
-    tpath = PurePath(*tparts)
-    if not os.path.isfile(tpath):
-        msg = f"can't find {tpath}"
-        Utilities.log_msg(msg=msg, loggers=[errLogName, outLogName], level=logging.INFO)
-        return -1
-    dailydf = pd.read_csv(tpath)
+    if entries is None:
+        # not handed the index rows by parse_all, look them up ourselves
+        tpath = daily_index_path(sdir)
+        if not os.path.isfile(tpath):
+            msg = f"can't find {tpath}"
+            stats["failures"] = len(txtfiles)
+            Utilities.log_msg(msg=msg, loggers=[errLogName, outLogName], level=logging.INFO)
+            return stats
+        entries = daily_index_map(tpath)
+    form = pparts[4] if len(pparts) > 4 else None
+    # the form type directory picks the parser, see formParsers.PARSERS
+    parser = formParsers.parser_for(form if form is not None else "13F-HR")
+    if parser is None:
+        stats["skipped"] = len(txtfiles)
+        Utilities.log_msg(msg=f"{Utilities.get_fname()}  no parser for {form} in {sdir}",
+                          loggers=[outLogName], level=logging.INFO)
+        return stats
+    storedfs = []
+    # with timed, one pipelineMetrics record per filing and per parquet write goes back in stats.
+    # profile is the fraction of the files run under cProfile, their profile goes back too
+    records = []
+    profiler = cProfile.Profile() if profile > 0 else None
+    nprofiled = 0
     for ti, fname in enumerate(txtfiles):
         if verbosity > 1:
             msg = f"{ti}, {fname}"
             Utilities.log_msg(msg=msg, loggers=[errLogName, outLogName], level=logging.INFO)
+        timer = None
+        if timed:
+            timer = pipelineMetrics.FilingTimer(fname, form=form)
+            records.append(timer.record)
+        if profiler is not None:
+            # on for the sampled files only, until the top of the next iteration
+            profiler.disable()
+            if pipelineMetrics.profile_sampled(fname, profile):
+                nprofiled += 1
+                if timer is not None:
+                    timer.record["profiled"] = True
+                profiler.enable()
+        entry = {}
         try:
-            fparts = os.path.splitext(fname)[0].split("_")
-            CIK = fparts[len(fparts)-2][3:]
-            CIK = int(CIK)
-            fid = fparts[len(fparts)-1][3:]
-            cdf = dailydf.loc[dailydf["CIK"] == CIK]
-            entry = cdf.loc[cdf["fid"] == fid]
+            CIK, fid = filing_key(fname)
+            entry = entries.get((CIK, fid), {})
+            if len(entry) == 0:
+                logger = logging.getLogger(outLogName)
+                logger.warning(f"{fname}, {Utilities.get_fname()}  not in the daily index")
         except:
             msg = f"{fname}, {Utilities.get_fname()}  error parsing"
             msg += Utilities.err_info()
             Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
         fpath = os.path.join(sdir, fname)
         try:
-            with open(fpath, "r") as fp:
-                html_orig = fp.read()
-            html_fixed = fixup(html_orig, outLogName, errLogName, verbosity=verbosity)
-            outname = os.path.splitext(fname)[0]+ "_fixed.txt"
-            outpath = os.path.join(sdir,  outname)
-            with open(outpath, "w") as fp:
-                fp.write(html_fixed)
             def extract_key_values(text, keys=None, sep=":"):
                 res = {}
                 for key in keys:
@@ -157,44 +481,112 @@ def parse_forms(sdir, outLogName, errLogName,
                         value = match.group(2).strip()
                         res[key] = value
                 return res
-            hdf = parse_form(html_fixed, fname=fname, outLogName=outLogName, errLogName=errLogName, verbosity=verbosity)
-            if not isinstance(hdf, pd.DataFrame) or hdf.shape[0] == 0:
+            if timer is not None:
+                timer.add(bytes=os.path.getsize(fpath))
+            if stream or use_mmap or parser.dataset != "holdings":
+                keyvals = {}
+                hdf = parser(fpath, fname, outLogName, errLogName, header=keyvals, timer=timer, use_mmap=use_mmap,
+                             verbosity=verbosity)
+            else:
+                with pipelineMetrics.stage(timer, "read"), Utilities.open_filing(fpath, "rt") as fp:
+                    html_orig = fp.read()
+                with pipelineMetrics.stage(timer, "fixup"):
+                    html_fixed = fixup(html_orig, outLogName, errLogName, verbosity=verbosity)
+                outname = Utilities.filing_stem(fname) + "_fixed.txt"
+                outpath = os.path.join(sdir,  outname)
+                with open(outpath, "w") as fp:
+                    fp.write(html_fixed)
+                hdf = parse_form(html_fixed, fname=fname, outLogName=outLogName, errLogName=errLogName,
+                                 verbosity=verbosity, timer=timer)
+                keyvals = extract_key_values(html_fixed, keys=HEADER_KEYS)
+            # row dicts from the parsers of small forms, see formParsers.FormParser
+            rowwise = isinstance(hdf, list)
+            if not rowwise and not isinstance(hdf, pd.DataFrame):
+                stats["failures"] += 1
+                continue
+            elif len(hdf) == 0:
                 continue
 
-            keys = ["ACCEPTANCE-DATETIME", "STATE", "CITY"]
-            keyvals = extract_key_values(html_fixed, keys=keys)
-            hdf["year"] = int(year)
-            hdf["month"] = int(month)
-            hdf["day"] = int(day)
-            hdf["filingDt"] = datetime.datetime(int(year), int(month), int(day))
+            filing = {"year": int(year), "month": int(month), "day": int(day),
+                      "filingDt": datetime.datetime(int(year), int(month), int(day))}
             try:
                 key = "ACCEPTANCE-DATETIME"
                 filingDt = datetime.datetime.strptime(keyvals[key], "%Y%m%d%H%M%S")
-                hdf["filingDt"] = filingDt
+                filing["filingDt"] = filingDt
             except:
                 key = "ACCEPTANCE-DATETIME"
-                msg = f" bad Acceptance-datetime {keyvals[key]}"
+                msg = f" bad Acceptance-datetime {keyvals.get(key)}"
                 Utilities.log_msg(msg=msg, loggers=[errLogName, outLogName], level=logging.WARNING)
-
-            if not isinstance(hdf, pd.DataFrame):
-                logger = logging.getLogger("forms")
-                logger.warning(f"{fname}, None from parse_form")
-                continue
-            elif hdf.shape[0] == 0:
-                logger = logging.getLogger("forms")
-                logger.warning(f"{fname}, empty dataframe from parse_form ")
-                continue
+            # the quarter the holdings are for, and for a 13F-HR/A whether it
+            # restates the earlier filing or adds new holdings to it
+            filing["period"] = pd.to_datetime(keyvals.get("CONFORMED PERIOD OF REPORT"), format="%Y%m%d",
+                                              errors="coerce")
+            filing["amendmentType"] = keyvals.get("amendmentType")
+            stats["parsed"] += 1
+            stats["rows"] += len(hdf)
+            if timer is not None:
+                timer.add(rows=len(hdf))
+            filing["CIK"] = CIK
+            filing["fid"] = fid
+            for col in ENTRY_COLS:
+                filing[col] = entry.get(col)
+            if storedir is not None:
+                filing["form"] = form
+            if rowwise:
+                for row in hdf:
+                    row.update(filing)
             else:
-                csvname = os.path.splitext(fname)[0] + "_" + str(CIK) + "_" + str(fid) + ".csv"
+                for col, val in filing.items():
+                    hdf[col] = val
+            if storedir is not None:
+                storedfs.append(hdf)
+            else:
+                if rowwise:
+                    with pipelineMetrics.stage(timer, "frame"):
+                        hdf = formParsers.records_frame(hdf, parser.columns, keep=filing)
+                csvname = Utilities.filing_stem(fname) + "_" + str(CIK) + "_" + str(fid) + ".csv"
                 csvpath = os.path.join(sdir, csvname)
                 if verbosity > 0:
                     print(csvpath)
-                hdf.to_csv(csvpath, index=None)
+                with pipelineMetrics.stage(timer, "store"):
+                    hdf.to_csv(csvpath, index=None)
         except Exception as e:
+            stats["failures"] += 1
             msg = f"{fname}, {Utilities.get_fname()}  error parsing"
             msg += Utilities.err_info()
             Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
-    return
+    if profiler is not None:
+        profiler.disable()
+        if nprofiled > 0:
+            profiler.create_stats()
+            stats["profile"] = profiler.stats
+    if len(storedfs) > 0:
+        # one parquet file per batch instead of one csv per filing
+        timer = pipelineMetrics.FilingTimer(None, form=form, filings=len(storedfs)) if timed else None
+        if parser.columns is not None:
+            # the row dicts of the whole batch framed at once
+            with pipelineMetrics.stage(timer, "frame"):
+                batch = formParsers.records_frame([row for rows in storedfs for row in rows], parser.columns,
+                                                  keep=holdingsStore.FILING_DTYPES)
+        else:
+            batch = holdingsStore.concat_holdings(storedfs)
+        with pipelineMetrics.stage(timer, "store"):
+            nrows = holdingsStore.write_frame(batch,
+                                              formParsers.dataset_dir(storedir, parser.dataset), parser.dtypes,
+                                              outLogName=outLogName, errLogName=errLogName, verbosity=verbosity)
+        if nrows < 0:
+            stats["failures"] += len(storedfs)
+        if timer is not None:
+            timer.add(rows=max(nrows, 0))
+            records.append(timer.record)
+    stats["elapsed"] = time.time() - starttime
+    if timed:
+        stats["metrics"] = records
+    return stats
+
+XML_PROLOG = re.compile("<\\?xml.*\\?>")
+# tags that come without a closing tag, with a lookahead on the next tag in the line
+NOEND_TAGS = re.compile("<(TYPE|SEQUENCE|FILENAME|DESCRIPTION)>[^<]*(?=(<.*>))")
 
 def fixup(html, outLogName, errLogName, verbosity=0):
     if verbosity > 1:
@@ -205,48 +597,46 @@ def fixup(html, outLogName, errLogName, verbosity=0):
         # this string does not have closing tag
         if verbosity > 1:
             logger.info("  {0} replacing texts".format(Utilities.get_fname()))
-        html = re.sub("<\?xml.*\?>", "", html)
-        html = re.sub("&", "and", html)
-        html = re.sub("<ACCEPTANCE-DATETIME>", "ACCEPTANCE-DATETIME: ", html)
+        html = XML_PROLOG.sub("", html)
+        html = html.replace("&", "and")
+        html = html.replace("<ACCEPTANCE-DATETIME>", "ACCEPTANCE-DATETIME: ")
 
         # now fixup knows issues with missing tags
-
-        noends = ["TYPE", "SEQUENCE", "FILENAME", "DESCRIPTION"]
-        tups = []
-        for ne in noends:
-            ms = [*re.finditer(f"<({ne})>([^<]*)(<.*>)", html)]
-            for i, m in enumerate(ms):
-                one = f"</{m.group(1)}>"
-                three = m.group(3)
-                tups.append((m.start(), m.end(), m.group(1), one,  m.group(3)))
-        rdf = pd.DataFrame(tups, columns=["start", "end", "grp1", "one", "grp3"])
-        rdf.sort_values(by="start", inplace=True)
-        newhtml = ''
+        # a match swallows the next tag in its line, so a second opening
+        # of the same tag inside that stretch is not a match of its own
+        newhtml = []
         laststart = 0
-        for idx, row in rdf.iterrows():
-            if row["one"] != row["grp3"]:
-                pos = row["end"] - len(row["grp3"])
-                newstr = row["one"] + "\n"
-                newhtml += html[laststart:pos] + newstr
+        nextstart = {}
+        for m in NOEND_TAGS.finditer(html):
+            tag, nexttag = m.group(1, 2)
+            if m.start() < nextstart.get(tag, 0):
+                continue
+            nextstart[tag] = m.end() + len(nexttag)
+            one = f"</{tag}>"
+            if one != nexttag:
+                pos = m.end()
+                newhtml.append(html[laststart:pos])
+                newhtml.append(one + "\n")
                 laststart = pos
-        newhtml += html[laststart:]  # m.group(3).start()] + f"</{m.group(1)}>"
-        return newhtml
+        newhtml.append(html[laststart:])
+        return "".join(newhtml)
     except:
         msg = f"{Utilities.get_fname()}  error parsing"
         msg += Utilities.err_info()
         Utilities.log_msg(msg, loggers=[outLogName, errLogName], level=logging.ERROR)
         return None
 
-def parse_form(html, fname, outLogName, errLogName, verbosity=0):
+def parse_form(html, fname, outLogName, errLogName, verbosity=0, timer=None):
     if verbosity > 1:
         logger = logging.getLogger(outLogName)
         logger.info("{0} {1}".format(Utilities.get_fname()))
 
     try:
-        lines = html.split("\n")
-        xml_data = io.StringIO(html)
-        etree = ET.parse(xml_data)  # create an ElementTree object
-        df = holdings_to_pandas(etree, fname, outLogName=outLogName, errLogName=errLogName, verbosity=verbosity)
+        with pipelineMetrics.stage(timer, "xml"):
+            xml_data = io.StringIO(html)
+            etree = ET.parse(xml_data)  # create an ElementTree object
+        df = holdings_to_pandas(etree, fname, outLogName=outLogName, errLogName=errLogName, verbosity=verbosity,
+                                timer=timer)
         return df
     except Exception as e:
         with open("html2.txt", 'w') as fp:
@@ -262,22 +652,35 @@ if __name__ == "__main__":
     errLogName = "parseErr"
     Utilities.setup_logging(outLogName=outLogName, errLogName=errLogName)
     basedir = "./data"
+    # set to e.g. os.path.join(basedir, "holdings") to write a parquet store instead of csvs,
+    # the datasets of the other form types go next to it (formParsers.dataset_dir)
+    storedir = None
+    # per filing stage timings as json lines, the run's aggregates for a Prometheus textfile collector
+    metrics = pipelineMetrics.RunMetrics(
+        jsonPath=os.path.join(basedir, "metrics", f"parse_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.jsonl"),
+        promPath=os.path.join(basedir, "metrics", "parse.prom"))
+    # set to pipelineMetrics.ProfileReport(fraction=0.05) to run cProfile over a sample of the files in the workers
+    profile = None
+    # set to True to read the holdings filings through mmap instead of the line stream
+    use_mmap = False
     sdirs = Utilities.sub_dirs_with_files(basedir, fname_incl=".txt")
-    # for now only 13F files
-    sdirs = [x for x in sdirs if re.search("13F", x)]
+    # the form types with a parser, see formParsers.PARSERS
+    sdirs = [x for x in sdirs if formParsers.parser_for(os.path.basename(x)) is not None]
     sdirs = sorted(sdirs)
-    for sdir in sdirs:
-        ppath = PurePath(sdir)
-        pparts = ppath.parts
-        print(pparts)
-        for lname in [outLogName, errLogName]:
-            logger = logging.getLogger(lname)
-            logger.info(f"--{sdir}--")
-        try:
-            parallel_parse(sdir=sdir, outLogName=outLogName,
-                           errLogName=errLogName, verbosity=1, ncpu=None)
-        except Exception as e:
-            print(Utilities.err_info())
-            print("")
+    for lname in [outLogName, errLogName]:
+        logger = logging.getLogger(lname)
+        logger.info(f"--{len(sdirs)} dirs--")
+    try:
+        stats = parse_all(sdirs, outLogName=outLogName,
+                          errLogName=errLogName, verbosity=1, ncpu=None, storedir=storedir, metrics=metrics,
+                          profile=profile, use_mmap=use_mmap)
+        print(stats)
+        metrics.close(outLogName)
+        if profile is not None:
+            print(profile.report())
+            profile.write(os.path.join(basedir, "metrics", "parse_profile.txt"))
+    except Exception as e:
+        print(Utilities.err_info())
+        print("")
     print("done {0}".format(datetime.datetime.now()))
 
@@ -0,0 +1,229 @@
+import os
+import json
+import uuid
+import logging
+import threading
+import contextlib
+import pandas as pd
+from time import perf_counter
+from utilities import Utilities
+
+# hot path stages a filing can go through, in pipeline order. fetch and write
+# are the download, read to store the parse. read is the file read and the
+# envelope scan, xml the XML parse, frame the DataFrame build and store the
+# csv/parquet write
+STAGES = ["fetch", "write", "read", "fixup", "xml", "frame", "store"]
+COUNTS = ["bytes", "rows"]
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class FilingTimer(object):
+    # stage seconds, bytes and rows of one filing (or one batch write), kept as a
+    # plain dict so it pickles back from pool workers with the batch stats
+    def __init__(self, fname, **labels):
+        self.record = {"file": fname, "pid": os.getpid()}
+        self.record.update(labels)
+
+    @contextlib.contextmanager
+    def stage(self, name, exclude=None):
+        # exclude is a stage timed inside this block, its time is not counted twice
+        start = perf_counter()
+        inner = self.record.get(exclude, 0.0)
+        try:
+            yield self
+        finally:
+            self.add_time(name, perf_counter() - start - (self.record.get(exclude, 0.0) - inner))
+
+    def add_time(self, name, seconds):
+        self.record[name] = self.record.get(name, 0.0) + seconds
+
+    def add(self, **counts):
+        for key, val in counts.items():
+            self.record[key] = self.record.get(key, 0) + val
+
+
+def stage(timer, name, exclude=None):
+    # times the block into timer, or nothing when the caller is not timing
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.stage(name, exclude=exclude)
+
+
+class RunMetrics(object):
+    # the records of one run. Each record goes out as a json line when added and
+    # summary() aggregates them per stage, write_prometheus() puts the aggregates
+    # in a Prometheus textfile collector file. Threads can add concurrently
+    def __init__(self, jsonPath=None, promPath=None, run=None):
+        self.jsonPath = jsonPath
+        self.promPath = promPath
+        self.run = run if run is not None else f"{Utilities.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.records = []
+        self.lock = threading.Lock()
+        self.start = perf_counter()
+        if jsonPath is not None and os.path.dirname(jsonPath) != "":
+            os.makedirs(os.path.dirname(jsonPath), exist_ok=True)
+
+    def timer(self, fname, **labels):
+        return FilingTimer(fname, **labels)
+
+    def add(self, records):
+        records = [r.record if isinstance(r, FilingTimer) else r for r in records]
+        with self.lock:
+            self.records.extend(records)
+            if self.jsonPath is not None and len(records) > 0:
+                with open(self.jsonPath, "a") as fp:
+                    for record in records:
+                        fp.write(json.dumps(dict(record, run=self.run), default=str) + "\n")
+
+    def summary(self):
+        # one row per stage: records timed, total and percentile seconds, share of
+        # the timed total, and the bytes and rows of the records that went through it
+        with self.lock:
+            df = pd.DataFrame(self.records)
+        tups = []
+        for name in STAGES:
+            if name not in df.columns:
+                continue
+            sub = df.loc[df[name].notna()]
+            secs = sub[name].astype(float)
+            tup = {"stage": name, "n": sub.shape[0], "seconds": secs.sum()}
+            for q in QUANTILES:
+                tup[f"p{int(q * 100)}"] = secs.quantile(q)
+            tup["max"] = secs.max()
+            for key in COUNTS:
+                tup[key] = int(sub[key].fillna(0).sum()) if key in sub.columns else 0
+            tups.append(tup)
+        res = pd.DataFrame(tups)
+        if res.shape[0] > 0:
+            res["share"] = res["seconds"] / res["seconds"].sum()
+            res["MB/s"] = res["bytes"] / 2**20 / res["seconds"].where(res["seconds"] > 0)
+            res["rows/s"] = res["rows"] / res["seconds"].where(res["seconds"] > 0)
+        return res
+
+    def write_prometheus(self, promPath=None):
+        # text exposition format, written to a temp file and renamed so a
+        # scraper never reads half a file
+        promPath = promPath if promPath is not None else self.promPath
+        if promPath is None:
+            return None
+        summary = self.summary()
+        lines = ["# HELP edgar_stage_seconds Seconds per filing or batch spent in a pipeline stage.",
+                 "# TYPE edgar_stage_seconds summary"]
+        for row in summary.itertuples(index=False):
+            for q in QUANTILES:
+                val = getattr(row, f"p{int(q * 100)}")
+                lines.append(f'edgar_stage_seconds{{stage="{row.stage}",quantile="{q}"}} {val:.6f}')
+            lines.append(f'edgar_stage_seconds_sum{{stage="{row.stage}"}} {row.seconds:.6f}')
+            lines.append(f'edgar_stage_seconds_count{{stage="{row.stage}"}} {row.n}')
+        for key in COUNTS:
+            lines += [f"# HELP edgar_stage_{key}_total {key.capitalize()} that went through a pipeline stage.",
+                      f"# TYPE edgar_stage_{key}_total counter"]
+            for row in summary.itertuples(index=False):
+                lines.append(f'edgar_stage_{key}_total{{stage="{row.stage}"}} {getattr(row, key)}')
+        lines += ["# HELP edgar_run_seconds Wall clock seconds of the run.",
+                  "# TYPE edgar_run_seconds gauge",
+                  f'edgar_run_seconds{{run="{self.run}"}} {perf_counter() - self.start:.3f}']
+        if os.path.dirname(promPath) != "":
+            os.makedirs(os.path.dirname(promPath), exist_ok=True)
+        with open(promPath + ".tmp", "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(promPath + ".tmp", promPath)
+        return promPath
+
+    def log_summary(self, outLogName):
+        summary = self.summary()
+        if summary.shape[0] == 0:
+            return summary
+        logger = logging.getLogger(outLogName)
+        logger.info(f"{Utilities.get_fname()}  run {self.run}  {len(self.records)} records\n"
+                    + summary.round(4).to_string(index=False))
+        return summary
+
+    def close(self, outLogName=None):
+        if outLogName is not None:
+            self.log_summary(outLogName)
+        self.write_prometheus()
+
+
+def profile_sampled(fname, fraction):
+    # whether a file is in the profiled sample. Decided by a hash of the name so
+    # a rerun profiles the same files and every worker agrees without talking
+    import zlib
+    if fraction <= 0:
+        return False
+    return zlib.crc32(str(fname).encode()) < fraction * 2**32
+
+
+class LoadedStats(object):
+    # cProfile stats sent back from a worker, in the shape pstats.Stats loads
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class ProfileReport(object):
+    # cProfile in the parse workers for a fraction of the files, merged here into
+    # one report with the top slowest filings and their stage times. The workers
+    # send their raw profile stats back with the batch stats, see parseForms.parse_all
+    def __init__(self, fraction=0.05, top=10, sortby="cumulative"):
+        self.fraction = fraction
+        self.top = top
+        self.sortby = sortby
+        self.stats = None
+        self.records = []
+
+    def add(self, profile=None, records=()):
+        import pstats
+        if profile:
+            if self.stats is None:
+                self.stats = pstats.Stats(LoadedStats(profile))
+            else:
+                self.stats.add(LoadedStats(profile))
+        self.records.extend(r for r in records if r.get("file") is not None)
+
+    def slowest(self, top=None, profiled=False):
+        # the slowest filings with their seconds per stage. The profiled ones run
+        # slower under cProfile, so they are ranked on their own with profiled=True
+        top = self.top if top is None else top
+        df = pd.DataFrame(self.records)
+        if df.shape[0] == 0:
+            return df
+        flags = pd.Series(False, index=df.index)
+        if "profiled" in df.columns:
+            flags = df["profiled"].fillna(False).astype(bool)
+        df = df.loc[flags == profiled]
+        stages = [name for name in STAGES if name in df.columns]
+        df["seconds"] = df[stages].sum(axis=1)
+        for key in COUNTS:
+            if key in df.columns:
+                df[key] = df[key].fillna(0).astype("int64")
+        cols = ["file", "pid", "seconds"] + stages + [key for key in COUNTS if key in df.columns]
+        return df.nlargest(top, "seconds")[cols].reset_index(drop=True)
+
+    def report(self, lines=40):
+        import io
+        out = io.StringIO()
+        nprofiled = sum(1 for r in self.records if r.get("profiled"))
+        out.write(f"profiled {nprofiled} of {len(self.records)} filings\n")
+        if self.stats is not None:
+            self.stats.stream = out
+            self.stats.strip_dirs().sort_stats(self.sortby).print_stats(lines)
+        for profiled, title in [(False, "filings, seconds per stage"),
+                                (True, "profiled filings, seconds per stage with the cProfile overhead")]:
+            slowest = self.slowest(profiled=profiled)
+            if slowest.shape[0] > 0:
+                out.write(f"slowest {slowest.shape[0]} {title}\n")
+                out.write(slowest.round(4).to_string(index=False) + "\n")
+        return out.getvalue()
+
+    def write(self, path, lines=40):
+        # the text report at path and the merged profile next to it as .prof for snakeviz/pstats
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write(self.report(lines=lines))
+        if self.stats is not None:
+            self.stats.dump_stats(os.path.splitext(path)[0] + ".prof")
+        return path
@@ -0,0 +1,122 @@
+import os
+import gzip
+import datetime
+import pandas as pd
+import benchmarks
+import downloadForms
+
+
+def fast_limiter():
+    return downloadForms.RateLimiter(rate=1000, burst=1000)
+
+
+def test_cache_revalidates_against_stub(tmp_path):
+    rootdir = tmp_path / "www"
+    rootdir.mkdir()
+    fpath = rootdir / "form.idx"
+    fpath.write_text("first version\n")
+    cache = downloadForms.HttpCache(str(tmp_path / "cache"))
+    limiter = fast_limiter()
+    with benchmarks.StubServer(str(rootdir)) as server:
+        url = server.url + "form.idx"
+        resp = downloadForms.get_url_resp(url, "testOut", "testErr", limiter=limiter, cache=cache)
+        assert resp.status_code == 200
+        assert resp.text == "first version\n"
+        assert cache.stored == 1
+        assert cache.get(url)[0]["lastModified"] is not None
+
+        # unchanged: a conditional request, the stub answers 304 and the body comes from the cache
+        resp = downloadForms.get_url_resp(url, "testOut", "testErr", limiter=limiter, cache=cache)
+        assert resp.status_code == 200
+        assert resp.from_cache
+        assert resp.text == "first version\n"
+        assert cache.revalidated == 1
+        assert cache.stored == 1
+
+        # changed on the server: a fresh 200 replaces the cached body
+        fpath.write_text("second version\n")
+        mtime = os.path.getmtime(fpath) + 10
+        os.utime(fpath, (mtime, mtime))
+        resp = downloadForms.get_url_resp(url, "testOut", "testErr", limiter=limiter, cache=cache)
+        assert resp.text == "second version\n"
+        assert not getattr(resp, "from_cache", False)
+        assert cache.stored == 2
+        assert cache.revalidated == 1
+
+    # immutable urls are served from the cache without a request, the stub is gone
+    resp = downloadForms.get_url_resp(url, "testOut", "testErr", limiter=limiter, cache=cache, immutable=True)
+    assert resp.text == "second version\n"
+    assert cache.hits == 1
+
+
+def index_line(form, company, CIK, date, url):
+    return f"{form:<12}{company:<62}{CIK:<12}{date:<12}{url}"
+
+
+def test_parse_form_index_columns_and_fallback():
+    lines = ["Daily Index of EDGAR Dissemination Feed by Form Type", "",
+             index_line("Form Type", "Company Name", "CIK", "Date Filed", "File Name"), "-" * 140,
+             index_line("13F-HR", "SMITH & JONES CAPITAL", 1234567, "20210908",
+                        "edgar/data/1234567/0001234567-21-000001.txt"),
+             # a company name wider than its column pushes the rest of the line right
+             index_line("4", "A VERY LONG COMPANY NAME THAT RUNS PAST THE SIXTY TWO CHARACTER COLUMN INC  ", 42,
+                        "20210908", "edgar/data/42/0000000042-21-000007.txt"),
+             # a name with non-ASCII characters, padded in bytes the way a byte oriented writer would
+             index_line("SC 13G/A", "SOCIÉTÉ GÉNÉRALE", 7, "20210908", "edgar/data/7/0000000007-21-000003.txt"),
+             "{:<12}{}{:<12}{:<12}{}".format("D", "CAFÉ HOLDINGS".encode().ljust(62).decode(), 99, "20210908",
+                                            "edgar/data/99/0000000099-21-000004.txt"),
+             "",
+             "NOT AN INDEX LINE"]
+    text = "\n".join(lines) + "\n"
+    for data in [text, text.encode()]:
+        df = downloadForms.parse_form_index(data, "testOut", "testErr")
+        assert list(df.columns) == downloadForms.FORM_INDEX_COLS + ["fid"]
+        assert df["form"].astype(str).tolist() == ["13F-HR", "4", "SC 13G/A", "D"]
+        assert df["company"].tolist() == ["SMITH & JONES CAPITAL",
+                                          "A VERY LONG COMPANY NAME THAT RUNS PAST THE SIXTY TWO CHARACTER COLUMN INC",
+                                          "SOCIÉTÉ GÉNÉRALE", "CAFÉ HOLDINGS"]
+        assert df["CIK"].tolist() == [1234567, 42, 7, 99]
+        assert str(df["CIK"].dtype) == "int64"
+        assert (df["date"] == "2021-09-08").all()
+        assert df["url"].iloc[1] == "edgar/data/42/0000000042-21-000007.txt"
+        assert df["fid"].tolist() == ["0001234567-21-000001", "0000000042-21-000007", "0000000007-21-000003",
+                                      "0000000099-21-000004"]
+
+    # the quarterly form.idx dates, and a file that is not an index at all
+    df = downloadForms.parse_form_index(text.replace("20210908", "2021-09-08"), "testOut", "testErr")
+    assert (df["date"] == "2021-09-08").all()
+    df = downloadForms.parse_form_index("<html>not found</html>", "testOut", "testErr")
+    assert df.shape[0] == 0
+    assert list(df.columns) == downloadForms.FORM_INDEX_COLS + ["fid"]
+
+
+def test_quarterly_index_splits_by_day(tmp_path):
+    # Friday the 3rd, a filing the SEC dated Saturday, nothing on Sunday or on Labor
+    # Day Monday, then Tuesday. The split keeps the days the index has, weekend or not
+    filings = [("13F-HR", "FUND A", 11, "2021-09-03"), ("4", "INSIDER B", 12, "2021-09-03"),
+               ("13F-HR/A", "FUND C", 13, "2021-09-04"),
+               ("13F-HR", "FUND D", 14, "2021-09-07"), ("4", "INSIDER E", 15, "2021-09-07"),
+               ("SC 13G", "FUND F", 16, "2021-09-07")]
+    lines = ["Description:           Master Index of EDGAR Dissemination Feed by Form Type", "",
+             index_line("Form Type", "Company Name", "CIK", "Date Filed", "File Name"), "-" * 140]
+    lines += [index_line(form, company, CIK, date, f"edgar/data/{CIK}/{CIK:010d}-21-{i:06d}.txt")
+              for i, (form, company, CIK, date) in enumerate(filings)]
+    rootdir = tmp_path / "www"
+    qdir = rootdir / "edgar" / "full-index" / "2021" / "QTR3"
+    qdir.mkdir(parents=True)
+    (qdir / "form.gz").write_bytes(gzip.compress(("\n".join(lines) + "\n").encode()))
+    basedir = str(tmp_path / "data")
+    with benchmarks.StubServer(str(rootdir)) as server, benchmarks.sec_archives(server.url):
+        days = downloadForms.get_quarterly_forms(2021, 3, basedir, "testOut", "testErr",
+                                                 cache=downloadForms.HttpCache(str(tmp_path / "cache")))
+    assert sorted(days) == [datetime.datetime(2021, 9, 3), datetime.datetime(2021, 9, 4),
+                            datetime.datetime(2021, 9, 7)]
+    assert [days[dt].shape[0] for dt in sorted(days)] == [2, 1, 3]
+    assert days[datetime.datetime(2021, 9, 4)]["form"].astype(str).tolist() == ["13F-HR/A"]
+    # the day's forms only, in the csv get_daily_forms writes for the day
+    assert set(days[datetime.datetime(2021, 9, 7)]["form"].cat.categories) == {"13F-HR", "4", "SC 13G"}
+    saved = sorted(os.listdir(os.path.join(basedir, "2021", "9")))
+    assert saved == ["secFilings_20210903.csv", "secFilings_20210904.csv", "secFilings_20210907.csv"]
+    df = pd.read_csv(os.path.join(basedir, "2021", "9", "secFilings_20210907.csv"))
+    assert df["CIK"].tolist() == [14, 15, 16]
+    assert df["fid"].tolist() == ["0000000014-21-000003", "0000000015-21-000004", "0000000016-21-000005"]
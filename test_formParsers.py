@@ -0,0 +1,24 @@
+import benchmarks
+import formParsers
+
+
+def write_filing(tmp_path, text, name="DOE-JOHN_CIK15_FID0000000015-21-000001.txt"):
+    fpath = tmp_path / name
+    fpath.write_text(text)
+    return str(fpath)
+
+
+def test_insider_entities_are_decoded(tmp_path):
+    # make_form4 writes the issuer as ACME &amp; SONS INC, as EDGAR does
+    text = benchmarks.make_form4(2, 1, CIK=15, fid="0000000015-21-000001", issuer="ACME & SONS INC")
+    text = text.replace("<officerTitle>Chief Executive Officer</officerTitle>",
+                        "<officerTitle>CEO &amp; Chair &lt;interim&gt; R&D</officerTitle>")
+    fpath = write_filing(tmp_path, text)
+    parser = formParsers.parser_for("4")
+    rows = parser(fpath, "form4", "testOut", "testErr", header={})
+    assert len(rows) == 3
+    df = formParsers.records_frame(rows, parser.columns)
+    assert set(df["issuerName"]) == {"ACME & SONS INC"}
+    assert set(df["officerTitle"]) == {"CEO & Chair <interim> R&D"}
+    assert df["derivative"].tolist() == [False, False, True]
+    assert df["isOfficer"].all()
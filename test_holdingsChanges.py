@@ -0,0 +1,33 @@
+import pandas as pd
+import holdingsChanges
+import holdingsStore
+from test_holdingsLoader import make_holdings, write_store
+
+
+def test_period_filter_reads_only_the_quarters_needed(tmp_path, monkeypatch):
+    storedir = str(tmp_path / "holdings")
+    quarters = [("2020-12-31", "2021-02-10"), ("2021-03-31", "2021-05-10"), ("2021-06-30", "2021-08-10"),
+                ("2021-09-30", "2021-11-10")]
+    for qi, (period, filingDt) in enumerate(quarters):
+        # the manager grows by a position every quarter, the other keeps its book
+        write_store(storedir, make_holdings(f"0000000001-21-00000{qi}", 1, 3 + qi, filingDt=filingDt, period=period),
+                    make_holdings(f"0000000002-21-00000{qi}", 2, 4, filingDt=filingDt, period=period))
+    # a filing without a period of report falls in the quarter before its filing date
+    write_store(storedir, make_holdings("0000000003-21-000001", 3, 2, filingDt="2021-08-11", period=None))
+    reads = []
+    read_holdings = holdingsStore.read_holdings
+
+    def counted(*args, **kwargs):
+        df = read_holdings(*args, **kwargs)
+        reads.append(df)
+        return df
+    monkeypatch.setattr(holdingsStore, "read_holdings", counted)
+
+    full = holdingsChanges.store_changes(storedir)
+    changes = holdingsChanges.store_changes(storedir, periods=["2021-06-30"])
+    # Q2 and Q1 holdings and the filing without a period, not Q4 2020 or Q3
+    assert reads[1].shape[0] == (5 + 4) + (4 + 4) + 2
+    assert set(changes["period"]) == {pd.Timestamp("2021-06-30")}
+    expected = full.loc[full["period"] == "2021-06-30"].reset_index(drop=True)
+    pd.testing.assert_frame_equal(changes.reset_index(drop=True), expected, check_categorical=False)
+    assert changes.groupby("change", observed=True).size().to_dict() == {"new": 1, "unchanged": 8}
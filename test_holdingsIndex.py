@@ -0,0 +1,37 @@
+import pandas as pd
+import holdingsIndex
+import holdingsStore
+from test_holdingsLoader import make_holdings, write_store
+
+
+def test_update_reads_only_new_store_files(tmp_path, monkeypatch):
+    storedir = str(tmp_path / "holdings")
+    indexdir = str(tmp_path / "index")
+    write_store(storedir, make_holdings("0000000001-21-000001", 1, 4), make_holdings("0000000002-21-000001", 2, 3))
+    reads = []
+    read_store_file = holdingsStore.read_store_file
+
+    def counted(fpath, storedir, columns=None):
+        reads.append(fpath)
+        return read_store_file(fpath, storedir, columns=columns)
+    monkeypatch.setattr(holdingsStore, "read_store_file", counted)
+
+    index = holdingsIndex.CusipIndex(indexdir)
+    assert index.update_from_store(storedir) == 2
+    assert len(reads) == 2
+    assert index.aggregate("000000001", period="2021-06-30")["holders"] == 2
+    index.save()
+
+    # a fresh index from disk skips the files it has, only the restatement is read
+    reads.clear()
+    index = holdingsIndex.CusipIndex(indexdir).load()
+    assert index.update_from_store(storedir) == 0
+    assert len(reads) == 0
+    write_store(storedir, make_holdings("0000000001-21-000002", 1, 2, form="13F-HR_A",
+                                        filingDt="2021-08-20 09:00:00", amendmentType="RESTATEMENT"))
+    assert index.update_from_store(storedir) == 1
+    assert len(reads) == 1
+    holders = index.holders("000000001", period=pd.Timestamp("2021-06-30"))
+    assert set(holders["fid"]) == {"0000000001-21-000002", "0000000002-21-000001"}
+    # only the replaced filing held cusip 3
+    assert index.aggregate("000000003", period="2021-06-30") is None
@@ -0,0 +1,180 @@
+import os
+import sqlite3
+import pandas as pd
+import holdingsLoader
+import holdingsStore
+
+
+def make_holdings(fid, CIK, nrows, form="13F-HR", filingDt="2021-08-10 16:00:00", period="2021-06-30",
+                  amendmentType=None):
+    filingDt = pd.Timestamp(filingDt)
+    df = pd.DataFrame({
+        "CIK": CIK, "fid": fid, "company": f"FUND {CIK}",
+        "nameOfIssuer": [f"ISSUER {i}" for i in range(nrows)],
+        "cusip": [f"{i:09d}" for i in range(nrows)],
+        "value": [1000 * (i + 1) for i in range(nrows)],
+        "sshPrnamt": [10 * i for i in range(nrows)],
+        "year": filingDt.year, "month": filingDt.month, "day": filingDt.day, "form": form,
+        "filingDt": filingDt, "period": pd.Timestamp(period), "amendmentType": amendmentType})
+    # the first row holds no shares, its perSh is inf
+    df["perSh"] = df["value"] / df["sshPrnamt"]
+    return df
+
+
+def write_store(storedir, *dfs):
+    for df in dfs:
+        assert holdingsStore.write_holdings(df, str(storedir), "testOut", "testErr") == df.shape[0]
+
+
+def count(conn, sql, *args):
+    return conn.execute(sql, args).fetchone()[0]
+
+
+def test_load_store_and_rerun(tmp_path):
+    storedir = tmp_path / "holdings"
+    write_store(storedir, make_holdings("0000000001-21-000001", 1, 5),
+                make_holdings("0000000002-21-000001", 2, 3))
+    conn = sqlite3.connect(":memory:")
+    loader = holdingsLoader.HoldingsLoader(conn, "testOut", "testErr", dialect="sqlite", batchRows=4)
+    loader.create_tables()
+    stats = loader.load_store(str(storedir))
+    assert stats["rows"] == 8
+    assert stats["sources"] == 2
+    assert count(conn, "SELECT count(*) FROM holdings") == 8
+    assert count(conn, f"SELECT count(*) FROM {holdingsLoader.CHECKPOINT_TABLE}") == 2
+    # inf is not a DOUBLE, the zero share rows load with a NULL perSh
+    assert count(conn, 'SELECT count(*) FROM holdings WHERE "perSh" IS NULL') == 2
+    assert count(conn, "SELECT period FROM holdings LIMIT 1") == "2021-06-30"
+
+    # a rerun skips the sources in the checkpoint table and loads only the new one
+    write_store(storedir, make_holdings("0000000003-21-000001", 3, 2))
+    loader = holdingsLoader.HoldingsLoader(conn, "testOut", "testErr", dialect="sqlite")
+    stats = loader.load_store(str(storedir))
+    assert stats["skipped"] == 2
+    assert stats["sources"] == 1
+    assert count(conn, "SELECT count(*) FROM holdings") == 10
+
+
+def test_infile_lines_escape_and_null():
+    # LOAD DATA needs MariaDB, its text is checked here: separators escaped, NULL as \N
+    df = holdingsLoader.sql_holdings(make_holdings("0000000001-21-000001", 1, 2).assign(
+        nameOfIssuer=["TAB\tAND\\SLASH", "LINE\nBREAK"]))
+    lines = holdingsLoader.infile_lines(df)
+    assert len(lines) == 2
+    fields = dict(zip(df.columns, lines[0].split("\t")))
+    assert fields["nameOfIssuer"] == "TAB\\tAND\\\\SLASH"
+    assert fields["perSh"] == "\\N"
+    assert fields["putCall"] == "\\N"
+    assert fields["filingDt"] == "2021-08-10 16:00:00"
+    assert dict(zip(df.columns, lines[1].split("\t")))["nameOfIssuer"] == "LINE\\nBREAK"
+
+
+def sync_store(conn, storedir):
+    sync = holdingsLoader.HoldingsSync(conn, "testOut", "testErr", dialect="sqlite")
+    sync.create_tables()
+    return sync.load_store(str(storedir))
+
+
+def holdings_by_fid(conn):
+    return dict(conn.execute("SELECT fid, count(*) FROM holdings GROUP BY fid").fetchall())
+
+
+def superseded_by(conn):
+    return dict(conn.execute(f"SELECT fid, supersededBy FROM {holdingsLoader.FILINGS_TABLE}").fetchall())
+
+
+def test_sync_supersedes_restated_filings(tmp_path):
+    storedir = tmp_path / "holdings"
+    conn = sqlite3.connect(":memory:")
+    original = "0000000001-21-000001"
+    write_store(storedir, make_holdings(original, 1, 4), make_holdings("0000000002-21-000001", 2, 3))
+    stats = sync_store(conn, storedir)
+    assert stats["filings"] == 2
+    assert holdings_by_fid(conn) == {original: 4, "0000000002-21-000001": 3}
+
+    # a NEW HOLDINGS amendment adds to the original
+    added = "0000000001-21-000002"
+    write_store(storedir, make_holdings(added, 1, 2, form="13F-HR_A", filingDt="2021-08-12 09:00:00",
+                                        amendmentType="NEW HOLDINGS"))
+    stats = sync_store(conn, storedir)
+    assert stats["filings"] == 1
+    assert stats["superseded"] == 0
+    assert holdings_by_fid(conn)[original] == 4
+    assert holdings_by_fid(conn)[added] == 2
+
+    # a restatement replaces everything filed before it for the CIK and period
+    restated = "0000000001-21-000003"
+    write_store(storedir, make_holdings(restated, 1, 3, form="13F-HR_A", filingDt="2021-08-20 09:00:00",
+                                        amendmentType="RESTATEMENT"))
+    stats = sync_store(conn, storedir)
+    assert stats["superseded"] == 6
+    assert holdings_by_fid(conn) == {restated: 3, "0000000002-21-000001": 3}
+    assert superseded_by(conn)[original] == restated
+    assert superseded_by(conn)[added] == restated
+    assert superseded_by(conn)[restated] is None
+
+    # a filing seen before under another source is not loaded twice
+    write_store(storedir, make_holdings("0000000002-21-000001", 2, 3))
+    stats = sync_store(conn, storedir)
+    assert stats["duplicates"] == 1
+    assert stats["filings"] == 0
+    assert holdings_by_fid(conn)["0000000002-21-000001"] == 3
+
+
+def test_sync_supersedes_whatever_the_arrival_order(tmp_path):
+    # the restatement is loaded first, the filing it replaces arrives later
+    storedir = tmp_path / "holdings"
+    conn = sqlite3.connect(":memory:")
+    restated = "0000000001-21-000003"
+    write_store(storedir, make_holdings(restated, 1, 3, form="13F-HR_A", filingDt="2021-08-20 09:00:00",
+                                        amendmentType="RESTATEMENT"))
+    sync_store(conn, storedir)
+    original = "0000000001-21-000001"
+    write_store(storedir, make_holdings(original, 1, 4))
+    stats = sync_store(conn, storedir)
+    assert stats["filings"] == 1
+    assert stats["superseded"] == 4
+    assert holdings_by_fid(conn) == {restated: 3}
+    assert superseded_by(conn)[original] == restated
+
+
+def test_load_csvs_skips_other_datasets(tmp_path, monkeypatch):
+    # a csv tree from parse_forms without a store: 13F-HR, 13F-NT and Form 4
+    # directories side by side, only the holdings go in
+    import datetime
+    import benchmarks
+    import parseForms
+    monkeypatch.chdir(tmp_path)
+    dt = datetime.datetime(2021, 9, 8)
+    corpus = benchmarks.make_corpus(str(tmp_path / "sec"), dt, nfilings=30, rows=(2, 20), ntShare=0.3,
+                                    badShare=0.0, insiderShare=0.3)
+    formsdf, sdirs = benchmarks.stage_corpus(str(tmp_path / "sec"), "data", dt, "testOut", "testErr")
+    assert set(corpus["form"]) == {"13F-HR", "13F-NT", "4"}
+    for sdir in sdirs:
+        txtfiles = [f for f in os.listdir(sdir) if f.endswith(".txt")]
+        stats = parseForms.parse_forms(sdir, "testOut", "testErr", txtfiles=txtfiles)
+        assert stats["failures"] == 0
+    conn = sqlite3.connect(":memory:")
+    sync = holdingsLoader.HoldingsSync(conn, "testOut", "testErr", dialect="sqlite")
+    sync.create_tables()
+    stats = sync.load_csvs("data")
+    holdings = corpus.loc[corpus["form"] == "13F-HR"]
+    assert stats["sources"] == holdings.shape[0]
+    assert stats["rows"] == holdings["rows"].sum()
+    assert count(conn, "SELECT count(DISTINCT form) FROM holdings") == 1
+
+
+def test_create_tables_refuses_an_old_holdings_table():
+    # the table database.ipynb made with to_sql: a text CIK, a manager column, no fid or period
+    import pytest
+    conn = sqlite3.connect(":memory:")
+    conn.execute('CREATE TABLE holdings ("CIK" TEXT, "manager" TEXT, "nameOfIssuer" TEXT, "cusip" TEXT, '
+                 '"value" BIGINT, "sshPrnamt" BIGINT)')
+    loader = holdingsLoader.HoldingsLoader(conn, "testOut", "testErr", dialect="sqlite")
+    with pytest.raises(RuntimeError, match="missing: .*'fid'.*extra: \\['manager'\\]"):
+        loader.create_tables()
+    # another table name leaves the old one alone
+    loader = holdingsLoader.HoldingsSync(conn, "testOut", "testErr", dialect="sqlite", table="holdings13f")
+    loader.create_tables()
+    loader.create_tables()
+    assert count(conn, "SELECT count(*) FROM holdings13f") == 0
@@ -0,0 +1,144 @@
+import os
+import datetime
+import pandas as pd
+import benchmarks
+import parseForms
+from utilities import Utilities
+
+DT = datetime.datetime(2021, 9, 8)
+
+
+def stage_day(tmp_path, monkeypatch, nfilings=6, seed=0, compress=None):
+    # a synthetic day of 13F-HR filings staged under data/ as downloadForms
+    # leaves it, parse_forms takes the year, month and day from the path
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    monkeypatch.chdir(tmp_path)
+    benchmarks.make_corpus(str(tmp_path / "sec"), DT, nfilings=nfilings, rows=(2, 40), ntShare=0.0,
+                           badShare=0.0, seed=seed)
+    formsdf, sdirs = benchmarks.stage_corpus(str(tmp_path / "sec"), "data", DT, "testOut", "testErr",
+                                             compress=compress)
+    return sdirs[0]
+
+
+def txt_files(sdir):
+    return sorted(f for f in os.listdir(sdir) if Utilities.filing_stem(f) is not None)
+
+
+def parse_csvs(sdir, **kwargs):
+    for fname in os.listdir(sdir):
+        if fname.endswith(".csv"):
+            os.remove(os.path.join(sdir, fname))
+    stats = parseForms.parse_forms(sdir, "testOut", "testErr", txtfiles=txt_files(sdir), **kwargs)
+    assert stats["failures"] == 0
+    csvs = sorted(f for f in os.listdir(sdir) if f.endswith(".csv"))
+    return pd.concat([pd.read_csv(os.path.join(sdir, f)) for f in csvs], ignore_index=True)
+
+
+def test_issuer_entities_survive_stream_and_mmap(tmp_path, monkeypatch):
+    sdir = stage_day(tmp_path, monkeypatch, nfilings=2)
+    # one issuer with an entity and one with a bare ampersand, as EDGAR has both
+    fpath = os.path.join(sdir, txt_files(sdir)[0])
+    with open(fpath) as fp:
+        text = fp.read()
+    text = text.replace("ISSUER 0 &amp; CO", "AT&amp;T INC", 1).replace("ISSUER 1 &amp; CO", "JOHNSON & JOHNSON", 1)
+    with open(fpath, "w") as fp:
+        fp.write(text)
+    for use_mmap in [False, True]:
+        df = parse_csvs(sdir, use_mmap=use_mmap)
+        names = set(df["nameOfIssuer"])
+        assert {"AT&T INC", "JOHNSON & JOHNSON"} <= names
+        assert all(name.endswith(" & CO") for name in names if name.startswith("ISSUER"))
+        assert not any("and" in name for name in names)
+    # the legacy path keeps its fixup, ampersands become "and"
+    df = parse_csvs(sdir, stream=False)
+    assert "ATandamp;T INC" in set(df["nameOfIssuer"])
+
+
+def test_mmap_chunks_never_split_an_entity():
+    text = benchmarks.make_13f(20).replace("ISSUER 3 &amp; CO", "R&D & CO")
+    lines = "".join(parseForms.info_table_lines(text.splitlines(keepends=True), {}))
+    # tiny chunks cut the document everywhere, entities included, without the tag rule
+    chunks = parseForms.info_table_chunks_mmap(text.encode(), {}, chunksize=7)
+    assert b"".join(chunks).decode() == lines
+    assert "R&amp;D &amp; CO" in lines
+
+
+def test_parse_all_passes_use_mmap(tmp_path, monkeypatch):
+    # workers as threads so the mmap reader can be counted in this process
+    from concurrent.futures import ThreadPoolExecutor
+    sdir = stage_day(tmp_path, monkeypatch, nfilings=4)
+    calls = []
+    parse_form_mmap = parseForms.parse_form_mmap
+
+    def counted(fpath, *args, **kwargs):
+        calls.append(fpath)
+        return parse_form_mmap(fpath, *args, **kwargs)
+    monkeypatch.setattr(parseForms, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(parseForms, "parse_form_mmap", counted)
+    stats = parseForms.parallel_parse(sdir, "testOut", "testErr", ncpu=2, storedir=str(tmp_path / "holdings"))
+    assert stats["parsed"] == 4
+    assert len(calls) == 0
+    stats = parseForms.parallel_parse(sdir, "testOut", "testErr", ncpu=2, storedir=str(tmp_path / "holdings2"),
+                                      use_mmap=True)
+    assert stats["parsed"] == 4
+    assert len(calls) == 4
+
+
+def rewrite_newlines(sdir, newline):
+    for fname in txt_files(sdir):
+        fpath = os.path.join(sdir, fname)
+        with open(fpath, newline="") as fp:
+            text = fp.read().replace("\r\n", "\n")
+        with open(fpath, "w", newline="") as fp:
+            fp.write(text.replace("\n", newline))
+
+
+def comparable(df):
+    # the legacy fixup turns & into "and", the entity of make_13f comes out as "andamp;"
+    df = df.assign(nameOfIssuer=df["nameOfIssuer"].str.replace("andamp;", "&", regex=False))
+    return df.sort_values(["fid", "nameOfIssuer", "cusip"], ignore_index=True)
+
+
+def test_stream_matches_legacy_parse(tmp_path, monkeypatch):
+    sdir = stage_day(tmp_path, monkeypatch, nfilings=8, seed=3)
+    for newline in ["\n", "\r\n"]:
+        rewrite_newlines(sdir, newline)
+        legacy = comparable(parse_csvs(sdir, stream=False))
+        stream = comparable(parse_csvs(sdir))
+        assert legacy.shape[0] > 0
+        assert set(stream.columns) == set(legacy.columns)
+        pd.testing.assert_frame_equal(stream[legacy.columns], legacy)
+
+
+def test_mmap_matches_stream_parse(tmp_path, monkeypatch):
+    sdir = stage_day(tmp_path / "plain", monkeypatch, nfilings=8, seed=5)
+    for newline in ["\n", "\r\n"]:
+        rewrite_newlines(sdir, newline)
+        stream = comparable(parse_csvs(sdir))
+        mapped = comparable(parse_csvs(sdir, use_mmap=True))
+        assert stream.shape[0] > 0
+        pd.testing.assert_frame_equal(mapped, stream)
+    # compressed filings can't be mapped, they go through the stream reader
+    sdir = stage_day(tmp_path / "gzip", monkeypatch, nfilings=8, seed=5, compress="gzip")
+    assert all(fname.endswith(".gz") for fname in txt_files(sdir))
+    pd.testing.assert_frame_equal(comparable(parse_csvs(sdir, use_mmap=True)), stream)
+
+
+def random_envelope(rnd):
+    # lines built from the pieces fixup cares about: the tags without closing tags,
+    # their closing tags, other tags, prologs, ampersands and text, in any order
+    pieces = ["<TYPE>", "</TYPE>", "<SEQUENCE>", "</SEQUENCE>", "<FILENAME>", "</FILENAME>", "<DESCRIPTION>",
+              "</DESCRIPTION>", "<TEXT>", "</TEXT>", "<XML>", "<value>", "</value>", '<?xml version="1.0"?>',
+              "<ACCEPTANCE-DATETIME>", "&", "&amp;", "13F-HR", "1", "primary_doc.xml", " ", "\t", "x y", "<", ">"]
+    lines = ["".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 8))) for _ in range(rnd.randint(1, 30))]
+    return rnd.choice(["\n", "\r\n"]).join(lines)
+
+
+def test_fixup_matches_reference():
+    import random
+    rnd = random.Random(11)
+    texts = [random_envelope(rnd) for _ in range(400)]
+    texts += [benchmarks.make_filing(kind, rnd.randint(0, 20), seed=i)
+              for i, kind in enumerate(["13F-HR", "13F-NT", "4"] + list(benchmarks.MALFORMED))]
+    for text in texts:
+        assert parseForms.fixup(text, "testOut", "testErr") == benchmarks.fixup_reference(text), repr(text)
@@ -6,6 +6,9 @@ import datetime
 import logging
 
 class Utilities(object):
+    # raw filings are saved as .txt, optionally gzip or zstd compressed
+    FILING_SUFFIXES = {None: ".txt", "gzip": ".txt.gz", "zstd": ".txt.zst"}
+
     @staticmethod
     def now():
         import datetime
@@ -63,10 +66,50 @@ class Utilities(object):
             que.extend(dirs)
         return res
 
+    @staticmethod
+    def filing_stem(fname):
+        # file name without the .txt/.txt.gz/.txt.zst suffix, None if not a raw filing
+        for suffix in sorted(Utilities.FILING_SUFFIXES.values(), key=len, reverse=True):
+            if fname.endswith(suffix):
+                stem = fname[:-len(suffix)]
+                if stem.endswith("_fixed"):
+                    return None
+                return stem
+        return None
+
+    @staticmethod
+    def open_filing(fpath, mode="rt"):
+        # opens a raw filing, decompressing on the fly when the suffix says so
+        if fpath.endswith(".gz"):
+            import gzip
+            if "w" in mode:
+                return gzip.open(fpath, mode, compresslevel=6)
+            return gzip.open(fpath, mode)
+        if fpath.endswith(".zst"):
+            import zstandard
+            return zstandard.open(fpath, mode)
+        return open(fpath, mode)
+
+    @staticmethod
+    def new_stats(**kwargs):
+        # counters a batch of work reports back to its coordinator
+        stats = {"files": 0, "failures": 0, "elapsed": 0.0}
+        stats.update(kwargs)
+        return stats
+
+    @staticmethod
+    def add_stats(total, stats):
+        if not isinstance(stats, dict):
+            return total
+        for key, val in stats.items():
+            if isinstance(val, (int, float)) and not isinstance(val, bool):
+                total[key] = total.get(key, 0) + val
+        return total
+
     @staticmethod
     def log_msg(msg, loggers, level=logging.WARNING):
         try:
-            if not isinstance(loggers, list) or not isinstance(loggers, tuple):
+            if not isinstance(loggers, (list, tuple)):
                 msg = f"{Utilities.get_fname()} loggers should be a list"
                 raise RuntimeError(msg)
             for lname in loggers: